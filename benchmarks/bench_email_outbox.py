@@ -0,0 +1,77 @@
+"""
+Notifications sent one request each (before) and queued as jobs which
+the email outbox sends in batches (after), against the stub Mailgun served in-process with a simulated
+network latency, so it runs offline. Run from the project directory:
+python -m benchmarks.bench_email_outbox
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+
+os.environ.setdefault("STUB_LATENCY_MS", "20")
+os.environ["DEV_DATABASE_URL"] = "sqlite:///" + os.path.join(
+    tempfile.mkdtemp(), "bench.db"
+)
+os.environ["DEV_MAILGUN_API_URL"] = "http://stub/v3"
+os.environ["DEV_MAILGUN_DOMAIN"] = "bench.example.net"
+os.environ["DEV_MAILGUN_API_KEY"] = "bench"
+
+from httpx import ASGITransport, AsyncClient  # noqa: E402
+
+from storeapi import http_clients, stub_upstream, tasks  # noqa: E402
+from storeapi.database import database  # noqa: E402
+
+EMAILS = 2000
+# as many emails in flight as the email workers send at once
+CONCURRENCY = 4
+
+
+async def send_each(emails: list[str]) -> None:
+    slots = asyncio.Semaphore(CONCURRENCY)
+
+    async def send(to: str):
+        async with slots:
+            await tasks.send_templated_email(to, "image_ready", {"url": "/post/1"})
+
+    await asyncio.gather(*(send(to) for to in emails))
+
+
+async def send_batched(emails: list[str]) -> None:
+    for to in emails:
+        await tasks.send_templated_email(to, "image_ready", {"url": "/post/1"})
+    while await tasks.email_outbox.flush():
+        pass
+
+
+async def run(label: str, send) -> None:
+    stub_upstream.stats.update(requests=0, messages=0)
+    emails = [f"user{i}@example.net" for i in range(EMAILS)]
+    start = time.perf_counter()
+    await send(emails)
+    elapsed = time.perf_counter() - start
+    assert stub_upstream.stats["messages"] == EMAILS
+    print(
+        f"{label:>6}: {EMAILS / elapsed:8.1f} emails/s,"
+        f" {stub_upstream.stats['requests']} requests"
+    )
+
+
+async def main() -> None:
+    await database.connect()
+    http_clients._clients["mailgun"] = AsyncClient(
+        transport=ASGITransport(app=stub_upstream.app)
+    )
+    await run("before", send_each)
+    # flushed by send_batched only, so timing covers every email
+    tasks.email_outbox.flush_interval = 3600
+    tasks.email_outbox.start()
+    await run("after", send_batched)
+    await tasks.email_outbox.stop()
+    await http_clients.close_http_clients()
+    await database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
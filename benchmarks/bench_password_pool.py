@@ -0,0 +1,96 @@
+"""
+Concurrent logins against an in-process app, while another client keeps
+polling /hello, once with bcrypt on the event loop (before) and once with
+bcrypt in the password pool (after). Run from the project directory:
+python -m benchmarks.bench_password_pool
+"""
+
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+# every login comes from one client, measure the pool rather than throttling
+os.environ["DEV_THROTTLE_ENABLED"] = "false"
+os.environ["DEV_DATABASE_URL"] = "sqlite:///" + os.path.join(
+    tempfile.mkdtemp(), "bench.db"
+)
+
+from fastapi import FastAPI  # noqa: E402
+from httpx import ASGITransport, AsyncClient  # noqa: E402
+
+from storeapi import security  # noqa: E402
+from storeapi.database import database, user_table  # noqa: E402
+from storeapi.routers.users import router as users_router  # noqa: E402
+
+LOGINS = 32
+USER = {"email": "bench@example.net", "password": "1234"}
+
+app = FastAPI()
+app.include_router(users_router)
+
+
+@app.get("/hello")
+async def hello():
+    return {"message": "Hello World"}
+
+
+async def verify_on_event_loop(plain_password: str, hashed_password: str) -> bool:
+    return security.verify_password(plain_password, hashed_password)
+
+
+async def probe(client: AsyncClient, latencies: list[float], done: asyncio.Event):
+    """
+    Latency is counted from when the request was due, so the time
+    it waited for a blocked event loop is included
+    """
+    while not done.is_set():
+        due = time.perf_counter() + 0.005
+        await asyncio.sleep(0.005)
+        await client.get("/hello")
+        latencies.append(time.perf_counter() - due)
+
+
+async def run(label: str) -> None:
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://bench"
+    ) as client:
+        latencies: list[float] = []
+        done = asyncio.Event()
+        prober = asyncio.create_task(probe(client, latencies, done))
+        start = time.perf_counter()
+        responses = await asyncio.gather(
+            *(client.post("/login", json=USER) for _ in range(LOGINS))
+        )
+        elapsed = time.perf_counter() - start
+        done.set()
+        await prober
+    assert all(res.status_code == 201 for res in responses)
+    p99 = statistics.quantiles(latencies, n=100)[98] if len(latencies) > 1 else 0
+    print(
+        f"{label:>6}: {LOGINS / elapsed:6.1f} logins/s,"
+        f" /hello p99 {p99 * 1000:7.1f} ms over {len(latencies)} requests"
+    )
+
+
+async def main() -> None:
+    await database.connect()
+    await database.execute(
+        user_table.insert().values(
+            email=USER["email"],
+            password=security.get_password_hash(USER["password"]),
+            confirmed=True,
+        )
+    )
+    pooled = security.averify_password
+    security.averify_password = verify_on_event_loop
+    await run("before")
+    security.averify_password = pooled
+    await run("after")
+    await database.disconnect()
+    security.password_pool.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,3 +1,14 @@
 uvicorn storeapi.main:app --reload
 # delpoy
 # uvicorn storeapi.main:app --host 0.0.0.0 --port $PORT(8000)
+# backfill posts.like_count for an existing database
+# python -m storeapi.commands reconcile-likes
+# add new columns and indexes to an existing database
+# python -m storeapi.commands migrate
+# index existing posts and comments for GET /post/search
+# python -m storeapi.commands rebuild-search
+# run background jobs in their own process, set JOB_WORKERS=0 for the app then
+# python -m storeapi.commands work-jobs
+# fake DeepAI and Mailgun for local runs, with DEV_DEEPAI_API_URL=http://localhost:8001/api
+# and DEV_MAILGUN_API_URL=http://localhost:8001/v3
+# uvicorn storeapi.stub_upstream:app --port 8001
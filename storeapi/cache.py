@@ -0,0 +1,242 @@
+import abc
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable
+
+from storeapi import metrics
+from storeapi.config import config
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """
+    In-process LRU cache, an entry is dropped when it expires or when
+    it is the least recently used one and the cache is full.
+    Entries can be tagged to invalidate a group of them at once.
+    Every invalidation gets a sequence number, a value read before an
+    invalidation of one of its tags is not set afterwards, see version.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        maxsize: int = 1024,
+        ttl: float = 60,
+        timer: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._data: OrderedDict[Hashable, tuple[float, Any, tuple]] = OrderedDict()
+        self._tags: dict[str, set[Hashable]] = {}
+        self.hits = 0
+        self.misses = 0
+        # sequence of the last invalidation of the recently invalidated tags,
+        # set() of a version older than _floor is refused as it may be stale
+        self.version = 0
+        self._invalidated: OrderedDict[str, int] = OrderedDict()
+        self._floor = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, record=False) is not None
+
+    def get(self, key: Hashable, record: bool = True) -> Any | None:
+        entry = self._data.get(key)
+        if entry is not None and entry[0] <= self.timer():
+            self._remove(key, "expired")
+            entry = None
+        if entry is None:
+            if record:
+                self.misses += 1
+                metrics.cache_misses.labels(self.name).inc()
+                self._record_ratio()
+            return None
+        self._data.move_to_end(key)
+        if record:
+            self.hits += 1
+            metrics.cache_hits.labels(self.name).inc()
+            self._record_ratio()
+        return entry[1]
+
+    def _record_ratio(self) -> None:
+        ratio = self.hits / (self.hits + self.misses)
+        metrics.cache_hit_ratio.labels(self.name).set(ratio)
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        tags: Iterable[str] = (),
+        ttl: float | None = None,
+        version: int | None = None,
+    ) -> bool:
+        """
+        :param: ttl: seconds to live, overrides the ttl of the cache
+        :param: version: of the cache before the value was read, the value is
+        not set when one of its tags has been invalidated since
+        :return: whether the value has been set
+        """
+        tags = tuple(tags)
+        if version is not None and self.is_stale(version, tags):
+            logger.debug(f"Skipped setting stale entry of {self.name} cache")
+            return False
+        if key in self._data:
+            self._remove(key)
+        expire = self.timer() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expire, value, tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._data) > self.maxsize:
+            self._remove(next(iter(self._data)), "size")
+        metrics.cache_size.labels(self.name).set(len(self._data))
+        return True
+
+    def is_stale(self, version: int, tags: Iterable[str]) -> bool:
+        if version < self._floor:
+            return True
+        return any(self._invalidated.get(tag, 0) > version for tag in tags)
+
+    def _record_invalidation(self, tags: Iterable[str]) -> None:
+        self.version += 1
+        for tag in tags:
+            self._invalidated.pop(tag, None)
+            self._invalidated[tag] = self.version
+        while len(self._invalidated) > self.maxsize:
+            _, seq = self._invalidated.popitem(last=False)
+            self._floor = max(self._floor, seq)
+
+    def pop(self, key: Hashable) -> Any | None:
+        if key not in self._data:
+            return None
+        value = self._data[key][1]
+        self._remove(key)
+        metrics.cache_size.labels(self.name).set(len(self._data))
+        return value
+
+    def invalidate(self, *tags: str) -> int:
+        """Drop every entry carrying any of the tags, return number of entries"""
+        self._record_invalidation(tags)
+        keys = set().union(*(self._tags.get(tag, ()) for tag in tags))
+        for key in keys:
+            self._remove(key)
+        if keys:
+            logger.debug(f"Invalidated {len(keys)} entries of {self.name} cache")
+        metrics.cache_size.labels(self.name).set(len(self._data))
+        return len(keys)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._tags.clear()
+        self.version += 1
+        self._invalidated.clear()
+        self._floor = self.version
+        metrics.cache_size.labels(self.name).set(0)
+
+    def _remove(self, key: Hashable, eviction: str | None = None) -> None:
+        _, _, tags = self._data.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+        if eviction:
+            metrics.cache_evictions.labels(self.name, eviction).inc()
+
+
+class CacheBackend(abc.ABC):
+    """
+    Interface of the response cache, an implementation backed by
+    an external store can be installed by set_response_cache()
+    """
+
+    @abc.abstractmethod
+    async def get(self, key: str) -> Any | None: ...
+
+    @abc.abstractmethod
+    async def set(
+        self,
+        key: str,
+        value: Any,
+        tags: Iterable[str] = (),
+        version: int | None = None,
+    ) -> None:
+        """
+        :param: version: taken by version() before reading the value, which
+        is not set when one of its tags has been invalidated since
+        """
+
+    @abc.abstractmethod
+    async def version(self) -> int | None:
+        """Current invalidation sequence, None when not supported"""
+
+    @abc.abstractmethod
+    async def invalidate(self, *tags: str) -> None: ...
+
+    @abc.abstractmethod
+    async def clear(self) -> None: ...
+
+
+class InMemoryCacheBackend(CacheBackend):
+    def __init__(self, cache: TTLCache) -> None:
+        self.cache = cache
+
+    async def get(self, key: str) -> Any | None:
+        return self.cache.get(key)
+
+    async def set(
+        self,
+        key: str,
+        value: Any,
+        tags: Iterable[str] = (),
+        version: int | None = None,
+    ) -> None:
+        self.cache.set(key, value, tags, version=version)
+
+    async def version(self) -> int | None:
+        return self.cache.version
+
+    async def invalidate(self, *tags: str) -> None:
+        self.cache.invalidate(*tags)
+
+    async def clear(self) -> None:
+        self.cache.clear()
+
+
+_response_cache: CacheBackend = InMemoryCacheBackend(
+    TTLCache(
+        "response",
+        maxsize=config.RESPONSE_CACHE_MAXSIZE,
+        ttl=config.RESPONSE_CACHE_TTL,
+    )
+)
+
+
+def get_response_cache() -> CacheBackend:
+    return _response_cache
+
+
+def set_response_cache(backend: CacheBackend) -> None:
+    global _response_cache
+    _response_cache = backend
+
+
+def post_tag(post_id: int) -> str:
+    """Tag of every response which shows the post"""
+    return f"post:{post_id}"
+
+
+def comments_tag(post_id: int) -> str:
+    """Tag of every response which shows comments of the post"""
+    return f"comments:{post_id}"
+
+
+def feed_tag(sorting: str | None = None) -> str:
+    """Tag of the pages of GET /post, sorting narrows it to one sort mode"""
+    return f"feed:{sorting}" if sorting else "feed"
@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, NamedTuple
+
+import httpx
+
+from storeapi import metrics
+from storeapi.config import config
+
+logger = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# calls slower than this shrink the concurrency limit of an upstream
+UPSTREAM_LATENCY_TARGETS = {
+    "mailgun": lambda: config.MAILGUN_LATENCY_TARGET,
+    "deepai": lambda: config.DEEPAI_LATENCY_TARGET,
+}
+
+
+class UpstreamUnavailable(Exception):
+    """A call refused without reaching the upstream"""
+
+
+def is_upstream_failure(exc: BaseException | None) -> bool:
+    """Errors of the upstream itself, a 4xx other than 429 is our fault"""
+    if isinstance(exc, httpx.TransportError):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError):
+        code = exc.response.status_code
+        return code >= 500 or code == 429
+    return False
+
+
+class Admission(NamedTuple):
+    """A call let through by CircuitBreaker.allow()"""
+
+    # transitions of the breaker before the call
+    generation: int
+    probe: bool
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures, so calls fail fast
+    instead of waiting for a timeout. After reset_timeout one probe call
+    is let through (half open), its outcome closes or opens the circuit again.
+    Outcomes of calls let through before the last transition are ignored.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int,
+        reset_timeout: float,
+        timer: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timer = timer
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.generation = 0
+        metrics.circuit_state.labels(name).set(STATE_VALUES[CLOSED])
+
+    def _transition(self, state: str) -> None:
+        if state == self.state:
+            return
+        logger.warning(f"Circuit of {self.name} {self.state} -> {state}")
+        self.state = state
+        self.generation += 1
+        metrics.circuit_state.labels(self.name).set(STATE_VALUES[state])
+        metrics.circuit_transitions.labels(self.name, state).inc()
+
+    def refuses(self) -> bool:
+        """Whether allow() would refuse a call now, without admitting one"""
+        if self.state == OPEN:
+            return self.timer() - self.opened_at < self.reset_timeout
+        return self.state == HALF_OPEN and self.probing
+
+    def allow(self) -> Admission | None:
+        """:return: None when the call is refused"""
+        if self.state == OPEN and self.timer() - self.opened_at >= self.reset_timeout:
+            self._transition(HALF_OPEN)
+        if self.state == CLOSED:
+            return Admission(self.generation, probe=False)
+        if self.state == HALF_OPEN and not self.probing:
+            self.probing = True
+            return Admission(self.generation, probe=True)
+        return None
+
+    def record(self, failed: bool, admission: Admission | None = None) -> None:
+        """:param: admission: of the call, None for a call of the current state"""
+        if admission is not None and admission.generation != self.generation:
+            # let through before the circuit changed, it says nothing about now
+            return
+        self.probing = False
+        if not failed:
+            self.failures = 0
+            self._transition(CLOSED)
+            return
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = self.timer()
+            self._transition(OPEN)
+
+    def cancel(self, admission: Admission) -> None:
+        """The call let through has not been made"""
+        if admission.probe and admission.generation == self.generation:
+            self.probing = False
+
+
+class AIMDLimiter:
+    """
+    Concurrency limit which grows by one per limit of calls answered in time
+    (additive increase), and halves when a call fails or is slower than
+    latency_target (multiplicative decrease). Calls above it wait in turn.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial: int,
+        min_limit: int,
+        max_limit: int,
+        latency_target: float,
+        backoff_ratio: float = 0.5,
+    ) -> None:
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff_ratio = backoff_ratio
+        self.in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        metrics.concurrency_limit.labels(name).set(self.limit)
+
+    def try_acquire(self) -> bool:
+        if self._waiters or self.in_flight >= int(self.limit):
+            return False
+        self.in_flight += 1
+        return True
+
+    async def acquire(self) -> None:
+        """Wait for a permit, callers get them in arrival order"""
+        if self.try_acquire():
+            return
+        start = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # handed a permit while being cancelled, pass it on
+                self.in_flight -= 1
+                self._wake()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+        finally:
+            metrics.concurrency_wait_seconds.labels(self.name).observe(
+                time.perf_counter() - start
+            )
+
+    def _wake(self) -> None:
+        """Hand the free permits to the waiters"""
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def release(self, latency: float | None, failed: bool) -> None:
+        """:param: latency: None when the call has not been made"""
+        self.in_flight -= 1
+        if latency is not None:
+            if failed or latency > self.latency_target:
+                self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            metrics.concurrency_limit.labels(self.name).set(self.limit)
+        self._wake()
+
+
+class UpstreamGuard:
+    """Circuit breaker and concurrency limit of one upstream"""
+
+    def __init__(self, upstream: str) -> None:
+        self.upstream = upstream
+        self.breaker = CircuitBreaker(
+            upstream,
+            failure_threshold=config.CIRCUIT_FAILURE_THRESHOLD,
+            reset_timeout=config.CIRCUIT_RESET_SECONDS,
+        )
+        self.limiter = AIMDLimiter(
+            upstream,
+            initial=config.CONCURRENCY_INITIAL_LIMIT,
+            min_limit=1,
+            max_limit=config.HTTP_MAX_CONNECTIONS,
+            latency_target=UPSTREAM_LATENCY_TARGETS[upstream](),
+        )
+
+    def _reject(self):
+        metrics.upstream_rejected.labels(self.upstream, "circuit_open").inc()
+        raise UpstreamUnavailable(f"Circuit of {self.upstream} is open")
+
+    @asynccontextmanager
+    async def __call__(self):
+        """
+        Guard one call of the upstream, it waits while the concurrency
+        limit is reached
+        :raise: UpstreamUnavailable when the circuit is open
+        """
+        # an open circuit fails fast, without queueing for a permit
+        if self.breaker.refuses():
+            self._reject()
+        await self.limiter.acquire()
+        # checked again, the circuit may have opened while waiting
+        if (admission := self.breaker.allow()) is None:
+            self.limiter.release(None, False)
+            self._reject()
+        start = time.perf_counter()
+        try:
+            yield
+        except asyncio.CancelledError:
+            # the outcome is unknown, count it neither way
+            self.breaker.cancel(admission)
+            self.limiter.release(None, False)
+            raise
+        except Exception as e:
+            failed = is_upstream_failure(e)
+            self.breaker.record(failed, admission)
+            self.limiter.release(time.perf_counter() - start, failed)
+            raise
+        self.breaker.record(False, admission)
+        self.limiter.release(time.perf_counter() - start, False)
+
+
+_guards: dict[str, UpstreamGuard] = {}
+
+
+def get_guard(upstream: str) -> UpstreamGuard:
+    if upstream not in _guards:
+        _guards[upstream] = UpstreamGuard(upstream)
+    return _guards[upstream]
+
+
+def guarded(upstream: str):
+    """async with guarded("deepai"): around a call of the upstream"""
+    return get_guard(upstream)()
+
+
+def reset_guards() -> None:
+    _guards.clear()
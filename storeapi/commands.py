@@ -0,0 +1,145 @@
+"""
+Maintenance commands, run them from the project directory e.g.
+python -m storeapi.commands migrate
+python -m storeapi.commands reconcile-likes
+python -m storeapi.commands rebuild-search
+python -m storeapi.commands work-jobs
+"""
+
+import argparse
+import asyncio
+import logging
+
+import sqlalchemy
+from databases import Database
+
+from storeapi.config import config
+from storeapi.database import database, engine, like_table, metadata, post_table
+from storeapi.search import rebuild_search_index
+
+logger = logging.getLogger(__name__)
+
+
+def migrate_schema(bind: sqlalchemy.Engine = engine) -> bool:
+    """
+    metadata.create_all() never alters an existing table,
+    add the new columns and indexes of an existing database here
+    :return: whether like counts need reconcile, i.e. the like_count column
+    has been added or duplicated likes have been removed
+    """
+    inspector = sqlalchemy.inspect(bind)
+    removed = 0
+    added = False
+    if "user_post_unique" not in [i["name"] for i in inspector.get_indexes("likes")]:
+        keep = sqlalchemy.select(sqlalchemy.func.min(like_table.c.id)).group_by(
+            like_table.c.user_id, like_table.c.post_id
+        )
+        with bind.begin() as conn:
+            result = conn.execute(
+                like_table.delete().where(like_table.c.id.not_in(keep))
+            )
+            removed = result.rowcount
+        logger.info(f"Removed {removed} duplicated likes")
+    columns = [c["name"] for c in inspector.get_columns("posts")]
+    if "like_count" not in columns:
+        logger.info("Adding column like_count to posts")
+        added = True
+        with bind.begin() as conn:
+            conn.execute(
+                sqlalchemy.text(
+                    "ALTER TABLE posts ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0"
+                )
+            )
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind, checkfirst=True)
+    return added or removed > 0
+
+
+async def reconcile_like_counts(db: Database) -> int:
+    """
+    Recount likes of every post whose counter has drifted
+    :return: number of posts updated
+    """
+    actual = (
+        sqlalchemy.select(sqlalchemy.func.count(like_table.c.id))
+        .where(like_table.c.post_id == post_table.c.id)
+        .scalar_subquery()
+    )
+    # a single statement, so a like committed meanwhile is never overwritten
+    # by a count read before it
+    query = (
+        post_table.update()
+        .where(post_table.c.like_count != actual)
+        .values(like_count=actual)
+        .returning(post_table.c.id)
+    )
+    logger.debug(query)
+    updated = await db.fetch_all(query)
+    logger.info(f"Reconciled like_count of {len(updated)} posts")
+    return len(updated)
+
+
+async def _migrate():
+    if not migrate_schema():
+        return
+    await database.connect()
+    try:
+        await reconcile_like_counts(database)
+    finally:
+        await database.disconnect()
+
+
+async def _reconcile_likes():
+    migrate_schema()
+    await database.connect()
+    try:
+        await reconcile_like_counts(database)
+    finally:
+        await database.disconnect()
+
+
+async def _rebuild_search():
+    await database.connect()
+    try:
+        await rebuild_search_index(database)
+    finally:
+        await database.disconnect()
+
+
+async def _work_jobs():
+    """Run job workers until interrupted, alongside apps with JOB_WORKERS=0"""
+    from storeapi import tasks  # noqa: F401 registers the job handlers
+    from storeapi.http_clients import close_http_clients
+    from storeapi.jobs import job_queue
+
+    await database.connect()
+    job_queue.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await job_queue.stop(timeout=config.JOB_DRAIN_SECONDS)
+        await close_http_clients()
+        await database.disconnect()
+
+
+COMMANDS = {
+    "migrate": _migrate,
+    "reconcile-likes": _reconcile_likes,
+    "rebuild-search": _rebuild_search,
+    "work-jobs": _work_jobs,
+}
+
+
+def main():
+    from storeapi.logging_conf import configure_logging
+
+    parser = argparse.ArgumentParser(prog="python -m storeapi.commands")
+    parser.add_argument("command", choices=COMMANDS.keys())
+    args = parser.parse_args()
+    configure_logging()
+    asyncio.run(COMMANDS[args.command]())
+
+
+if __name__ == "__main__":
+    main()
@@ -27,7 +27,100 @@ class GlobalConfig(BaseConfig):
     B2_KEY_ID: Optional[str] = None
     B2_APPLICATION_KEY: Optional[str] = None
     B2_BUCKET_NAME: Optional[str] = None
+    # "stream" uploads straight from the request, "tempfile" copies it to
+    # disk first, which is also the fallback when streaming fails
+    B2_UPLOAD_MODE: str = "stream"
+    # threads per upload for the parts of a large file
+    B2_UPLOAD_WORKERS: int = 4
+    # uploads running at once, waiting, and seconds a refused one should wait
+    B2_UPLOAD_CONCURRENCY: int = 4
+    B2_UPLOAD_QUEUE_SIZE: int = 16
+    B2_UPLOAD_RETRY_AFTER: float = 5
+    # skip uploading content already in B2, found by its sha256
+    UPLOAD_DEDUP_ENABLED: bool = True
+    # B2 parts are at least 5 MB, memory per stream is buffers * part size
+    B2_STREAM_PART_SIZE: int = 8 * 1024 * 1024
+    B2_STREAM_BUFFERS: int = 4
+    B2_STREAM_READ_SIZE: int = 1024 * 1024
     DEEPAI_API_KEY: Optional[str] = None
+    RESPONSE_CACHE_MAXSIZE: int = 1024
+    RESPONSE_CACHE_TTL: float = 30
+    LIKE_BUFFER_ENABLED: bool = False
+    LIKE_BUFFER_FLUSH_MS: int = 200
+    LIKE_BUFFER_MAX_ENTRIES: int = 500
+    LEADERBOARD_SIZE: int = 200
+    LEADERBOARD_RECONCILE_SECONDS: float = 60
+    USER_CACHE_MAXSIZE: int = 4096
+    USER_CACHE_TTL: float = 300
+    # "thread" or "process", bcrypt releases the GIL so threads are enough
+    PASSWORD_HASH_EXECUTOR: str = "thread"
+    PASSWORD_HASH_WORKERS: int = 4
+    # hashes waiting for a worker, more are refused with 429
+    PASSWORD_HASH_QUEUE_SIZE: int = 64
+    TOKEN_CACHE_MAXSIZE: int = 8192
+    # access tokens carry user id and confirmed, so no user lookup is needed
+    ACCESS_TOKEN_CLAIMS: bool = False
+    # "kid:secret,kid:secret", the first key signs, the others only verify.
+    # Dropping a key invalidates every token it signed, SECRET_KEY is used
+    # when this is not set.
+    SECRET_KEYS: Optional[str] = None
+    # how soon a token revoked by another process is refused
+    REVOCATION_REFRESH_SECONDS: float = 5
+    # rows revoked this long before the latest one read are read again, so
+    # a revocation committed late or by a process with a skewed clock is seen
+    REVOCATION_REFRESH_OVERLAP: float = 60
+    # token buckets of /login and /register, rates are per minute
+    THROTTLE_ENABLED: bool = True
+    LOGIN_IP_PER_MINUTE: float = 30
+    LOGIN_IP_BURST: int = 10
+    LOGIN_EMAIL_PER_MINUTE: float = 5
+    LOGIN_EMAIL_BURST: int = 5
+    REGISTER_IP_PER_MINUTE: float = 10
+    REGISTER_IP_BURST: int = 5
+    # seconds a caller shed by the full password pool is told to wait
+    PASSWORD_HASH_RETRY_AFTER: float = 1
+    # emails are sent by workers of a bounded queue, registration waits
+    # while the queue is full, and shutdown waits for it to drain
+    EMAIL_WORKERS: int = 4
+    EMAIL_QUEUE_SIZE: int = 256
+    EMAIL_DRAIN_SECONDS: float = 10
+    # one pooled client per upstream, timeouts are in seconds
+    HTTP_MAX_CONNECTIONS: int = 20
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 10
+    HTTP_KEEPALIVE_EXPIRY: float = 30
+    HTTP_CONNECT_TIMEOUT: float = 5
+    HTTP2_ENABLED: bool = False
+    MAILGUN_TIMEOUT: float = 10
+    # send the email jobs in batches, they are retried like other jobs
+    EMAIL_OUTBOX_ENABLED: bool = False
+    EMAIL_OUTBOX_FLUSH_MS: int = 1000
+    # Mailgun accepts at most 1000 recipients per message
+    EMAIL_BATCH_SIZE: int = 1000
+    DEEPAI_TIMEOUT: float = 60
+    # consecutive upstream failures which open its circuit, and seconds
+    # until a probe call is let through
+    CIRCUIT_FAILURE_THRESHOLD: int = 5
+    CIRCUIT_RESET_SECONDS: float = 30
+    # calls in flight per upstream, adapted between 1 and HTTP_MAX_CONNECTIONS,
+    # a call slower than the latency target halves it
+    CONCURRENCY_INITIAL_LIMIT: int = 10
+    MAILGUN_LATENCY_TARGET: float = 2
+    DEEPAI_LATENCY_TARGET: float = 30
+    # seconds a generated image is reused for the same prompt
+    IMAGE_CACHE_TTL: float = 7 * 24 * 3600
+    # point these at storeapi.stub_upstream to run without the real services
+    MAILGUN_API_URL: str = "https://api.mailgun.net/v3"
+    DEEPAI_API_URL: str = "https://api.deepai.org/api"
+    # workers of the job queue started by the app, 0 leaves the jobs to
+    # python -m storeapi.commands work-jobs
+    JOB_WORKERS: int = 2
+    JOB_POLL_SECONDS: float = 1
+    # a running job is claimed again after this, keep it above DEEPAI_TIMEOUT
+    JOB_VISIBILITY_TIMEOUT: float = 120
+    JOB_MAX_ATTEMPTS: int = 5
+    JOB_BACKOFF_SECONDS: float = 2
+    JOB_BACKOFF_MAX_SECONDS: float = 300
+    JOB_DRAIN_SECONDS: float = 10
 
 
 class DevConfig(GlobalConfig):
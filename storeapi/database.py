@@ -1,5 +1,6 @@
 import databases
 import sqlalchemy
+from sqlalchemy.dialects import postgresql, sqlite
 
 from storeapi.config import config
 
@@ -12,6 +13,14 @@ post_table = sqlalchemy.Table(
     sqlalchemy.Column("body", sqlalchemy.String),
     sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False),
     sqlalchemy.Column("image_url", sqlalchemy.String, nullable=True),
+    # denormalized count(likes), maintained by like_post
+    sqlalchemy.Column(
+        "like_count",
+        sqlalchemy.Integer,
+        nullable=False,
+        server_default="0",
+    ),
+    sqlalchemy.Index("ix_posts_like_count_id", "like_count", "id"),
 )
 
 user_table = sqlalchemy.Table(
@@ -30,6 +39,8 @@ comment_table = sqlalchemy.Table(
     sqlalchemy.Column("body", sqlalchemy.String),
     sqlalchemy.Column("post_id", sqlalchemy.ForeignKey("posts.id"), nullable=False),
     sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False),
+    # comments of a post are paginated in id order
+    sqlalchemy.Index("ix_comments_post_id_id", "post_id", "id"),
 )
 
 like_table = sqlalchemy.Table(
@@ -38,6 +49,105 @@ like_table = sqlalchemy.Table(
     sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
     sqlalchemy.Column("post_id", sqlalchemy.ForeignKey("posts.id"), nullable=False),
     sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False),
+    # one like per user per post, a unique index so that migrate can add it
+    sqlalchemy.Index("user_post_unique", "user_id", "post_id", unique=True),
+)
+
+# jti of tokens revoked before they expire, rows are purged after expires_at
+revoked_token_table = sqlalchemy.Table(
+    "revoked_tokens",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("jti", sqlalchemy.String, nullable=False, unique=True),
+    # unix time of the token exp claim
+    sqlalchemy.Column("expires_at", sqlalchemy.Integer, nullable=False, index=True),
+    # unix time of the revocation, read by refresh since ids may be reused
+    # after a purge or committed out of order
+    sqlalchemy.Column("revoked_at", sqlalchemy.Float, nullable=False, index=True),
+)
+
+# durable background jobs, a worker claims a job by setting it running
+# until locked_until, a job whose worker died is claimed again after that
+job_table = sqlalchemy.Table(
+    "jobs",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("kind", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("payload", sqlalchemy.JSON, nullable=False),
+    # pending, running, done or failed
+    sqlalchemy.Column(
+        "status", sqlalchemy.String, nullable=False, server_default="pending"
+    ),
+    sqlalchemy.Column(
+        "attempts", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    # unix times
+    sqlalchemy.Column("run_at", sqlalchemy.Float, nullable=False),
+    sqlalchemy.Column("locked_until", sqlalchemy.Float, nullable=True),
+    sqlalchemy.Column("last_error", sqlalchemy.String, nullable=True),
+    sqlalchemy.Column("post_id", sqlalchemy.Integer, nullable=True, index=True),
+    sqlalchemy.Index("ix_jobs_status_run_at", "status", "run_at"),
+)
+
+# output of image generation by hash of the normalized prompt
+generated_image_table = sqlalchemy.Table(
+    "generated_images",
+    metadata,
+    sqlalchemy.Column("prompt_hash", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("output_url", sqlalchemy.String, nullable=False),
+    # unix time, the entry expires after IMAGE_CACHE_TTL
+    sqlalchemy.Column("created_at", sqlalchemy.Float, nullable=False),
+)
+
+# files uploaded to B2 by sha256 of their content, an upload of the same
+# content only adds a reference, a file without references can be deleted
+uploaded_file_table = sqlalchemy.Table(
+    "uploaded_files",
+    metadata,
+    sqlalchemy.Column("digest", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("file_id", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("file_url", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("size", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column(
+        "ref_count", sqlalchemy.Integer, nullable=False, server_default="1"
+    ),
+)
+
+# full-text index of post and comment bodies, ref_id is the id of the
+# post or comment. It is created by DDL since SQLite needs a FTS5 virtual
+# table and PostgreSQL a generated tsvector column with a GIN index.
+search_table = sqlalchemy.Table(
+    "post_search",
+    sqlalchemy.MetaData(),
+    sqlalchemy.Column("post_id", sqlalchemy.Integer),
+    sqlalchemy.Column("kind", sqlalchemy.String),
+    sqlalchemy.Column("ref_id", sqlalchemy.Integer),
+    sqlalchemy.Column("body", sqlalchemy.String),
+)
+sqlalchemy.event.listen(
+    metadata,
+    "after_create",
+    sqlalchemy.DDL(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING fts5("
+        "body, post_id UNINDEXED, kind UNINDEXED, ref_id UNINDEXED)"
+    ).execute_if(dialect="sqlite"),
+)
+sqlalchemy.event.listen(
+    metadata,
+    "after_create",
+    sqlalchemy.DDL(
+        "CREATE TABLE IF NOT EXISTS post_search ("
+        "post_id INTEGER NOT NULL, kind VARCHAR NOT NULL, ref_id INTEGER NOT NULL,"
+        " body VARCHAR, tsv TSVECTOR GENERATED ALWAYS AS"
+        " (to_tsvector('english', coalesce(body, ''))) STORED)"
+    ).execute_if(dialect="postgresql"),
+)
+sqlalchemy.event.listen(
+    metadata,
+    "after_create",
+    sqlalchemy.DDL(
+        "CREATE INDEX IF NOT EXISTS ix_post_search_tsv ON post_search USING GIN (tsv)"
+    ).execute_if(dialect="postgresql"),
 )
 
 connect_args = {"check_same_thread": False} if "sqlite" in config.DATABASE_URL else {}
@@ -45,6 +155,27 @@ engine = sqlalchemy.create_engine(
     config.DATABASE_URL, connect_args=connect_args, echo=True
 )
 
+
+def dialect_insert(table: sqlalchemy.Table):
+    """INSERT supporting ON CONFLICT of the configured database"""
+    dialect = postgresql if "postgre" in config.DATABASE_URL else sqlite
+    return dialect.insert(table)
+
+
+def insert_or_ignore(table: sqlalchemy.Table, *index_elements: str):
+    """INSERT which skips rows conflicting on the unique index_elements"""
+    return dialect_insert(table).on_conflict_do_nothing(index_elements=index_elements)
+
+
+def upsert(table: sqlalchemy.Table, values: dict, *index_elements: str):
+    """INSERT which updates the row conflicting on the unique index_elements"""
+    query = dialect_insert(table).values(values)
+    return query.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={k: query.excluded[k] for k in values if k not in index_elements},
+    )
+
+
 db_args = {"min_size": 1, "max_size": 3} if "postgre" in config.DATABASE_URL else {}
 metadata.create_all(engine)
 database = databases.Database(
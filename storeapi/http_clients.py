@@ -0,0 +1,91 @@
+import importlib.util
+import logging
+
+import httpx
+
+from storeapi import metrics
+from storeapi.config import config
+
+logger = logging.getLogger(__name__)
+
+# read timeout of every upstream, DeepAI takes long to generate an image
+UPSTREAM_TIMEOUTS = {
+    "mailgun": lambda: config.MAILGUN_TIMEOUT,
+    "deepai": lambda: config.DEEPAI_TIMEOUT,
+}
+
+_clients: dict[str, httpx.AsyncClient] = {}
+
+
+class InstrumentedTransport(httpx.AsyncHTTPTransport):
+    """Export requests in flight and connections of the pool of an upstream"""
+
+    def __init__(self, upstream: str, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.upstream = upstream
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        # sampled around each request, a body is read after this returns
+        self._record_connections()
+        in_flight = metrics.http_requests_in_flight.labels(self.upstream)
+        in_flight.inc()
+        try:
+            return await super().handle_async_request(request)
+        finally:
+            in_flight.dec()
+            self._record_connections()
+
+    def _record_connections(self) -> None:
+        connections = self._pool.connections
+        idle = sum(1 for c in connections if c.is_idle())
+        metrics.http_pool_connections.labels(self.upstream, "idle").set(idle)
+        metrics.http_pool_connections.labels(self.upstream, "active").set(
+            len(connections) - idle
+        )
+
+
+def http2_available() -> bool:
+    """HTTP/2 needs the optional h2 package, i.e. pip install httpx[http2]"""
+    if not config.HTTP2_ENABLED:
+        return False
+    if importlib.util.find_spec("h2") is None:
+        logger.warning("HTTP2_ENABLED is set but h2 is not installed, using HTTP/1.1")
+        return False
+    return True
+
+
+def create_http_client(upstream: str) -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=config.HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+    )
+    metrics.http_pool_max_connections.labels(upstream).set(limits.max_connections)
+    http2 = http2_available()
+    return httpx.AsyncClient(
+        transport=InstrumentedTransport(upstream, limits=limits, http2=http2),
+        timeout=httpx.Timeout(
+            UPSTREAM_TIMEOUTS[upstream](), connect=config.HTTP_CONNECT_TIMEOUT
+        ),
+    )
+
+
+def get_http_client(upstream: str) -> httpx.AsyncClient:
+    """
+    The shared client of an upstream, created on first use
+    so that code running outside of the app works too
+    """
+    if upstream not in _clients:
+        logger.debug(f"Creating HTTP client for {upstream}")
+        _clients[upstream] = create_http_client(upstream)
+    return _clients[upstream]
+
+
+def open_http_clients() -> None:
+    for upstream in UPSTREAM_TIMEOUTS:
+        get_http_client(upstream)
+
+
+async def close_http_clients() -> None:
+    for upstream in list(_clients):
+        await _clients.pop(upstream).aclose()
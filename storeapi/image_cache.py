@@ -0,0 +1,89 @@
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Awaitable, Callable
+
+import sqlalchemy
+from databases import Database
+
+from storeapi import metrics
+from storeapi.config import config
+from storeapi.database import database, generated_image_table, upsert
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.lower().split())
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(normalize_prompt(prompt).encode()).hexdigest()
+
+
+class ImageCache:
+    """
+    output_url of generated images by prompt, persisted so every process
+    reuses it until ttl. Concurrent requests of a prompt being generated
+    wait for that generation instead of calling the upstream again.
+    """
+
+    def __init__(self, db: Database, ttl: float) -> None:
+        self.db = db
+        self.ttl = ttl
+        self._in_flight: dict[str, asyncio.Task] = {}
+
+    async def get(self, key: str) -> str | None:
+        query = sqlalchemy.select(generated_image_table.c.output_url).where(
+            generated_image_table.c.prompt_hash == key,
+            generated_image_table.c.created_at > time.time() - self.ttl,
+        )
+        logger.debug(query)
+        return await self.db.fetch_val(query)
+
+    async def set(self, key: str, output_url: str) -> None:
+        query = upsert(
+            generated_image_table,
+            {"prompt_hash": key, "output_url": output_url, "created_at": time.time()},
+            "prompt_hash",
+        )
+        logger.debug(query)
+        await self.db.execute(query)
+
+    async def get_or_generate(
+        self, prompt: str, generate: Callable[[str], Awaitable[str]]
+    ) -> str:
+        """
+        :param: generate: coroutine function returning output_url of a prompt
+        :return: output_url, errors of generate are raised to every waiter
+        """
+        key = prompt_hash(prompt)
+        if (task := self._in_flight.get(key)) is not None:
+            metrics.image_generations_joined.inc()
+            return await asyncio.shield(task)
+        if (output_url := await self.get(key)) is not None:
+            metrics.cache_hits.labels("image").inc()
+            return output_url
+        # checked again, another request may have started while reading
+        if (task := self._in_flight.get(key)) is None:
+            metrics.cache_misses.labels("image").inc()
+            task = asyncio.create_task(self._generate(key, prompt, generate))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            metrics.image_generations_joined.inc()
+        # a cancelled waiter leaves the generation running for the others
+        return await asyncio.shield(task)
+
+    async def _generate(self, key: str, prompt: str, generate) -> str:
+        output_url = await generate(prompt)
+        try:
+            await self.set(key, output_url)
+        except Exception:
+            # the image is still good for the posts waiting for it
+            logger.exception(f"Caching image of prompt {key[:12]} failed")
+        return output_url
+
+
+image_cache = ImageCache(database, ttl=config.IMAGE_CACHE_TTL)
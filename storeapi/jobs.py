@@ -0,0 +1,288 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Iterable
+
+import sqlalchemy
+from databases import Database
+
+from storeapi import metrics
+from storeapi.config import config
+from storeapi.database import database, job_table
+
+logger = logging.getLogger(__name__)
+
+JobHandler = Callable[[dict], Awaitable[Any]]
+GiveUpHandler = Callable[[dict, str], Awaitable[Any]]
+
+_handlers: dict[str, JobHandler] = {}
+_give_up_handlers: dict[str, GiveUpHandler] = {}
+
+
+def job_handler(kind: str, on_give_up: GiveUpHandler | None = None):
+    """
+    Register the coroutine running jobs of a kind, it is retried when it raises.
+    on_give_up(payload, error) is awaited once the last attempt has failed.
+    """
+
+    def register(func: JobHandler) -> JobHandler:
+        _handlers[kind] = func
+        if on_give_up is not None:
+            _give_up_handlers[kind] = on_give_up
+        return func
+
+    return register
+
+
+def backoff_seconds(attempts: int) -> float:
+    """Delay before the next attempt, doubled after every failed attempt"""
+    return min(
+        config.JOB_BACKOFF_MAX_SECONDS,
+        config.JOB_BACKOFF_SECONDS * 2 ** max(0, attempts - 1),
+    )
+
+
+def claimable(now: float, kind: str | None = None, exclude: Iterable[str] = ()):
+    """
+    :param: kind: only jobs of this kind
+    :param: exclude: kinds claimed by someone else, e.g. in batches
+    """
+    condition = sqlalchemy.or_(
+        sqlalchemy.and_(job_table.c.status == "pending", job_table.c.run_at <= now),
+        # the worker died or hang, its visibility timeout has passed
+        sqlalchemy.and_(
+            job_table.c.status == "running", job_table.c.locked_until <= now
+        ),
+    )
+    if kind is not None:
+        condition = sqlalchemy.and_(job_table.c.kind == kind, condition)
+    if exclude:
+        condition = sqlalchemy.and_(job_table.c.kind.not_in(list(exclude)), condition)
+    return condition
+
+
+class JobQueue:
+    """
+    Jobs persisted in the jobs table and run by asyncio workers, so they
+    survive restarts and web workers only insert them. Every process may
+    run workers, a job is claimed by a single UPDATE and is only finished
+    by the worker holding the latest attempt.
+    """
+
+    def __init__(self, db: Database, workers: int, poll_interval: float) -> None:
+        self.db = db
+        self.workers = workers
+        self.poll_interval = poll_interval
+        # created by start() in the loop of the workers
+        self._wakeup: asyncio.Event | None = None
+        self._stopping: asyncio.Event | None = None
+        self._tasks: list[asyncio.Task] = []
+        # kinds the workers leave to claim_batch() callers of this process
+        self.batched_kinds: set[str] = set()
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    async def enqueue(
+        self,
+        kind: str,
+        payload: dict,
+        post_id: int | None = None,
+        delay: float = 0,
+        notify: bool = True,
+    ) -> int:
+        """
+        Insert a job, inside the transaction of the caller if any
+        :param: notify: wake the workers up now, a caller inside a transaction
+        passes False and calls notify() once committed, or the workers would
+        not see the job yet and wait a full poll interval
+        """
+        query = job_table.insert().values(
+            kind=kind, payload=payload, post_id=post_id, run_at=time.time() + delay
+        )
+        logger.debug(query)
+        job_id = await self.db.execute(query)
+        metrics.jobs_enqueued.labels(kind).inc()
+        if notify:
+            self.notify()
+        return job_id
+
+    def notify(self) -> None:
+        """Wake the workers up to claim jobs just committed"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _claim_query(self, limit: int, kind: str | None, exclude: Iterable[str]):
+        now = time.time()
+        next_ids = (
+            sqlalchemy.select(job_table.c.id)
+            .where(claimable(now, kind, exclude))
+            .order_by(job_table.c.run_at, job_table.c.id)
+            .limit(limit)
+        )
+        # claimable() again, so a job taken meanwhile by another worker is skipped
+        return (
+            job_table.update()
+            .where(job_table.c.id.in_(next_ids), claimable(now, kind, exclude))
+            .values(
+                status="running",
+                attempts=job_table.c.attempts + 1,
+                locked_until=now + config.JOB_VISIBILITY_TIMEOUT,
+            )
+            .returning(*job_table.c)
+        )
+
+    async def claim(self):
+        """Take the next due job, None when there is none"""
+        query = self._claim_query(1, None, self.batched_kinds)
+        logger.debug(query)
+        return await self.db.fetch_one(query)
+
+    async def claim_batch(self, kind: str, limit: int) -> list:
+        """Take at most limit due jobs of a kind, to be finished by complete()"""
+        query = self._claim_query(limit, kind, ())
+        logger.debug(query)
+        jobs = await self.db.fetch_all(query)
+        return sorted(jobs, key=lambda job: (job.run_at, job.id))
+
+    async def _finish(self, job, **values) -> bool:
+        """Update the job unless another worker has claimed it since"""
+        query = (
+            job_table.update()
+            .where(
+                job_table.c.id == job.id,
+                job_table.c.attempts == job.attempts,
+                job_table.c.status == "running",
+            )
+            .values(locked_until=None, **values)
+            .returning(job_table.c.id)
+        )
+        logger.debug(query)
+        return await self.db.fetch_one(query) is not None
+
+    async def run_job(self, job) -> str:
+        """:return: outcome of the attempt, done, retry or failed"""
+        handler = _handlers.get(job.kind)
+        start = time.perf_counter()
+        error = None
+        if handler is None:
+            error = f"No handler for job kind {job.kind}"
+        elif job.attempts > config.JOB_MAX_ATTEMPTS:
+            error = job.last_error or "Visibility timeout expired too many times"
+        else:
+            try:
+                await handler(job.payload)
+            except Exception as e:
+                logger.exception(f"Job {job.id} {job.kind} failed")
+                error = repr(e)
+        metrics.job_seconds.labels(job.kind).observe(time.perf_counter() - start)
+        return await self.complete(job, error, retry=handler is not None)
+
+    async def complete(self, job, error: str | None, retry: bool = True) -> str:
+        """
+        Finish an attempt of a claimed job, a failed one is retried
+        with backoff until JOB_MAX_ATTEMPTS
+        :return: outcome of the attempt, done, retry or failed
+        """
+        if error is None:
+            outcome = "done"
+            await self._finish(job, status="done", last_error=None)
+        elif retry and job.attempts < config.JOB_MAX_ATTEMPTS:
+            outcome = "retry"
+            await self._finish(
+                job,
+                status="pending",
+                last_error=error,
+                run_at=time.time() + backoff_seconds(job.attempts),
+            )
+        else:
+            outcome = "failed"
+            if await self._finish(job, status="failed", last_error=error):
+                if (on_give_up := _give_up_handlers.get(job.kind)) is not None:
+                    await on_give_up(job.payload, error)
+        metrics.jobs_finished.labels(job.kind, outcome).inc()
+        logger.info(f"Job {job.id} {job.kind} attempt {job.attempts}: {outcome}")
+        return outcome
+
+    async def complete_many(self, jobs: list) -> None:
+        """Mark claimed jobs done by one UPDATE, fenced like _finish()"""
+        if not jobs:
+            return
+        query = (
+            job_table.update()
+            .where(
+                sqlalchemy.tuple_(job_table.c.id, job_table.c.attempts).in_(
+                    [(job.id, job.attempts) for job in jobs]
+                ),
+                job_table.c.status == "running",
+            )
+            .values(status="done", last_error=None, locked_until=None)
+        )
+        logger.debug(query)
+        await self.db.execute(query)
+        for job in jobs:
+            metrics.jobs_finished.labels(job.kind, "done").inc()
+
+    async def run_pending(self) -> int:
+        """Run due jobs until there is none left, :return: number of attempts"""
+        count = 0
+        while (job := await self.claim()) is not None:
+            await self.run_job(job)
+            count += 1
+        return count
+
+    def start(self) -> None:
+        logger.info(f"Starting {self.workers} job workers")
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float | None = None) -> None:
+        """
+        Let the workers finish their current job for at most timeout seconds,
+        a job cut off stays running and is claimed again after its timeout
+        """
+        if not self._tasks:
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        _, pending = await asyncio.wait(self._tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info("Job workers stopped")
+
+    async def _work(self) -> None:
+        while not self._stopping.is_set():
+            # cleared before claiming, so a job enqueued meanwhile is not missed
+            self._wakeup.clear()
+            try:
+                job = await self.claim()
+                if job is not None:
+                    await self.run_job(job)
+                    continue
+            except Exception:
+                logger.exception("Job worker failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def get_post_image_job(db: Database, post_id: int):
+    """The latest image generation job of the post, None when there is none"""
+    query = (
+        job_table.select()
+        .where(job_table.c.kind == "generate_image", job_table.c.post_id == post_id)
+        .order_by(job_table.c.id.desc())
+        .limit(1)
+    )
+    logger.debug(query)
+    return await db.fetch_one(query)
+
+
+job_queue = JobQueue(
+    database, workers=config.JOB_WORKERS, poll_interval=config.JOB_POLL_SECONDS
+)
@@ -0,0 +1,84 @@
+import asyncio
+import bisect
+import logging
+
+import sqlalchemy
+from databases import Database
+
+from storeapi.config import config
+from storeapi.database import post_table
+
+logger = logging.getLogger(__name__)
+
+
+class Leaderboard:
+    """
+    Most liked posts kept in memory, sorted like PostSorting.most_likes
+    i.e. by likes and then by newest post. Only the top capacity posts
+    are kept, and top() is served from the upper half so that posts
+    which drop out of sight between reconciliations do not show up.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.loaded = False
+        self._likes: dict[int, int] = {}
+        # ascending keys (-likes, -post_id) i.e. the most liked first
+        self._keys: list[tuple[int, int]] = []
+
+    @property
+    def max_k(self) -> int:
+        return max(1, self.capacity // 2)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    async def load(self, db: Database) -> None:
+        """Seed or reconcile the board from the like_count index"""
+        query = (
+            sqlalchemy.select(post_table.c.id, post_table.c.like_count)
+            .order_by(post_table.c.like_count.desc(), post_table.c.id.desc())
+            .limit(self.capacity)
+        )
+        logger.debug(query)
+        rows = await db.fetch_all(query)
+        self._likes = {row.id: row.like_count for row in rows}
+        self._keys = sorted((-likes, -id) for id, likes in self._likes.items())
+        self.loaded = True
+        logger.debug(f"Loaded {len(rows)} posts into leaderboard")
+
+    def clear(self) -> None:
+        self._likes.clear()
+        self._keys.clear()
+        self.loaded = False
+
+    def update(self, post_id: int, likes: int) -> None:
+        """Record the current like count of a post"""
+        if not self.loaded:
+            return
+        if post_id in self._likes:
+            self._keys.remove((-self._likes.pop(post_id), -post_id))
+        key = (-likes, -post_id)
+        if len(self._keys) >= self.capacity and key > self._keys[-1]:
+            return
+        bisect.insort(self._keys, key)
+        self._likes[post_id] = likes
+        if len(self._keys) > self.capacity:
+            _, last_id = self._keys.pop()
+            del self._likes[-last_id]
+
+    def top(self, k: int) -> list[tuple[int, int]]:
+        """:return: [(post_id, likes)] of the k most liked posts"""
+        return [(-post_id, -likes) for likes, post_id in self._keys[:k]]
+
+
+async def reconcile_periodically(board: Leaderboard, db: Database, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await board.load(db)
+        except Exception:
+            logger.exception("Reconciling leaderboard failed")
+
+
+leaderboard = Leaderboard(capacity=config.LEADERBOARD_SIZE)
@@ -1,17 +1,30 @@
+import asyncio
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
+from typing import Awaitable, Callable, NamedTuple
 
 import b2sdk.v2 as b2
+from storeapi import metrics
 from storeapi.config import config
+from storeapi.throttle import too_many_requests_exception
 
 logger = logging.getLogger(__name__)
 
 
+class B2File(NamedTuple):
+    file_id: str
+    url: str
+
+
 @lru_cache()
 def b2_api() -> b2.B2Api:
     logger.debug("Creating and authorizing B2 API")
     info = b2.InMemoryAccountInfo()
-    api = b2.B2Api(info)
+    # parts of a large file are uploaded by max_upload_workers threads
+    api = b2.B2Api(info, max_upload_workers=config.B2_UPLOAD_WORKERS)
 
     api.authorize_account("production", config.B2_KEY_ID, config.B2_APPLICATION_KEY)
     return api
@@ -22,7 +35,7 @@ def b2_get_bucket(api: b2.B2Api) -> b2.Bucket:
     return api.get_bucket_by_name(config.B2_BUCKET_NAME)
 
 
-def b2_upload_file(local_file: str, file_name: str) -> str:
+def b2_upload_file(local_file: str, file_name: str) -> B2File:
     api = b2_api()
     logger.debug(f"Uploading {local_file} to B2 as {file_name}")
     uploaded_file = b2_get_bucket(api).upload_local_file(
@@ -32,4 +45,119 @@ def b2_upload_file(local_file: str, file_name: str) -> str:
     logger.debug(
         f"Uploaded {local_file} to B2 successfully and got download URL {download_url}"
     )
-    return download_url
+    return B2File(uploaded_file.id_, download_url)
+
+
+class AsyncStreamReader:
+    """
+    Blocking file-like view of an async read(), to be read from a worker
+    thread while the event loop serves the reads. Nothing is buffered here,
+    a chunk is only read when the uploader asks for it.
+    """
+
+    def __init__(
+        self, read: Callable[[int], Awaitable[bytes]], loop: asyncio.AbstractEventLoop
+    ) -> None:
+        self._read = read
+        self._loop = loop
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = asyncio.run_coroutine_threadsafe(self._read(size), self._loop).result()
+        self.bytes_read += len(chunk)
+        return chunk
+
+
+def b2_upload_stream(stream, file_name: str) -> B2File:
+    """
+    Upload a stream of unknown length without a local copy. Parts are uploaded
+    in parallel, at most B2_STREAM_BUFFERS parts are held in memory.
+    Blocking, run it in a thread.
+    """
+    api = b2_api()
+    logger.debug(f"Streaming {file_name} to B2")
+    uploaded_file = b2_get_bucket(api).upload_unbound_stream(
+        stream,
+        file_name=file_name,
+        buffers_count=config.B2_STREAM_BUFFERS,
+        buffer_size=config.B2_STREAM_PART_SIZE,
+        recommended_upload_part_size=config.B2_STREAM_PART_SIZE,
+        read_size=config.B2_STREAM_READ_SIZE,
+    )
+    download_url = api.get_download_url_for_fileid(uploaded_file.id_)
+    logger.debug(f"Streamed {file_name} to B2 and got download URL {download_url}")
+    return B2File(uploaded_file.id_, download_url)
+
+
+def b2_warm_up() -> None:
+    """Authorize and find the bucket, so the first upload does not pay for it"""
+    b2_get_bucket(b2_api())
+    logger.info("B2 API authorized")
+
+
+class UploadPool:
+    """
+    Run blocking b2sdk calls on dedicated threads, so an upload never
+    freezes the event loop. At most workers uploads run at once and
+    queue_size wait, later uploads are refused with 429.
+    """
+
+    def __init__(self, workers: int, queue_size: int) -> None:
+        self.workers = workers
+        self.slots = asyncio.Semaphore(workers + queue_size)
+        # uploads submitted to the executor and not started yet
+        self.waiting = 0
+        self._lock = threading.Lock()
+        self._executor: ThreadPoolExecutor | None = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="b2-upload"
+            )
+        return self._executor
+
+    def _queued(self, delta: int) -> None:
+        with self._lock:
+            self.waiting += delta
+            metrics.upload_queue_depth.set(self.waiting)
+
+    def _started(self, queued_at: float) -> None:
+        self._queued(-1)
+        metrics.upload_queue_wait_seconds.observe(time.perf_counter() - queued_at)
+        metrics.uploads_in_flight.inc()
+
+    async def run(self, func, *args):
+        if self.slots.locked():
+            metrics.throttle_decisions.labels("b2_upload", "throttled").inc()
+            logger.warning("Upload pool is full, refusing upload")
+            raise too_many_requests_exception(config.B2_UPLOAD_RETRY_AFTER)
+        metrics.throttle_decisions.labels("b2_upload", "allowed").inc()
+        queued_at = time.perf_counter()
+
+        def call():
+            self._started(queued_at)
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                metrics.uploads_in_flight.dec()
+                metrics.upload_seconds.observe(time.perf_counter() - start)
+
+        async with self.slots:
+            self._queued(1)
+            future = self.executor.submit(call)
+            # a job cancelled before a thread took it never runs call()
+            future.add_done_callback(lambda f: f.cancelled() and self._queued(-1))
+            return await asyncio.wrap_future(future)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+upload_pool = UploadPool(
+    workers=config.B2_UPLOAD_CONCURRENCY, queue_size=config.B2_UPLOAD_QUEUE_SIZE
+)
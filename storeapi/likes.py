@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+
+import sqlalchemy
+
+from storeapi import metrics
+from storeapi.cache import feed_tag, get_response_cache, post_tag
+from storeapi.config import config
+from storeapi.database import database, insert_or_ignore, like_table, post_table
+from storeapi.leaderboard import leaderboard
+
+logger = logging.getLogger(__name__)
+
+
+async def find_existing_post_ids(post_ids) -> set[int]:
+    """Check existence of many posts by a single query"""
+    query = sqlalchemy.select(post_table.c.id).where(post_table.c.id.in_(set(post_ids)))
+    logger.debug(query)
+    return {row.id for row in await database.fetch_all(query)}
+
+
+async def invalidate_likes(*post_ids: int):
+    # likes of the posts changed, and so may the order of most_likes pages
+    await get_response_cache().invalidate(
+        *map(post_tag, post_ids), feed_tag("most_likes")
+    )
+
+
+async def save_likes(rows: list[dict]) -> dict[tuple[int, int], int]:
+    """
+    Insert likes by one statement, likes already given are skipped,
+    then add the new likes to like_count of their posts by one UPDATE
+    :param: rows: [{"user_id": int, "post_id": int}]
+    :return: {(user_id, post_id): like id} of the inserted likes
+    """
+    query = (
+        insert_or_ignore(like_table, "user_id", "post_id")
+        .values(rows)
+        .returning(like_table.c.id, like_table.c.user_id, like_table.c.post_id)
+    )
+    logger.debug(query)
+    async with database.transaction():
+        records = await database.fetch_all(query)
+        inserted = {(r.user_id, r.post_id): r.id for r in records}
+        amounts = Counter(post_id for _, post_id in inserted)
+        if amounts:
+            query = (
+                post_table.update()
+                .where(post_table.c.id.in_(amounts))
+                .values(
+                    like_count=post_table.c.like_count
+                    + sqlalchemy.case(amounts, value=post_table.c.id, else_=0)
+                )
+                .returning(post_table.c.id, post_table.c.like_count)
+            )
+            logger.debug(query)
+            counts = await database.fetch_all(query)
+    if amounts:
+        for post in counts:
+            leaderboard.update(post.id, post.like_count)
+        await invalidate_likes(*amounts)
+    return inserted
+
+
+class LikeBuffer:
+    """
+    Coalesce likes in memory and write them by one bulk insert
+    every flush_interval seconds or once max_entries are pending.
+    A like is acknowledged before it is written, so likes pending
+    when the process dies are lost.
+    """
+
+    def __init__(self, flush_interval: float, max_entries: int) -> None:
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        # dict keeps the arrival order and drops repeated likes in a window
+        self._pending: dict[tuple[int, int], None] = {}
+        self._full = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, user_id: int, post_id: int) -> None:
+        self._pending[(user_id, post_id)] = None
+        metrics.like_buffer_depth.set(len(self._pending))
+        if len(self._pending) >= self.max_entries:
+            self._full.set()
+
+    def start(self) -> None:
+        logger.info("Starting like buffer")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop flushing periodically and write what is left"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+        logger.info("Like buffer stopped")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Flushing like buffer failed")
+
+    async def flush(self) -> int:
+        """
+        Write the pending likes, likes on missing posts are dropped.
+        They are pending again when writing fails.
+        :return: number of likes inserted
+        """
+        if not self._pending:
+            return 0
+        batch, self._pending = list(self._pending), {}
+        metrics.like_buffer_depth.set(0)
+        start = time.perf_counter()
+        try:
+            existing = await find_existing_post_ids(p for _, p in batch)
+            rows = [
+                {"user_id": user_id, "post_id": post_id}
+                for user_id, post_id in batch
+                if post_id in existing
+            ]
+            inserted = await save_likes(rows) if rows else {}
+        except Exception:
+            for key in batch:
+                self._pending.setdefault(key, None)
+            metrics.like_buffer_depth.set(len(self._pending))
+            raise
+        metrics.like_buffer_flush_seconds.observe(time.perf_counter() - start)
+        metrics.like_buffer_flushed.inc(len(inserted))
+        logger.debug(f"Flushed {len(batch)} likes, {len(inserted)} inserted")
+        return len(inserted)
+
+
+like_buffer = LikeBuffer(
+    flush_interval=config.LIKE_BUFFER_FLUSH_MS / 1000,
+    max_entries=config.LIKE_BUFFER_MAX_ENTRIES,
+)
@@ -1,12 +1,22 @@
-import logging
+import logging, asyncio
 from asgi_correlation_id import CorrelationIdMiddleware
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from fastapi.exception_handlers import http_exception_handler
+from storeapi.config import config
 from storeapi.database import database
+from storeapi.leaderboard import leaderboard, reconcile_periodically
+from storeapi.http_clients import close_http_clients, open_http_clients
+from storeapi.jobs import job_queue
+from storeapi.libs.b2 import b2_warm_up, upload_pool
+from storeapi.likes import like_buffer
+from storeapi.revocation import refresh_periodically, revocation_list
+from storeapi.security import password_pool
+from storeapi.worker_pool import email_pool
 from storeapi.routers.posts import router as posts_router
 from storeapi.routers.users import router as users_router
 from storeapi.routers.upload import router as upload_router
+from storeapi import tasks  # registers the job handlers
 
 from storeapi.logging_conf import configure_logging
 from storeapi.jaeger import jaeger_exporter, tracer
@@ -23,8 +33,44 @@ logger = logging.getLogger(__name__)
 async def lifespan(app: FastAPI):
     configure_logging()
     await database.connect()
+    open_http_clients()
+    email_pool.start()
+    if config.EMAIL_OUTBOX_ENABLED:
+        tasks.email_outbox.start()
+    if config.JOB_WORKERS:
+        job_queue.start()
+    if config.LIKE_BUFFER_ENABLED:
+        like_buffer.start()
+    await leaderboard.load(database)
+    reconcile = asyncio.create_task(
+        reconcile_periodically(
+            leaderboard, database, config.LEADERBOARD_RECONCILE_SECONDS
+        )
+    )
+    await revocation_list.refresh(database)
+    if config.B2_KEY_ID:
+        try:
+            await asyncio.to_thread(b2_warm_up)
+        except Exception:
+            logger.exception("Authorizing B2 failed, retried on first upload")
+    revocation_refresh = asyncio.create_task(
+        refresh_periodically(
+            revocation_list, database, config.REVOCATION_REFRESH_SECONDS
+        )
+    )
     yield
+    reconcile.cancel()
+    revocation_refresh.cancel()
+    # flush buffered likes while database is still connected
+    await like_buffer.stop()
+    await email_pool.stop(timeout=config.EMAIL_DRAIN_SECONDS)
+    await job_queue.stop(timeout=config.JOB_DRAIN_SECONDS)
+    # send the email jobs which are due once more
+    await tasks.email_outbox.stop()
+    await close_http_clients()
     await database.disconnect()
+    password_pool.shutdown()
+    upload_pool.shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
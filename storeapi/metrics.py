@@ -0,0 +1,126 @@
+"""
+Application metrics, they are registered in the default prometheus
+registry so they are exported on /metrics with the endpoint metrics
+"""
+
+from prometheus_client import Counter, Gauge, Histogram
+
+cache_hits = Counter("storeapi_cache_hits_total", "Cache hits", ["cache"])
+cache_misses = Counter("storeapi_cache_misses_total", "Cache misses", ["cache"])
+cache_evictions = Counter(
+    "storeapi_cache_evictions_total",
+    "Entries dropped from cache before being read again",
+    ["cache", "reason"],
+)
+cache_hit_ratio = Gauge(
+    "storeapi_cache_hit_ratio", "Hits over lookups since start", ["cache"]
+)
+cache_size = Gauge("storeapi_cache_size", "Number of entries in cache", ["cache"])
+
+like_buffer_depth = Gauge("storeapi_like_buffer_depth", "Likes waiting to be written")
+like_buffer_flush_seconds = Histogram(
+    "storeapi_like_buffer_flush_seconds", "Time spent writing buffered likes"
+)
+like_buffer_flushed = Counter(
+    "storeapi_like_buffer_flushed_total", "Buffered likes written to database"
+)
+
+throttle_decisions = Counter(
+    "storeapi_throttle_decisions_total",
+    "Requests allowed or refused by a throttle",
+    ["limiter", "decision"],
+)
+
+worker_queue_depth = Gauge(
+    "storeapi_worker_queue_depth", "Jobs waiting for a worker", ["pool"]
+)
+worker_queue_wait_seconds = Histogram(
+    "storeapi_worker_queue_wait_seconds",
+    "Time a job waited in queue before a worker took it",
+    ["pool"],
+)
+worker_task_seconds = Histogram(
+    "storeapi_worker_task_seconds", "Time a worker spent on a job", ["pool", "outcome"]
+)
+
+http_requests_in_flight = Gauge(
+    "storeapi_http_requests_in_flight", "Outbound requests in flight", ["upstream"]
+)
+http_pool_connections = Gauge(
+    "storeapi_http_pool_connections",
+    "Connections in the pool of an upstream client",
+    ["upstream", "state"],
+)
+http_pool_max_connections = Gauge(
+    "storeapi_http_pool_max_connections",
+    "Connection limit of the pool of an upstream client",
+    ["upstream"],
+)
+
+jobs_enqueued = Counter("storeapi_jobs_enqueued_total", "Jobs queued", ["kind"])
+jobs_finished = Counter(
+    "storeapi_jobs_finished_total",
+    "Job attempts by outcome, done, retry or failed",
+    ["kind", "outcome"],
+)
+job_seconds = Histogram("storeapi_job_seconds", "Time spent on a job attempt", ["kind"])
+
+email_batches = Counter(
+    "storeapi_email_batches_total", "Batches of emails sent or failed", ["outcome"]
+)
+email_batch_size = Histogram(
+    "storeapi_email_batch_size",
+    "Recipients per batch sent",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+email_batch_seconds = Histogram(
+    "storeapi_email_batch_seconds", "Time spent sending a batch of emails"
+)
+
+image_generations_joined = Counter(
+    "storeapi_image_generations_joined_total",
+    "Image requests served by a generation already in flight for the same prompt",
+)
+
+circuit_state = Gauge(
+    "storeapi_circuit_state",
+    "Circuit of an upstream, 0 closed, 1 half open, 2 open",
+    ["upstream"],
+)
+circuit_transitions = Counter(
+    "storeapi_circuit_transitions_total",
+    "Circuit state changes by the state entered",
+    ["upstream", "state"],
+)
+concurrency_limit = Gauge(
+    "storeapi_upstream_concurrency_limit",
+    "Adaptive limit of calls in flight to an upstream",
+    ["upstream"],
+)
+concurrency_wait_seconds = Histogram(
+    "storeapi_upstream_concurrency_wait_seconds",
+    "Time a call waited for the concurrency limit of an upstream",
+    ["upstream"],
+)
+upstream_rejected = Counter(
+    "storeapi_upstream_rejected_total",
+    "Calls failed fast without reaching the upstream",
+    ["upstream", "reason"],
+)
+
+upload_queue_depth = Gauge(
+    "storeapi_upload_queue_depth", "Uploads waiting for an upload thread"
+)
+upload_queue_wait_seconds = Histogram(
+    "storeapi_upload_queue_wait_seconds", "Time an upload waited for a thread"
+)
+uploads_in_flight = Gauge("storeapi_uploads_in_flight", "Uploads running on threads")
+upload_seconds = Histogram(
+    "storeapi_upload_seconds",
+    "Time spent uploading a file to B2",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+upload_dedup_bytes_saved = Counter(
+    "storeapi_upload_dedup_bytes_saved_total",
+    "Bytes of uploads not sent to B2 since the same content was there",
+)
@@ -51,3 +51,17 @@ class PostLikeIn(BaseModel):
 class PostLike(PostLikeIn):
     id: int
     user_id: int
+
+
+class BatchItemResult(BaseModel):
+    index: int = Field(description="position of the item in the request")
+    status_code: int
+    id: int | None = None
+    detail: str | None = None
+
+
+class ImageStatus(BaseModel):
+    post_id: int
+    status: str = Field(description="pending, running, done or failed")
+    attempts: int
+    image_url: str | None = None
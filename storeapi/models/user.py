@@ -10,3 +10,15 @@ class User(UserIn):
     model_config = ConfigDict(from_attributes=True)
 
     id: int
+
+
+class UserClaims(BaseModel):
+    """User as described by the claims of an access token"""
+
+    id: int
+    email: str
+    confirmed: bool
+
+
+class TokenRefreshIn(BaseModel):
+    refresh_token: str
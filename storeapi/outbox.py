@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+from storeapi import metrics
+from storeapi.config import config
+from storeapi.jobs import JobQueue
+
+logger = logging.getLogger(__name__)
+
+# send_batch(template, {address: variables}) sends one message per address
+BatchSender = Callable[[str, dict[str, dict]], Awaitable[object]]
+
+
+class EmailOutbox:
+    """
+    Send the email jobs of the job queue as batches: every flush_interval
+    seconds at most max_batch due jobs of kind are claimed and every
+    template is sent by one request. A job is only done once its batch is
+    delivered, a failed batch goes back to the queue to be retried with
+    backoff, so an accepted email survives a restart of the process.
+    Payloads are {"to", "template", "variables"}.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        kind: str,
+        send_batch: BatchSender,
+        flush_interval: float,
+        max_batch: int,
+    ) -> None:
+        self.queue = queue
+        self.kind = kind
+        self.send_batch = send_batch
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._task: asyncio.Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self) -> None:
+        logger.info("Starting email outbox")
+        # the job workers of this process leave these jobs to the outbox
+        self.queue.batched_kinds.add(self.kind)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop flushing periodically and send what is due once"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+        self.queue.batched_kinds.discard(self.kind)
+        logger.info("Email outbox stopped")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                claimed = await self.flush()
+            except Exception:
+                logger.exception("Flushing email outbox failed")
+                claimed = 0
+            # more jobs may be due when the batch was full
+            if claimed < self.max_batch:
+                await asyncio.sleep(self.flush_interval)
+
+    def batches(self, jobs: list):
+        """
+        Group jobs by template in batches of max_batch, an address
+        repeated within a template goes to a later batch since recipient
+        variables are keyed by address
+        """
+        by_template: dict[str, list[dict[str, tuple[dict, object]]]] = {}
+        for job in jobs:
+            payload = job.payload
+            batches = by_template.setdefault(payload["template"], [])
+            for batch in batches:
+                if payload["to"] not in batch and len(batch) < self.max_batch:
+                    break
+            else:
+                batch = {}
+                batches.append(batch)
+            batch[payload["to"]] = (payload["variables"], job)
+        for template, batches in by_template.items():
+            for batch in batches:
+                yield template, batch
+
+    async def flush(self) -> int:
+        """Send one claim of due jobs, :return: number of jobs claimed"""
+        jobs = await self.queue.claim_batch(self.kind, self.max_batch)
+        sendable = []
+        for job in jobs:
+            if job.attempts > config.JOB_MAX_ATTEMPTS:
+                # claimed by an outbox which died before finishing it
+                error = job.last_error or "Visibility timeout expired too many times"
+                await self.queue.complete(job, error, retry=False)
+            else:
+                sendable.append(job)
+        sent = 0
+        for template, batch in self.batches(sendable):
+            start = time.perf_counter()
+            try:
+                await self.send_batch(template, {to: v for to, (v, _) in batch.items()})
+            except Exception as e:
+                logger.exception(f"Sending {len(batch)} {template} emails failed")
+                metrics.email_batches.labels("failed").inc()
+                for _, job in batch.values():
+                    await self.queue.complete(job, repr(e))
+                continue
+            await self.queue.complete_many([job for _, job in batch.values()])
+            metrics.email_batches.labels("sent").inc()
+            metrics.email_batch_size.observe(len(batch))
+            metrics.email_batch_seconds.observe(time.perf_counter() - start)
+            sent += len(batch)
+        logger.debug(f"Sent {sent} of {len(jobs)} emails")
+        return len(jobs)
@@ -0,0 +1,46 @@
+import base64
+import json
+import logging
+
+from fastapi import HTTPException, status
+
+logger = logging.getLogger(__name__)
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+# type of every key a cursor may hold, the values reach SQL comparisons
+CURSOR_KEY_TYPES = {"sort": str, "id": int, "likes": int, "offset": int}
+
+
+def encode_cursor(**keys) -> str:
+    """Pack the sort keys of the last row on a page into an opaque string."""
+    raw = json.dumps(keys, separators=(",", ":"), sort_keys=True).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, *required: str) -> dict:
+    """
+    Reverse encode_cursor, any tampered or foreign cursor is a 400
+    :param: required: keys which must exist in the cursor
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        keys = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError) as e:
+        raise invalid_cursor_exception() from e
+    if not isinstance(keys, dict) or any(k not in keys for k in required):
+        raise invalid_cursor_exception()
+    for key, value in keys.items():
+        expected = CURSOR_KEY_TYPES.get(key)
+        # bool is an int too
+        if expected is None or isinstance(value, bool):
+            raise invalid_cursor_exception()
+        if not isinstance(value, expected):
+            raise invalid_cursor_exception()
+    return keys
+
+
+def invalid_cursor_exception() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+    )
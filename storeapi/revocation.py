@@ -0,0 +1,112 @@
+import asyncio
+import heapq
+import logging
+import time
+
+import sqlalchemy
+from databases import Database
+
+from storeapi.config import config
+from storeapi.database import insert_or_ignore, revoked_token_table
+
+logger = logging.getLogger(__name__)
+
+
+class RevocationList:
+    """
+    Revoked token ids mirrored from the revoked_tokens table into a set,
+    so checking a token which is not revoked costs no I/O.
+    refresh() only reads the rows revoked since the last refresh, minus
+    an overlap, and an entry is dropped once its token has expired anyway.
+    """
+
+    def __init__(self) -> None:
+        self._revoked: set[str] = set()
+        # (expires_at, jti) i.e. the next entry to age out first
+        self._expiry: list[tuple[int, str]] = []
+        # revoked_at of the latest row read
+        self._since = 0.0
+
+    def __len__(self) -> int:
+        return len(self._revoked)
+
+    def is_revoked(self, jti: str | None) -> bool:
+        return jti in self._revoked
+
+    def _add(self, jti: str, expires_at: int) -> bool:
+        """:return: whether the token was not known yet"""
+        if jti in self._revoked:
+            return False
+        self._revoked.add(jti)
+        heapq.heappush(self._expiry, (expires_at, jti))
+        return True
+
+    def prune(self, now: float | None = None) -> int:
+        """Forget the expired tokens, :return: number of entries dropped"""
+        now = time.time() if now is None else now
+        dropped = 0
+        while self._expiry and self._expiry[0][0] <= now:
+            _, jti = heapq.heappop(self._expiry)
+            self._revoked.discard(jti)
+            dropped += 1
+        return dropped
+
+    def clear(self) -> None:
+        self._revoked.clear()
+        self._expiry.clear()
+        self._since = 0.0
+
+    async def revoke(self, db: Database, jti: str, expires_at: int) -> None:
+        query = insert_or_ignore(revoked_token_table, "jti").values(
+            jti=jti, expires_at=expires_at, revoked_at=time.time()
+        )
+        logger.debug(query)
+        await db.execute(query)
+        self._add(jti, expires_at)
+
+    async def refresh(self, db: Database) -> int:
+        """Load tokens revoked since last refresh, :return: number of new tokens"""
+        query = sqlalchemy.select(revoked_token_table).where(
+            revoked_token_table.c.revoked_at
+            > self._since - config.REVOCATION_REFRESH_OVERLAP,
+            revoked_token_table.c.expires_at > int(time.time()),
+        )
+        logger.debug(query)
+        rows = await db.fetch_all(query)
+        added = sum(self._add(row.jti, row.expires_at) for row in rows)
+        self._since = max([self._since] + [row.revoked_at for row in rows])
+        self.prune()
+        return added
+
+    async def is_revoked_in_db(self, db: Database, jti: str | None) -> bool:
+        """Check the table itself, for a token which must not wait for refresh"""
+        if jti is None:
+            return False
+        if self.is_revoked(jti):
+            return True
+        query = sqlalchemy.select(revoked_token_table.c.id).where(
+            revoked_token_table.c.jti == jti
+        )
+        logger.debug(query)
+        return await db.fetch_val(query) is not None
+
+    async def purge(self, db: Database) -> None:
+        """Delete the rows of expired tokens"""
+        query = revoked_token_table.delete().where(
+            revoked_token_table.c.expires_at <= int(time.time())
+        )
+        logger.debug(query)
+        await db.execute(query)
+
+
+async def refresh_periodically(revoked: RevocationList, db: Database, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await revoked.refresh(db)
+            await revoked.purge(db)
+        except Exception:
+            logger.exception("Refreshing revoked tokens failed")
+
+
+revocation_list = RevocationList()
@@ -1,12 +1,28 @@
 from enum import Enum
-from multiprocessing import Process
-import asyncio
+import json
 import logging
-from fastapi import Depends, APIRouter, HTTPException, Request, BackgroundTasks
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import (
+    Body,
+    Depends,
+    APIRouter,
+    HTTPException,
+    Request,
+    Response,
+    Query,
+)
 import sqlalchemy
 from typing import Annotated
+from storeapi.cache import (
+    comments_tag,
+    feed_tag,
+    get_response_cache,
+    post_tag,
+)
 from storeapi.database import comment_table, database, post_table, like_table
 from storeapi.models.post import (
+    BatchItemResult,
+    ImageStatus,
     Comment,
     CommentIn,
     UserPost,
@@ -16,21 +32,63 @@ from storeapi.models.post import (
     PostLikeIn,
     PostLike,
 )
+from storeapi.leaderboard import leaderboard
+from storeapi.likes import (
+    find_existing_post_ids,
+    invalidate_likes,
+    like_buffer,
+    save_likes,
+)
 from storeapi.models.user import User
+from storeapi.pagination import (
+    NEXT_CURSOR_HEADER,
+    decode_cursor,
+    encode_cursor,
+    invalid_cursor_exception,
+)
+from storeapi.search import index_comments, index_posts, search_post_ids
 from storeapi.security import get_current_user
-from storeapi.tasks import generate_and_add_to_post, send_user_registration_email
+from storeapi.jobs import get_post_image_job, job_queue
 
 router = APIRouter()
 
 logger = logging.getLogger(__name__)
 
-select_post_and_likes = (
-    sqlalchemy.select(post_table, sqlalchemy.func.count(like_table.c.id).label("likes"))
-    .select_from(post_table.outerjoin(like_table))
-    .group_by(post_table.c.id)
+# likes are read from the counter on posts, no aggregation at read time
+select_post_and_likes = sqlalchemy.select(
+    post_table, post_table.c.like_count.label("likes")
 )
 
 
+def increase_like_count(post_id: int, amount: int = 1):
+    return (
+        post_table.update()
+        .where(post_table.c.id == post_id)
+        .values(like_count=post_table.c.like_count + amount)
+        .returning(post_table.c.like_count)
+    )
+
+
+async def get_cached_response(response: Response, key: str):
+    """Replay a cached body and its headers, None when not cached"""
+    cached = await get_response_cache().get(key)
+    if cached is None:
+        return None
+    body, headers = cached
+    response.headers.update(headers)
+    return body
+
+
+async def cache_response(
+    response: Response, key: str, body, tags: list[str], version: int | None
+):
+    """:param: version: of the cache taken before reading the body"""
+    headers = {
+        k: response.headers[k] for k in (NEXT_CURSOR_HEADER,) if k in response.headers
+    }
+    await get_response_cache().set(key, (body, headers), tags, version=version)
+
+
 async def find_post(post_id: int):
     logger.info(f"Finding post with id {post_id}")
     query = post_table.select().where(post_table.c.id == post_id)
@@ -38,8 +96,23 @@ async def find_post(post_id: int):
     return await database.fetch_one(query)
 
 
-def arun_generate_and_add_to_post(*args):
-    asyncio.run(generate_and_add_to_post(*args[:-1], database, args[-1]))
+async def insert_many(table: sqlalchemy.Table, rows: list[dict]) -> list[int]:
+    """
+    Insert rows by one multi-row statement
+    :return: ids in the order of rows, ids of a single INSERT are ascending
+    """
+    query = table.insert().values(rows).returning(table.c.id)
+    logger.debug(query)
+    return sorted(record.id for record in await database.fetch_all(query))
+
+
+def post_not_found_result(index: int, post_id: int) -> BatchItemResult:
+    return BatchItemResult(
+        index=index, status_code=404, detail="Post id:%d not found" % post_id
+    )
+
+
+MAX_BATCH_SIZE = 100
 
 
 @router.post("/post", response_model=UserPost, status_code=201)
@@ -47,43 +120,61 @@ async def create_post(
     post: UserPostIn,
     current_user: Annotated[User, Depends(get_current_user)],
     request: Request,
-    background_tasks: BackgroundTasks,
     prompt: str = None,
 ):
+    """:param: prompt: generate an image for the post by a queued job"""
     logger.info("Create a post")
     # current_user: User = await get_current_user(await oauth2_scheme(request))  # when inject no longer need
     data = {**post.model_dump(), "user_id": current_user.id}
     query = post_table.insert().values(data)
     logger.debug(query)
-    last_record_id = await database.execute(query)
-
+    async with database.transaction():
+        last_record_id = await database.execute(query)
+        await database.execute(index_posts([{**data, "id": last_record_id}]))
+        if prompt:
+            # committed with the post, a worker picks it up even after a restart
+            await job_queue.enqueue(
+                "generate_image",
+                {
+                    "email": current_user.email,
+                    "post_id": last_record_id,
+                    "post_url": str(
+                        request.url_for(
+                            "get_post_with_comments", post_id=last_record_id
+                        )
+                    ),
+                    "prompt": prompt,
+                },
+                post_id=last_record_id,
+                notify=False,
+            )
     if prompt:
-        # # TODO whether target of process can run kwargs
-        # p = Process(
-        #     target=arun_generate_and_add_to_post,
-        #     args=(
-        #         current_user.email,
-        #         last_record_id,
-        #         str(request.url_for("get_post_with_comments", post_id=last_record_id)),
-        #         # database, #cannot pass to Process
-        #         prompt,
-        #     ),
-        #     # kwargs={"func": print("Hello world")},
-        # )
-        # p.daemon = True
-        # p.start()
-        background_tasks.add_task(
-            generate_and_add_to_post,
-            current_user.email,
-            last_record_id,
-            str(request.url_for("get_post_with_comments", post_id=last_record_id)),
-            database,
-            prompt,
-        )
-
+        job_queue.notify()
+    leaderboard.update(last_record_id, 0)
+    await get_response_cache().invalidate(feed_tag())
     return {**data, "id": last_record_id}
 
 
+@router.post("/post/batch", response_model=list[BatchItemResult])
+async def create_posts(
+    posts: Annotated[list[UserPostIn], Body(min_length=1, max_length=MAX_BATCH_SIZE)],
+    current_user: Annotated[User, Depends(get_current_user)],
+):
+    logger.info(f"Create {len(posts)} posts")
+    rows = [{**post.model_dump(), "user_id": current_user.id} for post in posts]
+    async with database.transaction():
+        ids = await insert_many(post_table, rows)
+        await database.execute(
+            index_posts([{**row, "id": id} for row, id in zip(rows, ids)])
+        )
+    for id in ids:
+        leaderboard.update(id, 0)
+    await get_response_cache().invalidate(feed_tag())
+    return [
+        BatchItemResult(index=i, status_code=201, id=id) for i, id in enumerate(ids)
+    ]
+
+
 class PostSorting(str, Enum):
     new = "new"
     old = "old"
@@ -91,21 +182,158 @@ class PostSorting(str, Enum):
 
 
 @router.get("/post", response_model=list[UserPostWithLikes])
-async def get_all_posts(sorting: PostSorting = PostSorting.new):
+async def get_all_posts(
+    response: Response,
+    sorting: PostSorting = PostSorting.new,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+    after: str | None = None,
+):
+    """
+    Keyset pagination, every page is a range scan started from the cursor
+    so deep pages cost the same as the first one.
+    :param: after: opaque cursor taken from the X-Next-Cursor header
+    """
     logger.info("Getting all posts")
+    key = f"{feed_tag(sorting.value)}:{limit}:{after}"
+    if (cached := await get_cached_response(response, key)) is not None:
+        return cached
+    version = await get_response_cache().version()
     query = None
+    likes = post_table.c.like_count
+    # a most_likes page starts after both sort keys of the last post
+    required = ("likes",) if sorting is PostSorting.most_likes else ()
+    cursor = decode_cursor(after, "sort", "id", *required) if after else None
+    if cursor and cursor["sort"] != sorting.value:
+        raise invalid_cursor_exception()
     # only support above python 3.10
     match sorting:
         case PostSorting.new:
             query = select_post_and_likes.order_by(post_table.c.id.desc())
+            if cursor:
+                query = query.where(post_table.c.id < cursor["id"])
         case PostSorting.old:
             query = select_post_and_likes.order_by(post_table.c.id.asc())
+            if cursor:
+                query = query.where(post_table.c.id > cursor["id"])
         case PostSorting.most_likes:
-            query = select_post_and_likes.order_by(sqlalchemy.desc("likes"))
+            # post id breaks ties between posts which have the same likes,
+            # the order is served by index ix_posts_like_count_id
+            query = select_post_and_likes.order_by(likes.desc(), post_table.c.id.desc())
+            if cursor:
+                query = query.where(
+                    sqlalchemy.or_(
+                        likes < cursor["likes"],
+                        sqlalchemy.and_(
+                            likes == cursor["likes"],
+                            post_table.c.id < cursor["id"],
+                        ),
+                    )
+                )
+
+    # fetch one more row to know whether there is a next page
+    query = query.limit(limit + 1)
+    logger.debug(query)
+    posts = await database.fetch_all(query)
+    if len(posts) > limit:
+        posts = posts[:limit]
+        last = posts[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(
+            sort=sorting.value, id=last.id, likes=last.likes
+        )
+
+    body = [UserPostWithLikes.model_validate(post).model_dump() for post in posts]
+    tags = [feed_tag(), feed_tag(sorting.value), *(post_tag(p.id) for p in posts)]
+    await cache_response(response, key, body, tags, version)
+    return body
+
+
+EXPORT_CHUNK_ROWS = 500
 
+
+async def iterate_ndjson(query, fields: list[str]):
+    """Stream rows from a server side cursor as chunks of NDJSON lines"""
+    lines = []
+    async for row in database.iterate(query):
+        lines.append(json.dumps({field: row[field] for field in fields}))
+        if len(lines) == EXPORT_CHUNK_ROWS:
+            yield "\n".join(lines) + "\n"
+            lines.clear()
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+@router.get("/post/export", response_class=StreamingResponse)
+async def export_posts(
+    user_id: int | None = None,
+    min_id: int | None = None,
+    max_id: int | None = None,
+):
+    """
+    Export posts with likes in id order as newline-delimited JSON,
+    disjoint id ranges can be exported in parallel
+    :param: min_id: first post id included
+    :param: max_id: last post id included
+    """
+    logger.info("Exporting posts")
+    query = select_post_and_likes.order_by(post_table.c.id)
+    if user_id is not None:
+        query = query.where(post_table.c.user_id == user_id)
+    if min_id is not None:
+        query = query.where(post_table.c.id >= min_id)
+    if max_id is not None:
+        query = query.where(post_table.c.id <= max_id)
+    logger.debug(query)
+    return StreamingResponse(
+        iterate_ndjson(query, list(UserPostWithLikes.model_fields)),
+        media_type="application/x-ndjson",
+    )
+
+
+@router.get("/post/search", response_model=list[UserPostWithLikes])
+async def search_posts(
+    response: Response,
+    q: Annotated[str, Query(min_length=1, max_length=200)],
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+    after: str | None = None,
+):
+    """
+    Full-text search over bodies of posts and their comments,
+    the best matching posts come first
+    :param: after: opaque cursor taken from the X-Next-Cursor header
+    """
+    logger.info("Searching posts")
+    if not q.split():
+        raise HTTPException(status_code=400, detail="Search query is empty")
+    offset = decode_cursor(after, "offset")["offset"] if after else 0
+    if offset < 0:
+        raise invalid_cursor_exception()
+    post_ids = await search_post_ids(database, q, limit + 1, offset)
+    if len(post_ids) > limit:
+        post_ids = post_ids[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(offset=offset + limit)
+    ranks = {post_id: rank for rank, post_id in enumerate(post_ids)}
+    query = select_post_and_likes.where(post_table.c.id.in_(ranks))
     logger.debug(query)
+    posts = await database.fetch_all(query)
+    return sorted(posts, key=lambda post: ranks[post.id])
 
-    return await database.fetch_all(query)
+
+@router.get("/post/top", response_model=list[UserPostWithLikes])
+async def get_top_posts(k: Annotated[int, Query(ge=1)] = 10):
+    """
+    The k most liked posts, ranked by the in-memory leaderboard
+    """
+    if k > leaderboard.max_k:
+        raise HTTPException(
+            status_code=400, detail="k can not exceed %d" % leaderboard.max_k
+        )
+    if not leaderboard.loaded:
+        await leaderboard.load(database)
+    ranks = {post_id: rank for rank, (post_id, _) in enumerate(leaderboard.top(k))}
+    query = select_post_and_likes.where(post_table.c.id.in_(ranks))
+    logger.debug(query)
+    posts = await database.fetch_all(query)
+    return sorted(posts, key=lambda post: ranks[post.id])
 
 
 @router.post("/comment", response_model=Comment, status_code=201)
@@ -123,51 +351,264 @@ async def create_comment(
 
     data = {**comment.model_dump(), "user_id": current_user.id}
     query = comment_table.insert().values(data)
-    last_record_id = await database.execute(query)
+    async with database.transaction():
+        last_record_id = await database.execute(query)
+        await database.execute(index_comments([{**data, "id": last_record_id}]))
+    await get_response_cache().invalidate(comments_tag(comment.post_id))
     return {**data, "id": last_record_id}
 
 
+def select_comments_page(post_id: int, limit: int, after: str | None):
+    """Comments of a post in id order, one more row than limit is selected"""
+    query = comment_table.select().where(comment_table.c.post_id == post_id)
+    if after:
+        cursor = decode_cursor(after, "id")
+        query = query.where(comment_table.c.id > cursor["id"])
+    return query.order_by(comment_table.c.id).limit(limit + 1)
+
+
+def set_comments_next_cursor(response: Response, comments: list, limit: int) -> list:
+    if len(comments) > limit:
+        comments = comments[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(id=comments[-1]["id"])
+    return comments
+
+
+@router.post("/comment/batch", response_model=list[BatchItemResult])
+async def create_comments(
+    comments: Annotated[list[CommentIn], Body(min_length=1, max_length=MAX_BATCH_SIZE)],
+    current_user: Annotated[User, Depends(get_current_user)],
+):
+    logger.debug(f"Create {len(comments)} comments")
+    existing = await find_existing_post_ids(c.post_id for c in comments)
+    results = [
+        post_not_found_result(i, comment.post_id)
+        for i, comment in enumerate(comments)
+        if comment.post_id not in existing
+    ]
+    accepted = [(i, c) for i, c in enumerate(comments) if c.post_id in existing]
+    if accepted:
+        rows = [{**c.model_dump(), "user_id": current_user.id} for _, c in accepted]
+        async with database.transaction():
+            ids = await insert_many(comment_table, rows)
+            await database.execute(
+                index_comments([{**row, "id": id} for row, id in zip(rows, ids)])
+            )
+        results += [
+            BatchItemResult(index=i, status_code=201, id=id)
+            for (i, _), id in zip(accepted, ids)
+        ]
+        await get_response_cache().invalidate(
+            *{comments_tag(c.post_id) for _, c in accepted}
+        )
+    return sorted(results, key=lambda result: result.index)
+
+
 @router.get("/post/{post_id}/comment", response_model=list[Comment])
-async def get_comments_on_post(post_id: int):
+async def get_comments_on_post(
+    post_id: int,
+    response: Response,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+    after: str | None = None,
+):
     logger.info("Getting comments on post %d" % post_id)
-    query = comment_table.select().where(comment_table.c.post_id == post_id)
+    key = f"{comments_tag(post_id)}:{limit}:{after}"
+    if (cached := await get_cached_response(response, key)) is not None:
+        return cached
+    version = await get_response_cache().version()
+    query = select_comments_page(post_id, limit, after)
     logger.debug(query)
-    return await database.fetch_all(query)
+    comments = await database.fetch_all(query)
+    comments = set_comments_next_cursor(response, comments, limit)
+    body = [Comment.model_validate(comment).model_dump() for comment in comments]
+    await cache_response(response, key, body, [comments_tag(post_id)], version)
+    return body
+
+
+@router.get("/post/{post_id}/image-status", response_model=ImageStatus)
+async def get_image_status(post_id: int):
+    post = await find_post(post_id)
+    if not post:
+        raise HTTPException(status_code=404, detail="Post id:%d not found" % post_id)
+    job = await get_post_image_job(database, post_id)
+    if not job:
+        raise HTTPException(
+            status_code=404, detail="No image requested for post id:%d" % post_id
+        )
+    return {
+        "post_id": post_id,
+        "status": job.status,
+        "attempts": job.attempts,
+        "image_url": post.image_url,
+    }
 
 
 @router.get("/post/{post_id}", response_model=UserPostWithComments)
-async def get_post_with_comments(post_id: int):
+async def get_post_with_comments(
+    post_id: int,
+    response: Response,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+    after: str | None = None,
+):
     """
-    Endpoint for retrieving all commnent by a specific post id
+    Endpoint for retrieving a post with a page of its comments,
+    both are fetched by a single statement
     :param: post_id: int
     :return: {UserPostWithComments}
     """
     logger.info("Getting post %d and its comments" % post_id)
-    query = select_post_and_likes.where(post_table.c.id == post_id)
+    key = f"{post_tag(post_id)}:{limit}:{after}"
+    if (cached := await get_cached_response(response, key)) is not None:
+        return cached
+    version = await get_response_cache().version()
+    page = select_comments_page(post_id, limit, after).subquery()
+    query = (
+        select_post_and_likes.add_columns(
+            page.c.id.label("comment_id"),
+            page.c.body.label("comment_body"),
+            page.c.user_id.label("comment_user_id"),
+        )
+        .select_from(post_table.outerjoin(page, page.c.post_id == post_table.c.id))
+        .where(post_table.c.id == post_id)
+        .order_by(page.c.id)
+    )
     logger.debug(query)
-    post = await database.fetch_one(query)
-    if not post:
+    rows = await database.fetch_all(query)
+    if not rows:
         # logger.error("Post with post id %d not found" % post_id)
         raise HTTPException(status_code=404, detail="Post id:%d not found" % post_id)
 
-    return {
-        "post": post,
-        "comments": await get_comments_on_post(post_id),
-    }
+    comments = [
+        {
+            "id": row.comment_id,
+            "body": row.comment_body,
+            "post_id": post_id,
+            "user_id": row.comment_user_id,
+        }
+        for row in rows
+        if row.comment_id is not None
+    ]
+    body = UserPostWithComments.model_validate(
+        {
+            "post": rows[0],
+            "comments": set_comments_next_cursor(response, comments, limit),
+        },
+        from_attributes=True,
+    ).model_dump()
+    tags = [post_tag(post_id), comments_tag(post_id)]
+    await cache_response(response, key, body, tags, version)
+    return body
+
+
+# inserts of a like which keep racing with unlikes before giving up
+LIKE_ATTEMPTS = 3
 
 
-@router.post("/like", response_model=PostLike, status_code=201)
+@router.post(
+    "/like",
+    response_model=PostLike,
+    status_code=201,
+    responses={202: {"description": "Like buffered, it is written later"}},
+)
 async def like_post(
-    like: PostLikeIn, current_user: Annotated[User, Depends(get_current_user)]
+    like: PostLikeIn,
+    current_user: Annotated[User, Depends(get_current_user)],
+    response: Response,
 ):
+    """
+    Idempotent, liking a post again returns the existing like with status 200.
+    When the like buffer runs the like is only queued and 202 is returned.
+    """
     logger.debug("Post a like on %d" % like.post_id)
+    if like_buffer.running:
+        like_buffer.add(current_user.id, like.post_id)
+        return JSONResponse(
+            status_code=202,
+            content={"detail": "Like accepted", "post_id": like.post_id},
+        )
     post = await find_post(like.post_id)
     if not post:
         raise HTTPException(
             status_code=404, detail="Post id:%d not found" % like.post_id
         )
     data = {**like.model_dump(), "user_id": current_user.id}
-    query = like_table.insert().values(data)
+    query = like_table.select().where(
+        like_table.c.user_id == current_user.id, like_table.c.post_id == like.post_id
+    )
+    for _ in range(LIKE_ATTEMPTS):
+        inserted = await save_likes([data])
+        if inserted:
+            return {**data, "id": inserted[(current_user.id, like.post_id)]}
+        logger.debug(query)
+        if (existing := await database.fetch_one(query)) is not None:
+            response.status_code = 200
+            return existing
+        # unliked between the insert and the read, like it again
+    raise HTTPException(
+        status_code=409,
+        detail="Like on post id:%d changed concurrently" % like.post_id,
+    )
+
+
+@router.delete("/like/{post_id}", status_code=204)
+async def unlike_post(
+    post_id: int, current_user: Annotated[User, Depends(get_current_user)]
+):
+    logger.debug("Remove the like on %d" % post_id)
+    query = (
+        like_table.delete()
+        .where(like_table.c.user_id == current_user.id, like_table.c.post_id == post_id)
+        .returning(like_table.c.id)
+    )
     logger.debug(query)
-    last_record_id = await database.execute(query)
-    return {**data, "id": last_record_id}
+    async with database.transaction():
+        deleted = await database.fetch_one(query)
+        if deleted:
+            post = await database.fetch_one(increase_like_count(post_id, -1))
+    if not deleted:
+        raise HTTPException(
+            status_code=404, detail="Like on post id:%d not found" % post_id
+        )
+    leaderboard.update(post_id, post.like_count)
+    await invalidate_likes(post_id)
+
+
+@router.post("/like/batch", response_model=list[BatchItemResult])
+async def like_posts(
+    likes: Annotated[list[PostLikeIn], Body(min_length=1, max_length=MAX_BATCH_SIZE)],
+    current_user: Annotated[User, Depends(get_current_user)],
+):
+    logger.debug(f"Post {len(likes)} likes")
+    existing = await find_existing_post_ids(like.post_id for like in likes)
+    results = [
+        post_not_found_result(i, like.post_id)
+        for i, like in enumerate(likes)
+        if like.post_id not in existing
+    ]
+    # the first like on a post wins, the repeated ones are already liked
+    accepted = {}
+    for i, like in enumerate(likes):
+        if like.post_id in existing:
+            accepted.setdefault(like.post_id, i)
+    if accepted:
+        rows = [
+            {"post_id": post_id, "user_id": current_user.id} for post_id in accepted
+        ]
+        inserted = {
+            post_id: id for (_, post_id), id in (await save_likes(rows)).items()
+        }
+        for i, like in enumerate(likes):
+            if like.post_id not in existing:
+                continue
+            if accepted[like.post_id] == i and like.post_id in inserted:
+                result = BatchItemResult(
+                    index=i, status_code=201, id=inserted[like.post_id]
+                )
+            else:
+                result = BatchItemResult(
+                    index=i,
+                    status_code=200,
+                    detail="Post id:%d already liked" % like.post_id,
+                )
+            results.append(result)
+    return sorted(results, key=lambda result: result.index)
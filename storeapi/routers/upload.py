@@ -1,12 +1,22 @@
+import asyncio
+import hashlib
 import logging
 import tempfile
 from typing import Annotated
 
 import aiofiles
 from fastapi import APIRouter, HTTPException, UploadFile, status, Depends
-from storeapi.libs.b2 import b2_upload_file
+from storeapi.config import config
+from storeapi.libs.b2 import (
+    AsyncStreamReader,
+    B2File,
+    b2_upload_file,
+    b2_upload_stream,
+    upload_pool,
+)
 from storeapi.security import get_current_user
 from storeapi.models.user import User
+from storeapi.upload_index import upload_index
 
 logger = logging.getLogger(__name__)
 
@@ -15,18 +25,65 @@ router = APIRouter()
 CHUNK_SIZE = 1024 * 1024
 
 
+async def file_digest(file: UploadFile) -> tuple[str, int]:
+    """
+    sha256 and size of the uploaded file, the body has been spooled by
+    the time the route runs so this only reads it back
+    """
+    digest = hashlib.sha256()
+    size = 0
+    while chunk := await file.read(CHUNK_SIZE):
+        digest.update(chunk)
+        size += len(chunk)
+    await file.seek(0)
+    return digest.hexdigest(), size
+
+
+async def upload_by_temp_file(file: UploadFile) -> B2File:
+    with tempfile.NamedTemporaryFile() as temp_file:
+        temp_name = temp_file.name
+        logger.info(f"Saving uploaded file temporarily to {temp_name}")
+        async with aiofiles.open(temp_name, "wb") as f:
+            while chunk := await file.read(CHUNK_SIZE):
+                await f.write(chunk)
+        return await upload_pool.run(b2_upload_file, temp_name, file.filename)
+
+
+async def upload_by_stream(file: UploadFile) -> B2File:
+    """The uploader thread pulls chunks of the request, nothing is written to disk"""
+    logger.info(f"Streaming uploaded file {file.filename}")
+    reader = AsyncStreamReader(file.read, asyncio.get_running_loop())
+    return await upload_pool.run(b2_upload_stream, reader, file.filename)
+
+
+async def upload_to_b2(file: UploadFile) -> B2File:
+    if config.B2_UPLOAD_MODE != "stream":
+        return await upload_by_temp_file(file)
+    try:
+        return await upload_by_stream(file)
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Streaming upload failed, retrying by temp file")
+        await file.seek(0)
+        return await upload_by_temp_file(file)
+
+
 @router.post("/upload", status_code=201)
 async def upload_file(
     file: UploadFile, current_user: Annotated[User, Depends(get_current_user)]
 ):
     try:
-        with tempfile.NamedTemporaryFile() as temp_file:
-            temp_name = temp_file.name
-            logger.info(f"Saving uploaded file temporarily to {temp_name}")
-            async with aiofiles.open(temp_name, "wb") as f:
-                while chunk := await file.read(CHUNK_SIZE):
-                    await f.write(chunk)
-            file_url = b2_upload_file(local_file=temp_name, file_name=file.filename)
+        if config.UPLOAD_DEDUP_ENABLED:
+            digest, size = await file_digest(file)
+            file_url = await upload_index.get_or_upload(
+                digest, size, lambda: upload_to_b2(file)
+            )
+        else:
+            file_url = (await upload_to_b2(file)).url
+    except HTTPException:
+        # the upload pool is full
+        raise
     except Exception:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -1,5 +1,4 @@
-import logging, asyncio
-from multiprocessing import Process
+import logging
 
 from fastapi import (
     APIRouter,
@@ -8,31 +7,35 @@ from fastapi import (
     status,
     Request,
     Cookie,
+    Depends,
     Response,
 )
 
 from storeapi.database import database, user_table
-from storeapi.models.user import UserIn, User
+from storeapi.models.user import TokenRefreshIn, UserIn, User
 from storeapi.security import (
     get_user,
-    get_password_hash,
+    aget_password_hash,
     authenticate_user,
     create_access_token,
+    create_credentials_exception,
+    get_refresh_subject,
     get_subject_for_token_type,
+    invalidate_user,
+    oauth2_optional_scheme,
+    revoke_token,
 )
 from storeapi import tasks
+from storeapi.throttle import throttle_login, throttle_register
+from storeapi.worker_pool import email_pool
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
-def async_call_send_confirmed_email(email: str, url: str):
-    logger.debug("Multi process is running", extra={"email": email})
-    asyncio.run(tasks.send_user_registration_email(email, url))
-
-
 @router.post("/register", status_code=201)
 async def register(user: UserIn, background_tasks: BackgroundTasks, request: Request):
+    throttle_register(request.client.host if request.client else None)
     if await get_user(user.email):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -40,7 +43,7 @@ async def register(user: UserIn, background_tasks: BackgroundTasks, request: Req
         )
 
     logger.info("Register a new user", extra={"email": user.email})
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await aget_password_hash(user.password)
     user.password = hashed_password
     data = user.model_dump()
     query = user_table.insert().values(
@@ -55,11 +58,9 @@ async def register(user: UserIn, background_tasks: BackgroundTasks, request: Req
     # decode to URL from function name
     confirm_url = request.url_for("confirm_email", token=token)
 
-    p = Process(
-        target=async_call_send_confirmed_email, args=(user.email, str(confirm_url))
+    await email_pool.submit(
+        tasks.send_user_registration_email, user.email, str(confirm_url)
     )
-    p.daemon = True  # detached ref.https://stackoverflow.com/questions/49123439/python-how-to-run-process-in-detached-mode
-    p.start()
     logger.debug(
         "Submitting background task to send email",
         extra={"confirm_url": confirm_url},
@@ -78,9 +79,31 @@ async def register(user: UserIn, background_tasks: BackgroundTasks, request: Req
 
 
 @router.post("/login", status_code=status.HTTP_201_CREATED)
-async def login(user: UserIn, resp: Response):
+async def login(user: UserIn, resp: Response, request: Request):
+    throttle_login(request.client.host if request.client else None, user.email)
     user = await authenticate_user(user.email, user.password)
-    access_token = create_access_token(user.email)
+    access_token = create_access_token(user.email, "access", user.id, user.confirmed)
+    resp.set_cookie(key="cookie_token", value=access_token)
+    return {
+        "access_token": access_token,
+        "refresh_token": create_access_token(user.email, "refresh"),
+        "token_type": "bearer",
+    }
+
+
+@router.post("/refresh", status_code=status.HTTP_201_CREATED)
+async def refresh(token: TokenRefreshIn, resp: Response):
+    """
+    Exchange a refresh token for a new access token, the user is read
+    again here so a short lived access token never outlives a change
+    """
+    email = await get_refresh_subject(token.refresh_token)
+    user = await get_user(email)
+    if user is None:
+        raise create_credentials_exception("Could not find user for this token")
+    if not user.confirmed:
+        raise create_credentials_exception("User has not confirmed email")
+    access_token = create_access_token(user.email, "access", user.id, user.confirmed)
     resp.set_cookie(key="cookie_token", value=access_token)
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -100,8 +123,20 @@ async def login_cookie(resp: Response, cookie_token: str | None = Cookie(None)):
         return e
 
 
-@router.get("/logout")
-async def logout(resp: Response):
+@router.api_route("/logout", methods=["GET", "POST"])
+async def logout(
+    resp: Response,
+    token: str | None = Depends(oauth2_optional_scheme),
+    cookie_token: str | None = Cookie(None),
+    body: TokenRefreshIn | None = None,
+):
+    """
+    Revoke the bearer and cookie tokens and the refresh token posted
+    in the body, so a leaked copy is refused
+    """
+    refresh_token = body.refresh_token if body is not None else None
+    for t in {token, cookie_token, refresh_token} - {None}:
+        await revoke_token(t)
     resp.delete_cookie("cookie_token")
     return {"detail": "You've logout"}
 
@@ -114,4 +149,5 @@ async def confirm_email(token: str):
     )
     logger.debug(query)
     await database.execute(query)
+    invalidate_user(email)
     return {"detail": "You're confirmed"}
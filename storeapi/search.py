@@ -0,0 +1,98 @@
+import logging
+
+import sqlalchemy
+from databases import Database
+
+from storeapi.config import config
+from storeapi.database import comment_table, post_table, search_table
+
+logger = logging.getLogger(__name__)
+
+IS_POSTGRES = "postgre" in config.DATABASE_URL
+
+# best rank of every matched post, a lower rank is a better match
+if IS_POSTGRES:
+    search_query = sqlalchemy.text(
+        "SELECT post_id, -max(ts_rank(tsv, query)) AS rank"
+        " FROM post_search, websearch_to_tsquery('english', :q) query"
+        " WHERE tsv @@ query"
+        " GROUP BY post_id ORDER BY rank, post_id LIMIT :limit OFFSET :offset"
+    )
+else:
+    search_query = sqlalchemy.text(
+        "SELECT post_id, min(rank) AS rank FROM post_search"
+        " WHERE post_search MATCH :q"
+        " GROUP BY post_id ORDER BY rank, post_id LIMIT :limit OFFSET :offset"
+    )
+
+
+def to_fts5_query(q: str) -> str:
+    """Quote every word, so user input is never parsed as FTS5 syntax"""
+    return " ".join('"%s"' % word.replace('"', '""') for word in q.split())
+
+
+async def search_post_ids(db: Database, q: str, limit: int, offset: int) -> list[int]:
+    """:return: ids of the posts matching q, the best matches first"""
+    query = search_query.bindparams(
+        q=q if IS_POSTGRES else to_fts5_query(q), limit=limit, offset=offset
+    )
+    logger.debug(query)
+    return [row.post_id for row in await db.fetch_all(query)]
+
+
+def index_posts(posts: list[dict]):
+    """:param: posts: [{"id": int, "body": str}]"""
+    return search_table.insert().values(
+        [
+            {"post_id": p["id"], "kind": "post", "ref_id": p["id"], "body": p["body"]}
+            for p in posts
+        ]
+    )
+
+
+def index_comments(comments: list[dict]):
+    """:param: comments: [{"id": int, "post_id": int, "body": str}]"""
+    return search_table.insert().values(
+        [
+            {
+                "post_id": c["post_id"],
+                "kind": "comment",
+                "ref_id": c["id"],
+                "body": c["body"],
+            }
+            for c in comments
+        ]
+    )
+
+
+async def rebuild_search_index(db: Database) -> int:
+    """
+    Index all posts and comments from scratch
+    :return: number of rows indexed
+    """
+    sources = [
+        sqlalchemy.select(
+            post_table.c.id,
+            sqlalchemy.literal("post"),
+            post_table.c.id,
+            post_table.c.body,
+        ),
+        sqlalchemy.select(
+            comment_table.c.post_id,
+            sqlalchemy.literal("comment"),
+            comment_table.c.id,
+            comment_table.c.body,
+        ),
+    ]
+    columns = ["post_id", "kind", "ref_id", "body"]
+    async with db.transaction():
+        await db.execute(search_table.delete())
+        for source in sources:
+            query = search_table.insert().from_select(columns, source)
+            logger.debug(query)
+            await db.execute(query)
+    count = await db.fetch_val(
+        sqlalchemy.select(sqlalchemy.func.count()).select_from(search_table)
+    )
+    logger.info(f"Indexed {count} posts and comments for search")
+    return count
@@ -1,7 +1,13 @@
-import logging, datetime
+import logging, datetime, asyncio, hashlib, time, uuid
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from storeapi import metrics
+from storeapi.cache import TTLCache
 from storeapi.database import database, user_table
+from storeapi.models.user import UserClaims
+from storeapi.revocation import revocation_list
+from storeapi.throttle import too_many_requests_exception
 from storeapi.config import config
 from typing import Annotated, Literal
 from passlib.context import CryptContext
@@ -10,6 +16,13 @@ from jose import jwt, JWTError, ExpiredSignatureError
 logger = logging.getLogger(__name__)
 pwd_context = CryptContext(schemes=["bcrypt"])
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+oauth2_optional_scheme = OAuth2PasswordBearer(tokenUrl="login", auto_error=False)
+# users by email, tagged by user id, every user mutation has to invalidate it
+user_cache = TTLCache(
+    "user", maxsize=config.USER_CACHE_MAXSIZE, ttl=config.USER_CACHE_TTL
+)
+# verified claims by sha256 of the token, every entry lives until the token expires
+token_cache = TTLCache("token", maxsize=config.TOKEN_CACHE_MAXSIZE)
 
 
 def create_credentials_exception(detail: str) -> HTTPException:
@@ -28,21 +41,63 @@ def confirmation_token_expire_minutes() -> int:
     return 1440
 
 
+def claims_access_token_expire_minutes() -> int:
+    """Access tokens with claims are short lived, they are renewed by /refresh"""
+    return 5
+
+
+def refresh_token_expire_minutes() -> int:
+    return 10080
+
+
+def signing_keys() -> dict[str, str]:
+    """:return: {kid: secret}, the first one signs new tokens"""
+    if not config.SECRET_KEYS:
+        return {"default": config.SECRET_KEY}
+    return dict(
+        pair.strip().split(":", 1) for pair in config.SECRET_KEYS.split(",") if pair
+    )
+
+
 def create_access_token(
-    email: str, token_type: Literal["access", "confirmation"] = "access"
+    email: str,
+    token_type: Literal["access", "confirmation", "refresh"] = "access",
+    user_id: int | None = None,
+    confirmed: bool | None = None,
 ) -> str:
+    """
+    :param: user_id: embedded with confirmed into an access token,
+    which becomes short lived, only when config.ACCESS_TOKEN_CLAIMS
+    """
     logger.debug("Creating access token", extra={"email": email})
+    with_claims = (
+        token_type == "access" and config.ACCESS_TOKEN_CLAIMS and user_id is not None
+    )
+    match token_type:
+        case "access" if with_claims:
+            minutes = claims_access_token_expire_minutes()
+        case "access":
+            minutes = access_token_expire_minutes()
+        case "refresh":
+            minutes = refresh_token_expire_minutes()
+        case _:
+            minutes = confirmation_token_expire_minutes()
     expire = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
-        minutes=(
-            access_token_expire_minutes()
-            if token_type == "access"
-            else confirmation_token_expire_minutes()
-        )
+        minutes=minutes
     )
-    jwt_data = {"sub": email, "exp": expire, "type": token_type}
+    # jti identifies the token in the revocation list
+    jwt_data = {
+        "sub": email,
+        "exp": expire,
+        "type": token_type,
+        "jti": uuid.uuid4().hex,
+    }
+    if with_claims:
+        jwt_data.update(uid=user_id, confirmed=bool(confirmed))
     # SECRET_KEY is arbitrary string for permanent saving as secrete as long string
+    kid, key = next(iter(signing_keys().items()))
     encoded_jwt = jwt.encode(
-        jwt_data, key=config.SECRET_KEY, algorithm=config.ALGORITHM
+        jwt_data, key=key, algorithm=config.ALGORITHM, headers={"kid": kid}
     )
     return encoded_jwt
 
@@ -55,12 +110,78 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+class PasswordHashPool:
+    """
+    Run bcrypt in a pool so it never blocks the event loop. At most
+    workers + queue_size calls are submitted, later callers are refused
+    with 429 so a burst of logins cannot queue up unbounded CPU work.
+    """
+
+    def __init__(self, kind: str, workers: int, queue_size: int) -> None:
+        self.kind = kind
+        self.workers = workers
+        self.slots = asyncio.Semaphore(workers + queue_size)
+        self._executor: Executor | None = None
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            pool = ProcessPoolExecutor if self.kind == "process" else ThreadPoolExecutor
+            self._executor = pool(max_workers=self.workers)
+        return self._executor
+
+    async def run(self, func, *args):
+        if self.slots.locked():
+            metrics.throttle_decisions.labels("password_hash", "throttled").inc()
+            logger.warning("Password pool is full, shedding request")
+            raise too_many_requests_exception(config.PASSWORD_HASH_RETRY_AFTER)
+        metrics.throttle_decisions.labels("password_hash", "allowed").inc()
+        async with self.slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_pool = PasswordHashPool(
+    config.PASSWORD_HASH_EXECUTOR,
+    workers=config.PASSWORD_HASH_WORKERS,
+    queue_size=config.PASSWORD_HASH_QUEUE_SIZE,
+)
+
+
+async def aget_password_hash(password: str) -> str:
+    return await password_pool.run(get_password_hash, password)
+
+
+async def averify_password(plain_password: str, hashed_password: str) -> bool:
+    return await password_pool.run(verify_password, plain_password, hashed_password)
+
+
+def user_tag(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+def invalidate_user(email: str | None = None, user_id: int | None = None):
+    """Drop a cached user after changing it in database"""
+    if email is not None:
+        user_cache.pop(email)
+    if user_id is not None:
+        user_cache.invalidate(user_tag(user_id))
+
+
 async def get_user(email: str):
+    if (user := user_cache.get(email)) is not None:
+        return user
     logger.info("Fetched user from database", extra={"email": email})
     query = user_table.select().where(user_table.c.email == email)
     logger.debug(query)
     result = await database.fetch_one(query)
     if result:
+        user_cache.set(email, result, tags=[user_tag(result.id)])
         return result
     logger.info("Not found email", extra={"email": email})
 
@@ -70,25 +191,46 @@ async def authenticate_user(email: str, password: str):
     user = await get_user(email)
     if not user:
         raise create_credentials_exception("Invalid email or password")
-    if not verify_password(password, user.password):
+    if not await averify_password(password, user.password):
         raise create_credentials_exception("Invalid email or password")
     if not user.confirmed:
         raise create_credentials_exception("User has not confirmed email")
     return user
 
 
-def get_subject_for_token_type(
-    token: str,
-    type: Literal["access", "confirmation"],
-) -> str:
+def decode_token(token: str) -> dict:
+    """
+    Verify the token, the claims of a valid token are memoized until it expires
+    so the signature of a reused token is checked once.
+    A token signed by a key which has been rotated out is invalid.
+    """
+    keys = signing_keys()
+    digest = hashlib.sha256(token.encode()).digest()
+    cached = token_cache.get(digest)
+    if cached is not None:
+        kid, payload = cached
+        if kid in keys and payload["exp"] > time.time():
+            return payload
     try:
-        payload = jwt.decode(
-            token, key=config.SECRET_KEY, algorithms=[config.ALGORITHM]
-        )
+        # tokens issued before key rotation have no kid
+        kid = jwt.get_unverified_header(token).get("kid", "default")
+        if kid not in keys:
+            raise JWTError(f"Unknown key id {kid}")
+        payload = jwt.decode(token, key=keys[kid], algorithms=[config.ALGORITHM])
     except ExpiredSignatureError as e:
         raise create_credentials_exception("Token has expired") from e
     except JWTError as e:
         raise create_credentials_exception("Invalid token") from e
+    if isinstance(payload.get("exp"), (int, float)):
+        token_cache.set(digest, (kid, payload), ttl=payload["exp"] - time.time())
+    return payload
+
+
+def get_claims_for_token_type(
+    token: str,
+    type: Literal["access", "confirmation", "refresh"],
+) -> dict:
+    payload = decode_token(token)
 
     email = payload.get("sub")
     if email is None:
@@ -98,11 +240,48 @@ def get_subject_for_token_type(
         raise create_credentials_exception(
             f"Token has incorrect type, expected '{type}'"
         )
-    return email
+    if revocation_list.is_revoked(payload.get("jti")):
+        raise create_credentials_exception("Token has been revoked")
+    return payload
+
+
+def get_subject_for_token_type(
+    token: str,
+    type: Literal["access", "confirmation", "refresh"],
+) -> str:
+    return get_claims_for_token_type(token, type)["sub"]
+
+
+async def revoke_token(token: str) -> None:
+    """Refuse the token from now on, an invalid token is ignored"""
+    try:
+        payload = decode_token(token)
+    except HTTPException:
+        return
+    if payload.get("jti") and isinstance(payload.get("exp"), int):
+        await revocation_list.revoke(database, payload["jti"], payload["exp"])
+
+
+async def get_refresh_subject(token: str) -> str:
+    """
+    Subject of a valid refresh token, its revocation is read from the
+    database since a refresh token revoked by another process must not
+    mint access tokens until the next refresh of the revocation list
+    """
+    claims = get_claims_for_token_type(token, "refresh")
+    if await revocation_list.is_revoked_in_db(database, claims.get("jti")):
+        raise create_credentials_exception("Token has been revoked")
+    return claims["sub"]
 
 
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
-    email = get_subject_for_token_type(token, "access")
+    claims = get_claims_for_token_type(token, "access")
+    if "uid" in claims:
+        # self-contained token, authorized without reading the database
+        return UserClaims(
+            id=claims["uid"], email=claims["sub"], confirmed=claims["confirmed"]
+        )
+    email = claims["sub"]
     user = await get_user(email)
     if user is None:
         raise create_credentials_exception("Could not find user for this token")
@@ -0,0 +1,46 @@
+"""
+Stand-in for DeepAI and Mailgun, so image generation and emails
+run fully locally. STUB_FAILURE_RATE makes some calls fail with 503
+to exercise retries, STUB_LATENCY_MS delays every response like a
+remote service would.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import uuid
+
+from fastapi import FastAPI, Form, HTTPException, Request
+
+logger = logging.getLogger(__name__)
+FAILURE_RATE = float(os.environ.get("STUB_FAILURE_RATE", "0"))
+LATENCY = float(os.environ.get("STUB_LATENCY_MS", "0")) / 1000
+# Mailgun requests and messages received, for benchmarks
+stats = {"requests": 0, "messages": 0}
+
+app = FastAPI()
+
+
+async def simulate_upstream():
+    await asyncio.sleep(LATENCY)
+    if random.random() < FAILURE_RATE:
+        raise HTTPException(status_code=503, detail="Stub upstream failure")
+
+
+@app.post("/api/text2img")
+async def text2img(request: Request, text: str = Form()):
+    await simulate_upstream()
+    id = uuid.uuid4().hex
+    logger.info(f"Generated image {id} for {text!r}")
+    return {"id": id, "output_url": f"{request.base_url}images/{id}.jpg"}
+
+
+@app.post("/v3/{domain}/messages")
+async def send_message(domain: str, to: list[str] = Form(), subject: str = Form()):
+    """A batch has recipient-variables and one message per address in to"""
+    await simulate_upstream()
+    stats["requests"] += 1
+    stats["messages"] += len(to)
+    logger.info(f"Sent {subject!r} to {len(to)} recipients from {domain}")
+    return {"id": f"<{uuid.uuid4().hex}@{domain}>", "message": "Queued. Thank you."}
@@ -1,11 +1,17 @@
 import asyncio
+import json
 from json import JSONDecodeError
 import logging
-from databases import Database
 import httpx
 
+from storeapi.cache import get_response_cache, post_tag
+from storeapi.circuit import UpstreamUnavailable, guarded
 from storeapi.config import config
 from storeapi.database import post_table
+from storeapi.http_clients import get_http_client
+from storeapi.image_cache import image_cache
+from storeapi.jobs import job_handler, job_queue
+from storeapi.outbox import EmailOutbox
 
 
 logger = logging.getLogger(__name__)
@@ -17,10 +23,11 @@ class APIResponseError(Exception):
 
 async def send_simple_message(to: str, subject: str, body: str):
     logger.debug(f"Sending email to '{to.split('@')[0]}' with subject '{subject[:20]}'")
-    async with httpx.AsyncClient() as client:
-        try:
+    client = get_http_client("mailgun")
+    try:
+        async with guarded("mailgun"):
             response = await client.post(
-                f"https://api.mailgun.net/v3/{config.MAILGUN_DOMAIN}/messages",
+                f"{config.MAILGUN_API_URL}/{config.MAILGUN_DOMAIN}/messages",
                 auth=("api", config.MAILGUN_API_KEY),
                 data={
                     "from": f"Jose Salvatierra <mailgun@{config.MAILGUN_DOMAIN}>",
@@ -31,19 +38,100 @@ async def send_simple_message(to: str, subject: str, body: str):
             )
             response.raise_for_status()
 
-            logger.debug(response.content)
+        logger.debug(response.content)
 
-            return response
-        except httpx.HTTPStatusError as err:
-            raise APIResponseError(
-                f"API request failed with status code {err.response.status_code}"
-            ) from err
+        return response
+    except httpx.HTTPStatusError as err:
+        raise APIResponseError(
+            f"API request failed with status code {err.response.status_code}"
+        ) from err
+    except UpstreamUnavailable as err:
+        raise APIResponseError(str(err)) from err
 
 
 def get_email_name(email: str) -> str:
     return email.split("@")[0]
 
 
+# (subject, text) of the notifications, %recipient.<name>% is replaced by
+# the variables of each recipient, by Mailgun when sent as a batch
+EMAIL_TEMPLATES = {
+    "registration": (
+        "Successfully signed up",
+        "Hi %recipient.name%! You have successfully signed up to the Stores REST API."
+        " Please confirm your email by clicking on the"
+        " following link: %recipient.url%",
+    ),
+    "image_ready": (
+        "Image generation completed",
+        "Hi %recipient.name%! Your image has been generated and added to your post."
+        " Please click on the following link to view it: %recipient.url%",
+    ),
+    "image_error": (
+        "Error generating image",
+        "Hi %recipient.name%! Unfortunately there was an error generating an image"
+        " for your post.",
+    ),
+}
+
+
+def render_email(template: str, variables: dict) -> tuple[str, str]:
+    subject, text = EMAIL_TEMPLATES[template]
+    for name, value in variables.items():
+        subject = subject.replace(f"%recipient.{name}%", str(value))
+        text = text.replace(f"%recipient.{name}%", str(value))
+    return subject, text
+
+
+async def send_batch_message(template: str, recipient_variables: dict[str, dict]):
+    """
+    Send a template to many recipients by one Mailgun request, every
+    recipient only sees its own address and variables
+    """
+    logger.debug(f"Sending {template} email to {len(recipient_variables)} recipients")
+    subject, text = EMAIL_TEMPLATES[template]
+    client = get_http_client("mailgun")
+    try:
+        async with guarded("mailgun"):
+            response = await client.post(
+                f"{config.MAILGUN_API_URL}/{config.MAILGUN_DOMAIN}/messages",
+                auth=("api", config.MAILGUN_API_KEY),
+                data={
+                    "from": f"Jose Salvatierra <mailgun@{config.MAILGUN_DOMAIN}>",
+                    "to": list(recipient_variables),
+                    "subject": subject,
+                    "text": text,
+                    "recipient-variables": json.dumps(recipient_variables),
+                },
+            )
+            response.raise_for_status()
+        return response
+    except httpx.HTTPStatusError as err:
+        raise APIResponseError(
+            f"API request failed with status code {err.response.status_code}"
+        ) from err
+    except UpstreamUnavailable as err:
+        raise APIResponseError(str(err)) from err
+
+
+email_outbox = EmailOutbox(
+    job_queue,
+    "send_email",
+    send_batch_message,
+    flush_interval=config.EMAIL_OUTBOX_FLUSH_MS / 1000,
+    max_batch=config.EMAIL_BATCH_SIZE,
+)
+
+
+async def send_templated_email(to: str, template: str, variables: dict):
+    """Queued for the outbox to send in batches when it runs, else sent right away"""
+    if email_outbox.running:
+        await enqueue_email(to, template, variables)
+        return None
+    variables = {"name": get_email_name(to), **variables}
+    return await send_simple_message(to, *render_email(template, variables))
+
+
 async def send_user_registration_email(email: str, confirmation_url: str):
     logger.debug("What is environment? %s" % config.ENV_STATE)
     if config.ENV_STATE == "dev":
@@ -83,72 +171,88 @@ async def send_user_registration_email(email: str, confirmation_url: str):
             #     await asyncio.sleep(0.5)
             #     record_id = await database.execute(query)
 
-    return await send_simple_message(
-        email,
-        "Successfully signed up",
-        (
-            f"Hi {get_email_name(email)}! You have successfully signed up to the Stores REST API."
-            " Please confirm your email by clicking on the"
-            f" following link: {confirmation_url}"
-        ),
-    )
+    return await send_templated_email(email, "registration", {"url": confirmation_url})
 
 
 async def _generate_cute_creature_api(prompt: str):
     logger.debug("Generating cute creature")
-    async with httpx.AsyncClient() as client:
-        try:
+    client = get_http_client("deepai")
+    try:
+        # fails fast while DeepAI is failing or slow, instead of holding a
+        # connection until the timeout
+        async with guarded("deepai"):
             res = await client.post(
-                url="https://api.deepai.org/api/text2img",
+                url=f"{config.DEEPAI_API_URL}/text2img",
                 data={"text": prompt},
                 headers={"api-key": config.DEEPAI_API_KEY},
-                timeout=60,
             )
             logger.debug(res)
             res.raise_for_status()
-            return res.json()
-        except httpx.HTTPStatusError as err:
-            raise APIResponseError(
-                f"API request failed with status code {err.response.status_code}"
-            ) from err
-        except (JSONDecodeError, TypeError) as err:
-            raise APIResponseError("API response parsing failed") from err
-
-
-async def generate_and_add_to_post(
-    email: str,
-    post_id: int,
-    post_url: str,
-    database: Database,
-    prompt: str = "A blue british shorthair cat is sitting on a couch",
-):
-    try:
-        res = await _generate_cute_creature_api(prompt)
-        # res = {"output_url": "12312321"} #test assert_called() in test_post.py
-    except APIResponseError:
-        return await send_simple_message(
-            email,
-            "Error generating image",
-            (
-                f"Hi {get_email_name(email)}! Unfortunately there was an error generating an image"
-                "for your post."
-            ),
-        )
-    query = (
+        return res.json()
+    except httpx.HTTPStatusError as err:
+        raise APIResponseError(
+            f"API request failed with status code {err.response.status_code}"
+        ) from err
+    except UpstreamUnavailable as err:
+        raise APIResponseError(str(err)) from err
+    except (JSONDecodeError, TypeError) as err:
+        raise APIResponseError("API response parsing failed") from err
+
+
+async def _generate_image_url(prompt: str) -> str:
+    return (await _generate_cute_creature_api(prompt))["output_url"]
+
+
+async def generate_image_url(prompt: str) -> str:
+    """Generate an image, or reuse the one of the same prompt"""
+    return await image_cache.get_or_generate(prompt, _generate_image_url)
+
+
+def add_image_to_post(post_id: int, image_url: str):
+    return (
         post_table.update()
         .where(post_table.c.id == post_id)
-        .values(image_url=res["output_url"])
+        .values(image_url=image_url)
     )
-    logger.debug("Connecting to database to update post id %d" % post_id)
-    record_id = await database.execute(query)
-    assert record_id == post_id
-    logger.debug("Database connection in background task closed")
+
+
+async def enqueue_email(
+    to: str, template: str, variables: dict, notify: bool = True
+) -> int:
+    variables = {"name": get_email_name(to), **variables}
+    return await job_queue.enqueue(
+        "send_email",
+        {"to": to, "template": template, "variables": variables},
+        notify=notify,
+    )
+
+
+@job_handler("send_email")
+async def send_email_job(payload: dict):
+    """Send a single email, the outbox sends these jobs in batches when it runs"""
     await send_simple_message(
-        email,
-        "Image generation completed",
-        (
-            f"Hi {get_email_name(email)}! Your image has been generated and added to your post."
-            f" Please click on the following link to view it: {post_url}"
-        ),
+        payload["to"], *render_email(payload["template"], payload["variables"])
     )
-    return res
+
+
+async def image_generation_failed(payload: dict, error: str):
+    await enqueue_email(payload["email"], "image_error", {})
+
+
+@job_handler("generate_image", on_give_up=image_generation_failed)
+async def generate_image_job(payload: dict):
+    """
+    Generate the image of a post, an upstream error is retried and
+    the notification is a job of its own so it never generates again
+    :param: payload: {"email", "post_id", "post_url", "prompt"}
+    """
+    output_url = await generate_image_url(payload["prompt"])
+    query = add_image_to_post(payload["post_id"], output_url)
+    logger.debug(query)
+    async with job_queue.db.transaction():
+        await job_queue.db.execute(query)
+        await enqueue_email(
+            payload["email"], "image_ready", {"url": payload["post_url"]}, notify=False
+        )
+    job_queue.notify()
+    await get_response_cache().invalidate(post_tag(payload["post_id"]))
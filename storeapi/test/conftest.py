@@ -7,7 +7,14 @@ from unittest.mock import AsyncMock, Mock
 
 # trick for test environment, we import database after setting
 os.environ["ENV_STATE"] = "test"
+from storeapi.circuit import reset_guards  # noqa: E402(tell ruff)
+from storeapi.cache import get_response_cache  # noqa: E402(tell ruff)
 from storeapi.database import database, user_table  # noqa: E402(tell ruff)
+from storeapi.leaderboard import leaderboard  # noqa: E402(tell ruff)
+from storeapi.revocation import revocation_list  # noqa: E402(tell ruff)
+from storeapi.security import token_cache, user_cache  # noqa: E402(tell ruff)
+from storeapi.throttle import clear_limiters  # noqa: E402(tell ruff)
+from storeapi.worker_pool import email_pool  # noqa: E402(tell ruff)
 from storeapi.main import app  # noqa: E402(tell ruff)
 
 
@@ -32,6 +39,27 @@ async def db() -> AsyncGenerator:
     await database.disconnect()
 
 
+@pytest.fixture(autouse=True)
+async def email_workers(db) -> AsyncGenerator:
+    """The lifespan does not run in tests, start email workers for every test"""
+    email_pool.start()
+    yield email_pool
+    await email_pool.stop()
+
+
+@pytest.fixture(autouse=True)
+async def clear_caches() -> AsyncGenerator:
+    """The database rolls back after every test, so must the caches"""
+    yield
+    await get_response_cache().clear()
+    leaderboard.clear()
+    user_cache.clear()
+    token_cache.clear()
+    revocation_list.clear()
+    clear_limiters()
+    reset_guards()
+
+
 @pytest.fixture
 async def async_client(client: TestClient) -> AsyncGenerator:
     async with AsyncClient(
@@ -73,12 +101,10 @@ def mock_tasks_httpx_client(mocker) -> Mock:
     Fixture to mock the HTTPX client so that we never make any
     real HTTP requests (especially important when registering users).
     """
-    mocked_client = mocker.patch("storeapi.tasks.httpx.AsyncClient")
-
     mocked_async_client = Mock()
     response = Response(status_code=200, content="", request=Request("POST", "//"))
     mocked_async_client.post = AsyncMock(return_value=response)
-    mocked_client.return_value.__aenter__.return_value = mocked_async_client
+    mocker.patch("storeapi.tasks.get_http_client", return_value=mocked_async_client)
 
     return mocked_async_client
 
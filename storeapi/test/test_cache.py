@@ -0,0 +1,70 @@
+from storeapi.cache import TTLCache
+
+
+class FakeTimer:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_cache_get_set():
+    cache = TTLCache("test")
+    assert cache.get("a") is None
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+
+
+def test_cache_expired():
+    timer = FakeTimer()
+    cache = TTLCache("test", ttl=10, timer=timer)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=20)
+    timer.now = 10
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert len(cache) == 1
+
+
+def test_cache_evicts_least_recently_used():
+    cache = TTLCache("test", maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_cache_invalidate_tags():
+    cache = TTLCache("test")
+    cache.set("a", 1, tags=["post:1", "feed"])
+    cache.set("b", 2, tags=["post:2", "feed"])
+    cache.set("c", 3, tags=["post:2"])
+    assert cache.invalidate("post:1") == 1
+    assert "a" not in cache and "b" in cache
+    assert cache.invalidate("post:2", "feed") == 2
+    assert len(cache) == 0
+
+
+def test_cache_skips_value_read_before_invalidation():
+    cache = TTLCache("test")
+    version = cache.version
+    # a writer invalidates the post while the reader is querying it
+    cache.invalidate("post:1")
+    assert not cache.set("a", "old", tags=["post:1"], version=version)
+    assert "a" not in cache
+    assert cache.set("b", 2, tags=["post:2"], version=version)
+    assert cache.set("a", "new", tags=["post:1"], version=cache.version)
+
+
+def test_cache_forgotten_invalidations_are_stale():
+    cache = TTLCache("test", maxsize=1)
+    version = cache.version
+    cache.invalidate("post:1")
+    cache.invalidate("post:2")
+    # post:1 is no longer tracked, a version before it may be stale
+    assert not cache.set("a", 1, tags=["post:3"], version=version)
+    assert cache.set("a", 1, tags=["post:3"], version=cache.version)
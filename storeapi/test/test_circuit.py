@@ -0,0 +1,184 @@
+import asyncio
+
+import httpx
+import pytest
+
+from storeapi import circuit
+from storeapi.circuit import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    AIMDLimiter,
+    CircuitBreaker,
+    UpstreamUnavailable,
+    get_guard,
+    guarded,
+)
+from storeapi.jobs import job_queue
+
+
+class FakeTimer:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def status_error(code: int) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "//")
+    return httpx.HTTPStatusError(
+        "error", request=request, response=httpx.Response(code, request=request)
+    )
+
+
+def test_circuit_opens_and_probes():
+    timer = FakeTimer()
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=10, timer=timer)
+    breaker.record(failed=True)
+    assert breaker.state == CLOSED
+    breaker.record(failed=True)
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+    timer.now = 10
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # a single probe at a time
+    assert not breaker.allow()
+    breaker.record(failed=True)
+    assert breaker.state == OPEN
+
+    timer.now = 20
+    assert breaker.allow()
+    breaker.record(failed=False)
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+def test_call_admitted_before_transition_ignored():
+    timer = FakeTimer()
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=10, timer=timer)
+    slow = breaker.allow()
+    breaker.record(True, breaker.allow())
+    assert breaker.state == OPEN
+    # a slow call let through while closed does not close the circuit
+    breaker.record(False, slow)
+    assert breaker.state == OPEN
+
+    timer.now = 10
+    probe = breaker.allow()
+    assert probe.probe
+    breaker.record(False, slow)
+    # nor does it let a second probe in
+    assert breaker.allow() is None
+    breaker.record(False, probe)
+    assert breaker.state == CLOSED
+
+
+def test_aimd_limit():
+    limiter = AIMDLimiter("test", initial=4, min_limit=1, max_limit=5, latency_target=1)
+    assert all(limiter.try_acquire() for _ in range(4))
+    assert not limiter.try_acquire()
+    limiter.release(0.1, failed=False)
+    assert limiter.limit == pytest.approx(4.25)
+    limiter.release(2, failed=False)
+    assert limiter.limit == pytest.approx(2.125)
+    limiter.release(0.1, failed=True)
+    limiter.release(0.1, failed=True)
+    assert limiter.limit == 1
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.anyio
+async def test_aimd_limit_waits_for_permit():
+    limiter = AIMDLimiter("test", initial=1, min_limit=1, max_limit=1, latency_target=1)
+    await limiter.acquire()
+    waiting = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0)
+    assert not waiting.done()
+    limiter.release(0.1, failed=False)
+    await waiting
+    assert limiter.in_flight == 1
+
+
+@pytest.mark.anyio
+async def test_busy_upstream_is_not_unavailable(mocker):
+    mocker.patch.object(circuit.config, "CONCURRENCY_INITIAL_LIMIT", 1)
+    release = asyncio.Event()
+
+    async def call():
+        async with guarded("deepai"):
+            await release.wait()
+
+    calls = [asyncio.create_task(call()) for _ in range(3)]
+    await asyncio.sleep(0)
+    assert get_guard("deepai").limiter.in_flight == 1
+    release.set()
+    await asyncio.gather(*calls)
+    assert get_guard("deepai").limiter.in_flight == 0
+
+
+@pytest.mark.anyio
+async def test_open_circuit_fails_fast_while_limit_reached(mocker):
+    mocker.patch.object(circuit.config, "CONCURRENCY_INITIAL_LIMIT", 1)
+    release = asyncio.Event()
+
+    async def slow_call():
+        async with guarded("deepai"):
+            await release.wait()
+
+    slow = asyncio.create_task(slow_call())
+    await asyncio.sleep(0)
+    guard = get_guard("deepai")
+    assert guard.limiter.in_flight == 1
+    for _ in range(guard.breaker.failure_threshold):
+        guard.breaker.record(True)
+    assert guard.breaker.state == OPEN
+    with pytest.raises(UpstreamUnavailable):
+        # refused before queueing behind the slow call
+        await asyncio.wait_for(guard().__aenter__(), timeout=0.1)
+    assert not guard.limiter._waiters
+    release.set()
+    await slow
+
+
+def test_upstream_failures():
+    assert circuit.is_upstream_failure(status_error(503))
+    assert circuit.is_upstream_failure(status_error(429))
+    assert not circuit.is_upstream_failure(status_error(400))
+    assert circuit.is_upstream_failure(httpx.ReadTimeout("timeout"))
+
+
+@pytest.mark.anyio
+async def test_guard_fails_fast_once_open(mocker):
+    mocker.patch.object(circuit.config, "CIRCUIT_FAILURE_THRESHOLD", 1)
+    with pytest.raises(httpx.HTTPStatusError):
+        async with guarded("deepai"):
+            raise status_error(500)
+    with pytest.raises(UpstreamUnavailable):
+        async with guarded("deepai"):
+            pass
+    assert get_guard("deepai").limiter.in_flight == 0
+
+
+@pytest.mark.anyio
+async def test_client_errors_keep_circuit_closed(mocker):
+    mocker.patch.object(circuit.config, "CIRCUIT_FAILURE_THRESHOLD", 1)
+    with pytest.raises(httpx.HTTPStatusError):
+        async with guarded("deepai"):
+            raise status_error(400)
+    assert get_guard("deepai").breaker.state == CLOSED
+
+
+@pytest.mark.anyio
+async def test_open_circuit_sends_error_email(mock_tasks_httpx_client, db, mocker):
+    mocker.patch.object(get_guard("deepai").breaker, "allow", return_value=None)
+    mocker.patch.object(circuit.config, "JOB_MAX_ATTEMPTS", 1)
+    payload = {"email": "test@example.net", "post_id": 1, "post_url": "/post/1"}
+    await job_queue.enqueue("generate_image", {**payload, "prompt": "A cat"})
+    # the generation gives up without calling DeepAI, then the email is sent
+    assert await job_queue.run_pending() == 2
+    mock_tasks_httpx_client.post.assert_called_once()
+    data = mock_tasks_httpx_client.post.call_args.kwargs["data"]
+    assert data["subject"] == "Error generating image"
@@ -0,0 +1,76 @@
+import pytest
+import sqlalchemy
+from databases import Database
+from httpx import AsyncClient
+
+from storeapi.commands import migrate_schema, reconcile_like_counts
+from storeapi.database import like_table, metadata, post_table, search_table
+from storeapi.search import rebuild_search_index, search_post_ids
+
+
+async def create_post(body: str, aclient: AsyncClient, logged_in_token: str) -> dict:
+    response = await aclient.post(
+        "/post",
+        json={"body": body},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    return response.json()
+
+
+@pytest.mark.anyio
+async def test_reconcile_like_counts(
+    async_client: AsyncClient, logged_in_token: str, confirmed_user: dict, db: Database
+):
+    post = await create_post("Test post", async_client, logged_in_token)
+    # a like inserted behind like_post's back leaves the counter stale
+    await db.execute(
+        like_table.insert().values(post_id=post["id"], user_id=confirmed_user["id"])
+    )
+    assert await reconcile_like_counts(db) == 1
+    assert await reconcile_like_counts(db) == 0
+
+    query = post_table.select().where(post_table.c.id == post["id"])
+    assert (await db.fetch_one(query)).like_count == 1
+
+
+@pytest.mark.anyio
+async def test_rebuild_search_index(
+    async_client: AsyncClient, logged_in_token: str, db: Database
+):
+    post = await create_post("Test post", async_client, logged_in_token)
+    await db.execute(search_table.delete())
+    assert await search_post_ids(db, "test", 10, 0) == []
+
+    assert await rebuild_search_index(db) == 1
+    assert await search_post_ids(db, "test", 10, 0) == [post["id"]]
+
+
+# tables of posts and likes before like_count and the unique like index
+BASELINE_SCHEMA = [
+    "CREATE TABLE posts (id INTEGER PRIMARY KEY, body VARCHAR,"
+    " user_id INTEGER NOT NULL, image_url VARCHAR)",
+    "CREATE TABLE likes (id INTEGER PRIMARY KEY,"
+    " post_id INTEGER NOT NULL, user_id INTEGER NOT NULL)",
+    "INSERT INTO posts (id, body, user_id) VALUES (1, 'a', 1), (2, 'b', 1)",
+    "INSERT INTO likes (post_id, user_id) VALUES (1, 1), (1, 2), (2, 1)",
+]
+
+
+@pytest.mark.anyio
+async def test_migrate_counts_likes_of_added_column(tmp_path):
+    url = f"sqlite:///{tmp_path / 'baseline.db'}"
+    bind = sqlalchemy.create_engine(url)
+    with bind.begin() as conn:
+        for statement in BASELINE_SCHEMA:
+            conn.execute(sqlalchemy.text(statement))
+    # what importing storeapi.database does to an existing database
+    metadata.create_all(bind)
+
+    assert migrate_schema(bind)
+    async with Database(url) as db:
+        assert await reconcile_like_counts(db) == 2
+        rows = await db.fetch_all(post_table.select().order_by(post_table.c.id))
+    assert [row.like_count for row in rows] == [2, 1]
+    # nothing left to migrate
+    assert not migrate_schema(bind)
+    bind.dispose()
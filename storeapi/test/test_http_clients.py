@@ -0,0 +1,27 @@
+import pytest
+
+from storeapi import http_clients
+
+
+@pytest.fixture(autouse=True)
+async def close_clients():
+    yield
+    await http_clients.close_http_clients()
+
+
+@pytest.mark.anyio
+async def test_client_shared_per_upstream():
+    mailgun = http_clients.get_http_client("mailgun")
+    assert http_clients.get_http_client("mailgun") is mailgun
+    assert http_clients.get_http_client("deepai") is not mailgun
+    assert mailgun.timeout.read == http_clients.config.MAILGUN_TIMEOUT
+
+    await http_clients.close_http_clients()
+    assert mailgun.is_closed
+    assert http_clients.get_http_client("mailgun") is not mailgun
+
+
+def test_http2_needs_h2(mocker):
+    mocker.patch.object(http_clients.config, "HTTP2_ENABLED", True)
+    mocker.patch("importlib.util.find_spec", return_value=None)
+    assert not http_clients.http2_available()
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+from httpx import AsyncClient
+
+from storeapi.image_cache import ImageCache, prompt_hash
+from storeapi.jobs import job_queue
+
+
+class FakeGenerator:
+    def __init__(self, fail: bool = False) -> None:
+        self.fail = fail
+        self.calls = 0
+
+    async def __call__(self, prompt: str) -> str:
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.fail:
+            raise ConnectionError("upstream down")
+        return f"https://example.com/{self.calls}.jpg"
+
+
+def test_prompt_normalized():
+    assert prompt_hash("A  blue Cat ") == prompt_hash("a blue cat")
+    assert prompt_hash("a blue cat") != prompt_hash("a red cat")
+
+
+@pytest.mark.anyio
+async def test_image_reused_for_same_prompt(db):
+    generate = FakeGenerator()
+    cache = ImageCache(db, ttl=60)
+    assert await cache.get_or_generate("A cat", generate) == "https://example.com/1.jpg"
+    assert await cache.get_or_generate("a cat", generate) == "https://example.com/1.jpg"
+    assert generate.calls == 1
+    # persisted, another process sees it
+    assert await ImageCache(db, ttl=60).get(prompt_hash("a cat")) is not None
+
+
+@pytest.mark.anyio
+async def test_image_expires(db):
+    generate = FakeGenerator()
+    cache = ImageCache(db, ttl=0)
+    await cache.get_or_generate("A cat", generate)
+    assert await cache.get_or_generate("A cat", generate) == "https://example.com/2.jpg"
+
+
+@pytest.mark.anyio
+async def test_concurrent_requests_share_generation(db):
+    generate = FakeGenerator()
+    cache = ImageCache(db, ttl=60)
+    urls = await asyncio.gather(
+        *(cache.get_or_generate("A cat", generate) for _ in range(3))
+    )
+    assert urls == ["https://example.com/1.jpg"] * 3
+    assert generate.calls == 1
+
+
+@pytest.mark.anyio
+async def test_failed_generation_not_cached(db):
+    generate = FakeGenerator(fail=True)
+    cache = ImageCache(db, ttl=60)
+    results = await asyncio.gather(
+        *(cache.get_or_generate("A cat", generate) for _ in range(2)),
+        return_exceptions=True,
+    )
+    assert all(isinstance(r, ConnectionError) for r in results)
+    assert generate.calls == 1
+    assert await cache.get(prompt_hash("A cat")) is None
+
+
+@pytest.mark.anyio
+async def test_posts_with_same_prompt_generate_once(
+    async_client: AsyncClient, logged_in_token: str, mock_generate_cute_creature_api
+):
+    for _ in range(2):
+        await async_client.post(
+            "/post?prompt=A cat",
+            json={"body": "Test Post"},
+            headers={"Authorization": f"Bearer {logged_in_token}"},
+        )
+    await job_queue.run_pending()
+    assert mock_generate_cute_creature_api.call_count == 1
+    res = await async_client.get("/post")
+    assert [p["image_url"] for p in res.json()] == ["https://example.com/image.jpg"] * 2
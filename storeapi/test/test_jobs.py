@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+from httpx import AsyncClient
+
+from storeapi.database import job_table
+from storeapi.jobs import backoff_seconds, config, job_handler, job_queue
+
+calls = []
+
+
+@job_handler("test_ok")
+async def ok_job(payload: dict):
+    calls.append(payload)
+
+
+async def give_up(payload: dict, error: str):
+    calls.append(("gave up", error))
+
+
+@job_handler("test_fail", on_give_up=give_up)
+async def failing_job(payload: dict):
+    raise ValueError("boom")
+
+
+@pytest.fixture(autouse=True)
+def clear_calls():
+    calls.clear()
+
+
+async def get_job(db, job_id: int):
+    return await db.fetch_one(job_table.select().where(job_table.c.id == job_id))
+
+
+def test_backoff_doubles_up_to_max(mocker):
+    mocker.patch.object(config, "JOB_BACKOFF_SECONDS", 2)
+    mocker.patch.object(config, "JOB_BACKOFF_MAX_SECONDS", 10)
+    assert [backoff_seconds(n) for n in range(1, 5)] == [2, 4, 8, 10]
+
+
+@pytest.mark.anyio
+async def test_job_done(db):
+    job_id = await job_queue.enqueue("test_ok", {"n": 1})
+    assert await job_queue.run_pending() == 1
+    assert calls == [{"n": 1}]
+    job = await get_job(db, job_id)
+    assert (job.status, job.attempts) == ("done", 1)
+
+
+@pytest.mark.anyio
+async def test_workers_woken_after_commit(db, mocker):
+    mocker.patch.object(job_queue, "_wakeup", asyncio.Event())
+    async with db.transaction():
+        await job_queue.enqueue("test_ok", {}, notify=False)
+        assert not job_queue._wakeup.is_set()
+    job_queue.notify()
+    assert job_queue._wakeup.is_set()
+
+
+@pytest.mark.anyio
+async def test_job_not_due(db):
+    await job_queue.enqueue("test_ok", {}, delay=60)
+    assert await job_queue.run_pending() == 0
+
+
+@pytest.mark.anyio
+async def test_failed_job_retried_with_backoff(db):
+    job_id = await job_queue.enqueue("test_fail", {})
+    assert await job_queue.run_pending() == 1
+    job = await get_job(db, job_id)
+    assert (job.status, job.attempts) == ("pending", 1)
+    assert "boom" in job.last_error
+    assert calls == []
+
+
+@pytest.mark.anyio
+async def test_job_gives_up_after_max_attempts(db, mocker):
+    mocker.patch.object(config, "JOB_MAX_ATTEMPTS", 3)
+    mocker.patch.object(config, "JOB_BACKOFF_SECONDS", 0)
+    job_id = await job_queue.enqueue("test_fail", {})
+    assert await job_queue.run_pending() == 3
+    job = await get_job(db, job_id)
+    assert (job.status, job.attempts) == ("failed", 3)
+    assert [c[0] for c in calls] == ["gave up"]
+
+
+@pytest.mark.anyio
+async def test_job_claimed_again_after_visibility_timeout(db, mocker):
+    mocker.patch.object(config, "JOB_VISIBILITY_TIMEOUT", -1)
+    await job_queue.enqueue("test_ok", {})
+    stale = await job_queue.claim()
+    job = await job_queue.claim()
+    assert (stale.id, job.attempts) == (job.id, 2)
+    # the first worker has lost the job
+    assert await job_queue.run_job(stale) == "done"
+    assert (await get_job(db, job.id)).status == "running"
+    assert await job_queue.run_job(job) == "done"
+    assert (await get_job(db, job.id)).status == "done"
+
+
+@pytest.mark.anyio
+async def test_image_status(
+    async_client: AsyncClient, logged_in_token: str, mock_generate_cute_creature_api
+):
+    res = await async_client.post(
+        "/post?prompt=A cat",
+        json={"body": "Test Post"},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    post_id = res.json()["id"]
+    res = await async_client.get(f"/post/{post_id}/image-status")
+    assert res.json() == {
+        "post_id": post_id,
+        "status": "pending",
+        "attempts": 0,
+        "image_url": None,
+    }
+
+    await job_queue.run_pending()
+    res = await async_client.get(f"/post/{post_id}/image-status")
+    assert res.json()["status"] == "done"
+    assert res.json()["image_url"] == "https://example.com/image.jpg"
+
+
+@pytest.mark.anyio
+async def test_image_status_not_requested(
+    async_client: AsyncClient, logged_in_token: str
+):
+    res = await async_client.post(
+        "/post",
+        json={"body": "Test Post"},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    res = await async_client.get(f"/post/{res.json()['id']}/image-status")
+    assert res.status_code == 404
+    res = await async_client.get("/post/999/image-status")
+    assert res.status_code == 404
@@ -0,0 +1,41 @@
+from storeapi.leaderboard import Leaderboard
+
+
+def loaded_board(capacity: int) -> Leaderboard:
+    board = Leaderboard(capacity)
+    board.loaded = True
+    return board
+
+
+def test_leaderboard_order():
+    board = loaded_board(10)
+    board.update(1, 3)
+    board.update(2, 5)
+    board.update(3, 3)
+    assert board.top(3) == [(2, 5), (3, 3), (1, 3)]
+    assert board.top(1) == [(2, 5)]
+
+
+def test_leaderboard_update_existing():
+    board = loaded_board(10)
+    board.update(1, 1)
+    board.update(2, 2)
+    board.update(1, 3)
+    assert board.top(2) == [(1, 3), (2, 2)]
+    assert len(board) == 2
+
+
+def test_leaderboard_bounded():
+    board = loaded_board(2)
+    board.update(1, 1)
+    board.update(2, 2)
+    board.update(3, 0)
+    assert board.top(3) == [(2, 2), (1, 1)]
+    board.update(3, 5)
+    assert board.top(3) == [(3, 5), (2, 2)]
+
+
+def test_leaderboard_not_loaded():
+    board = Leaderboard(10)
+    board.update(1, 1)
+    assert len(board) == 0
@@ -0,0 +1,56 @@
+import pytest
+from databases import Database
+from httpx import AsyncClient
+
+from storeapi.database import post_table
+from storeapi.likes import LikeBuffer
+
+
+async def create_post(body: str, aclient: AsyncClient, logged_in_token: str) -> dict:
+    response = await aclient.post(
+        "/post",
+        json={"body": body},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    return response.json()
+
+
+async def get_like_count(db: Database, post_id: int) -> int:
+    query = post_table.select().where(post_table.c.id == post_id)
+    return (await db.fetch_one(query)).like_count
+
+
+@pytest.mark.anyio
+async def test_like_buffer_flush(
+    async_client: AsyncClient, logged_in_token: str, confirmed_user: dict, db: Database
+):
+    post = await create_post("Test post", async_client, logged_in_token)
+    buffer = LikeBuffer(flush_interval=60, max_entries=100)
+    buffer.add(confirmed_user["id"], post["id"])
+    buffer.add(confirmed_user["id"], post["id"])
+    buffer.add(confirmed_user["id"], 99)
+    assert len(buffer) == 2
+
+    assert await buffer.flush() == 1
+    assert len(buffer) == 0
+    assert await get_like_count(db, post["id"]) == 1
+
+
+@pytest.mark.anyio
+async def test_like_post_buffered(
+    async_client: AsyncClient, logged_in_token: str, db: Database, mocker
+):
+    post = await create_post("Test post", async_client, logged_in_token)
+    buffer = LikeBuffer(flush_interval=60, max_entries=100)
+    mocker.patch("storeapi.routers.posts.like_buffer", buffer)
+    buffer.start()
+    res = await async_client.post(
+        "/like",
+        json={"post_id": post["id"]},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert res.status_code == 202
+    assert await get_like_count(db, post["id"]) == 0
+
+    await buffer.stop()
+    assert await get_like_count(db, post["id"]) == 1
@@ -0,0 +1,100 @@
+from types import SimpleNamespace
+
+import pytest
+
+from storeapi.config import config
+from storeapi.database import job_table
+from storeapi.jobs import JobQueue
+from storeapi.outbox import EmailOutbox
+
+
+class FakeSender:
+    def __init__(self, fail: bool = False) -> None:
+        self.fail = fail
+        self.batches = []
+
+    async def __call__(self, template: str, recipient_variables: dict):
+        if self.fail:
+            raise ConnectionError("mailgun down")
+        self.batches.append((template, recipient_variables))
+
+
+def email_job(template: str, to: str, variables: dict | None = None):
+    payload = {"to": to, "template": template, "variables": variables or {}}
+    return SimpleNamespace(payload=payload)
+
+
+def make_outbox(db, sender: FakeSender, max_batch: int = 10) -> EmailOutbox:
+    queue = JobQueue(db, workers=0, poll_interval=1)
+    return EmailOutbox(
+        queue, "send_email", sender, flush_interval=1, max_batch=max_batch
+    )
+
+
+async def enqueue(outbox: EmailOutbox, template: str, to: str, variables: dict):
+    payload = {"to": to, "template": template, "variables": variables}
+    return await outbox.queue.enqueue("send_email", payload)
+
+
+def test_batches_by_template_and_size(db):
+    outbox = make_outbox(db, FakeSender(), max_batch=2)
+    jobs = [
+        email_job("a", "x@example.net"),
+        email_job("b", "x@example.net"),
+        email_job("a", "y@example.net"),
+        email_job("a", "z@example.net"),
+    ]
+    batches = [(t, list(batch)) for t, batch in outbox.batches(jobs)]
+    assert batches == [
+        ("a", ["x@example.net", "y@example.net"]),
+        ("a", ["z@example.net"]),
+        ("b", ["x@example.net"]),
+    ]
+
+
+def test_repeated_address_goes_to_next_batch(db):
+    outbox = make_outbox(db, FakeSender())
+    jobs = [email_job("a", "x@example.net", {"n": n}) for n in range(2)]
+    batches = [batch for _, batch in outbox.batches(jobs)]
+    assert [b["x@example.net"][0] for b in batches] == [{"n": 0}, {"n": 1}]
+
+
+@pytest.mark.anyio
+async def test_flush_sends_recipient_variables(db):
+    sender = FakeSender()
+    outbox = make_outbox(db, sender)
+    await enqueue(outbox, "a", "x@example.net", {"name": "x"})
+    await enqueue(outbox, "a", "y@example.net", {"name": "y"})
+    assert await outbox.flush() == 2
+    assert sender.batches == [
+        ("a", {"x@example.net": {"name": "x"}, "y@example.net": {"name": "y"}})
+    ]
+    statuses = await db.fetch_all(job_table.select())
+    assert [job.status for job in statuses] == ["done", "done"]
+    assert await outbox.flush() == 0
+
+
+@pytest.mark.anyio
+async def test_failed_batch_retried_by_job_queue(db, mocker):
+    mocker.patch.object(config, "JOB_MAX_ATTEMPTS", 2)
+    mocker.patch.object(config, "JOB_BACKOFF_SECONDS", 0)
+    outbox = make_outbox(db, FakeSender(fail=True))
+    job_id = await enqueue(outbox, "a", "x@example.net", {})
+    assert await outbox.flush() == 1
+    job = await db.fetch_one(job_table.select().where(job_table.c.id == job_id))
+    assert (job.status, job.attempts) == ("pending", 1)
+    assert "mailgun down" in job.last_error
+
+    assert await outbox.flush() == 1
+    job = await db.fetch_one(job_table.select().where(job_table.c.id == job_id))
+    # kept in the table as failed, not dropped silently
+    assert (job.status, job.attempts) == ("failed", 2)
+
+
+@pytest.mark.anyio
+async def test_workers_leave_batched_jobs_to_outbox(db):
+    outbox = make_outbox(db, FakeSender())
+    outbox.queue.batched_kinds.add("send_email")
+    await enqueue(outbox, "a", "x@example.net", {})
+    assert await outbox.queue.claim() is None
+    assert len(await outbox.queue.claim_batch("send_email", 10)) == 1
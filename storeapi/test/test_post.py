@@ -1,7 +1,11 @@
+import json
 from httpx import AsyncClient
 from fastapi import status
 import pytest
 from storeapi import security
+from storeapi.jobs import job_queue
+from storeapi.pagination import NEXT_CURSOR_HEADER, encode_cursor
+from storeapi.routers import posts
 from storeapi.routers.posts import PostSorting
 
 
@@ -25,12 +29,16 @@ async def create_comment(
     return response.json()
 
 
-async def like_post(post_id: int, aclient: AsyncClient, logged_in_token: str) -> dict:
-    res = await aclient.post(
+async def like_post_response(aclient: AsyncClient, logged_in_token: str, post_id: int):
+    return await aclient.post(
         "/like",
         json={"post_id": post_id},
         headers={"Authorization": f"Bearer {logged_in_token}"},
     )
+
+
+async def like_post(post_id: int, aclient: AsyncClient, logged_in_token: str) -> dict:
+    res = await like_post_response(aclient, logged_in_token, post_id)
     return res.json()
 
 
@@ -131,6 +139,121 @@ async def test_get_all_posts_sort_likes(
     assert [post["id"] for post in res.json()] == [1, 2]
 
 
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "sorting,expected_order",
+    [
+        (PostSorting.new.value, [3, 2, 1]),
+        (PostSorting.old.value, [1, 2, 3]),
+        (PostSorting.most_likes.value, [2, 3, 1]),
+    ],
+)
+async def test_get_all_posts_pagination(
+    async_client: AsyncClient,
+    logged_in_token: str,
+    sorting: str,
+    expected_order: list[int],
+):
+    for i in range(3):
+        await create_post(f"Post {i + 1}", async_client, logged_in_token)
+    await like_post(2, async_client, logged_in_token)
+
+    ids, params = [], {"sorting": sorting, "limit": 2}
+    while True:
+        res = await async_client.get("/post", params=params)
+        assert res.status_code == 200
+        assert len(res.json()) <= 2
+        ids += [post["id"] for post in res.json()]
+        if NEXT_CURSOR_HEADER not in res.headers:
+            break
+        params["after"] = res.headers[NEXT_CURSOR_HEADER]
+    assert ids == expected_order
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "after",
+    [
+        "not a cursor",
+        encode_cursor(sort="old", id=1),
+        encode_cursor(sort="new", id="x"),
+        encode_cursor(sort=1, id=1),
+        encode_cursor(sort="new", id=True),
+        encode_cursor(sort="new", id=1, likes=[1]),
+    ],
+)
+async def test_get_all_posts_invalid_cursor(async_client: AsyncClient, after: str):
+    res = await async_client.get("/post", params={"sorting": "new", "after": after})
+    assert res.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.anyio
+async def test_most_likes_cursor_requires_likes(async_client: AsyncClient):
+    after = encode_cursor(sort="most_likes", id=1)
+    res = await async_client.get(
+        "/post", params={"sorting": "most_likes", "after": after}
+    )
+    assert res.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.anyio
+async def test_search_posts(async_client: AsyncClient, logged_in_token: str):
+    await create_post("A cat on a couch", async_client, logged_in_token)
+    await create_post("A dog", async_client, logged_in_token)
+    await create_post("Nothing here", async_client, logged_in_token)
+    await create_comment("The dog chases a cat, cat!", 2, async_client, logged_in_token)
+
+    res = await async_client.get("/post/search", params={"q": "cat"})
+    assert res.status_code == 200
+    assert sorted(post["id"] for post in res.json()) == [1, 2]
+
+    res = await async_client.get("/post/search", params={"q": "cat", "limit": 1})
+    assert len(res.json()) == 1
+    cursor = res.headers[NEXT_CURSOR_HEADER]
+    res2 = await async_client.get(
+        "/post/search", params={"q": "cat", "limit": 1, "after": cursor}
+    )
+    assert {res.json()[0]["id"], res2.json()[0]["id"]} == {1, 2}
+    assert NEXT_CURSOR_HEADER not in res2.headers
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "after", [encode_cursor(offset=-1), encode_cursor(offset="1"), encode_cursor()]
+)
+async def test_search_posts_invalid_cursor(async_client: AsyncClient, after: str):
+    res = await async_client.get("/post/search", params={"q": "cat", "after": after})
+    assert res.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.anyio
+async def test_search_posts_quotes_syntax(
+    async_client: AsyncClient, created_post: dict
+):
+    res = await async_client.get("/post/search", params={"q": 'post" OR ("'})
+    assert res.status_code == 200
+    assert res.json() == []
+
+
+@pytest.mark.anyio
+async def test_get_top_posts(async_client: AsyncClient, logged_in_token: str):
+    for i in range(3):
+        await create_post(f"Post {i + 1}", async_client, logged_in_token)
+    res = await async_client.get("/post/top", params={"k": 2})
+    assert [post["id"] for post in res.json()] == [3, 2]
+
+    await like_post(1, async_client, logged_in_token)
+    res = await async_client.get("/post/top", params={"k": 2})
+    assert res.status_code == 200
+    assert [(post["id"], post["likes"]) for post in res.json()] == [(1, 1), (3, 0)]
+
+
+@pytest.mark.anyio
+async def test_get_top_posts_k_too_large(async_client: AsyncClient):
+    res = await async_client.get("/post/top", params={"k": 10000})
+    assert res.status_code == status.HTTP_400_BAD_REQUEST
+
+
 @pytest.mark.anyio
 async def test_create_comment(
     async_client: AsyncClient,
@@ -190,6 +313,39 @@ async def test_get_post_with_comments(
     )
 
 
+@pytest.mark.anyio
+async def test_get_comments_on_post_pagination(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    for i in range(3):
+        await create_comment(f"Comment {i}", 1, async_client, logged_in_token)
+    res = await async_client.get("/post/1/comment", params={"limit": 2})
+    assert [comment["id"] for comment in res.json()] == [1, 2]
+    res = await async_client.get(
+        "/post/1/comment",
+        params={"limit": 2, "after": res.headers[NEXT_CURSOR_HEADER]},
+    )
+    assert [comment["id"] for comment in res.json()] == [3]
+    assert NEXT_CURSOR_HEADER not in res.headers
+
+
+@pytest.mark.anyio
+async def test_get_post_with_comments_pagination(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    for i in range(3):
+        await create_comment(f"Comment {i}", 1, async_client, logged_in_token)
+    res = await async_client.get("/post/1", params={"limit": 2})
+    assert res.status_code == 200
+    assert res.json()["post"] == {**created_post, "likes": 0}
+    assert [comment["id"] for comment in res.json()["comments"]] == [1, 2]
+    res = await async_client.get(
+        "/post/1", params={"limit": 2, "after": res.headers[NEXT_CURSOR_HEADER]}
+    )
+    assert [comment["id"] for comment in res.json()["comments"]] == [3]
+    assert NEXT_CURSOR_HEADER not in res.headers
+
+
 @pytest.mark.anyio
 async def test_not_found_post_with_comments(
     async_client: AsyncClient, created_comment: dict
@@ -215,6 +371,70 @@ async def test_post_like(
     }.items() <= res.json().items()
 
 
+@pytest.mark.anyio
+async def test_like_invalidates_cached_post(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    res = await async_client.get("/post", params={"sorting": "most_likes"})
+    assert res.json()[0]["likes"] == 0
+    res = await async_client.get(f"/post/{created_post['id']}")
+    assert res.json()["post"]["likes"] == 0
+
+    await like_post(created_post["id"], async_client, logged_in_token)
+    res = await async_client.get("/post", params={"sorting": "most_likes"})
+    assert res.json()[0]["likes"] == 1
+    res = await async_client.get(f"/post/{created_post['id']}")
+    assert res.json()["post"]["likes"] == 1
+
+
+@pytest.mark.anyio
+async def test_comment_invalidates_cached_comments(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    res = await async_client.get(f"/post/{created_post['id']}/comment")
+    assert res.json() == []
+    comment = await create_comment(
+        "Test comment", created_post["id"], async_client, logged_in_token
+    )
+    res = await async_client.get(f"/post/{created_post['id']}/comment")
+    assert res.json() == [comment]
+
+
+@pytest.mark.anyio
+async def test_post_like_twice(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    first = await like_post(created_post["id"], async_client, logged_in_token)
+    res = await async_client.post(
+        "/like",
+        json={"post_id": created_post["id"]},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert res.status_code == 200
+    assert res.json() == first
+    res = await async_client.get(f"/post/{created_post['id']}")
+    assert res.json()["post"]["likes"] == 1
+
+
+@pytest.mark.anyio
+async def test_unlike_post(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    await like_post(created_post["id"], async_client, logged_in_token)
+    res = await async_client.delete(
+        f"/like/{created_post['id']}",
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert res.status_code == 204
+    res = await async_client.get(f"/post/{created_post['id']}")
+    assert res.json()["post"]["likes"] == 0
+    res = await async_client.delete(
+        f"/like/{created_post['id']}",
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert res.status_code == 404
+
+
 @pytest.mark.anyio
 async def test_create_post_with_prompt(
     async_client: AsyncClient, logged_in_token: str, mock_generate_cute_creature_api
@@ -230,4 +450,126 @@ async def test_create_post_with_prompt(
         "body": "Test Post",
         "image_url": None,
     }.items() <= response.json().items()
+    mock_generate_cute_creature_api.assert_not_called()
+    # the image is generated by a job and the email by another one
+    assert await job_queue.run_pending() == 2
     mock_generate_cute_creature_api.assert_called()
+
+
+@pytest.mark.anyio
+async def test_create_posts_batch(
+    async_client: AsyncClient, registered_user: dict, logged_in_token: str
+):
+    res = await async_client.post(
+        "/post/batch",
+        json=[{"body": "Post 1"}, {"body": "Post 2"}],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert res.status_code == 200
+    assert [(r["index"], r["status_code"], r["id"]) for r in res.json()] == [
+        (0, 201, 1),
+        (1, 201, 2),
+    ]
+    res = await async_client.get("/post", params={"sorting": "old"})
+    assert [post["body"] for post in res.json()] == ["Post 1", "Post 2"]
+
+
+@pytest.mark.anyio
+async def test_create_comments_batch_missing_post(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    res = await async_client.post(
+        "/comment/batch",
+        json=[
+            {"body": "Comment 1", "post_id": created_post["id"]},
+            {"body": "Comment 2", "post_id": 99},
+            {"body": "Comment 3", "post_id": created_post["id"]},
+        ],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert res.status_code == 200
+    assert [r["status_code"] for r in res.json()] == [201, 404, 201]
+    assert res.json()[1]["detail"] == "Post id:99 not found"
+    res = await async_client.get(f"/post/{created_post['id']}/comment")
+    assert [comment["body"] for comment in res.json()] == ["Comment 1", "Comment 3"]
+
+
+@pytest.mark.anyio
+async def test_like_post_unliked_concurrently(
+    async_client: AsyncClient, logged_in_token: str, created_post: dict, mocker
+):
+    save_likes = posts.save_likes
+    conflicts = [{}]
+
+    async def racing_save_likes(rows):
+        # the first insert conflicts with a like which is gone before it is read
+        return conflicts.pop() if conflicts else await save_likes(rows)
+
+    mocker.patch("storeapi.routers.posts.save_likes", side_effect=racing_save_likes)
+    res = await like_post_response(async_client, logged_in_token, created_post["id"])
+    assert res.status_code == 201
+    assert res.json()["post_id"] == created_post["id"]
+
+
+@pytest.mark.anyio
+async def test_like_post_keeps_racing(
+    async_client: AsyncClient, logged_in_token: str, created_post: dict, mocker
+):
+    mocker.patch("storeapi.routers.posts.save_likes", return_value={})
+    res = await like_post_response(async_client, logged_in_token, created_post["id"])
+    assert res.status_code == 409
+
+
+@pytest.mark.anyio
+async def test_like_posts_batch(async_client: AsyncClient, logged_in_token: str):
+    await create_post("Post 1", async_client, logged_in_token)
+    await create_post("Post 2", async_client, logged_in_token)
+    res = await async_client.post(
+        "/like/batch",
+        json=[{"post_id": 2}, {"post_id": 1}, {"post_id": 2}, {"post_id": 3}],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert res.status_code == 200
+    assert [r["status_code"] for r in res.json()] == [201, 201, 200, 404]
+    assert res.json()[2]["detail"] == "Post id:2 already liked"
+    res = await async_client.get("/post", params={"sorting": "most_likes"})
+    assert [(post["id"], post["likes"]) for post in res.json()] == [(2, 1), (1, 1)]
+
+
+@pytest.mark.anyio
+async def test_batch_too_large(async_client: AsyncClient, logged_in_token: str):
+    res = await async_client.post(
+        "/post/batch",
+        json=[{"body": "Post"}] * 101,
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert res.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.anyio
+async def test_export_posts(
+    async_client: AsyncClient, logged_in_token: str, registered_user: dict
+):
+    for i in range(3):
+        await create_post(f"Post {i + 1}", async_client, logged_in_token)
+    await like_post(2, async_client, logged_in_token)
+    res = await async_client.get("/post/export", params={"min_id": 2})
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert lines == [
+        {
+            "id": 2,
+            "body": "Post 2",
+            "user_id": registered_user["id"],
+            "image_url": None,
+            "likes": 1,
+        },
+        {
+            "id": 3,
+            "body": "Post 3",
+            "user_id": registered_user["id"],
+            "image_url": None,
+            "likes": 0,
+        },
+    ]
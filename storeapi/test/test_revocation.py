@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+from storeapi.database import revoked_token_table
+from storeapi.revocation import RevocationList
+
+
+def test_prune_expired():
+    revoked = RevocationList()
+    revoked._add("old", 100)
+    revoked._add("new", 200)
+    assert revoked.prune(now=150) == 1
+    assert not revoked.is_revoked("old")
+    assert revoked.is_revoked("new")
+
+
+@pytest.mark.anyio
+async def test_refresh_reads_new_rows_only(db):
+    expires_at = int(time.time()) + 60
+    writer, reader = RevocationList(), RevocationList()
+    await writer.revoke(db, "first", expires_at)
+    assert await reader.refresh(db) == 1
+    assert reader.is_revoked("first")
+
+    await writer.revoke(db, "second", expires_at)
+    assert await reader.refresh(db) == 1
+    assert reader.is_revoked("second")
+    assert await reader.refresh(db) == 0
+
+
+@pytest.mark.anyio
+async def test_refresh_skips_expired(db):
+    await RevocationList().revoke(db, "expired", int(time.time()) - 1)
+    reader = RevocationList()
+    assert await reader.refresh(db) == 0
+    await reader.purge(db)
+    assert await db.fetch_all(revoked_token_table.select()) == []
+
+
+@pytest.mark.anyio
+async def test_refresh_after_purge(db):
+    writer, reader = RevocationList(), RevocationList()
+    await writer.revoke(db, "expired", int(time.time()) - 1)
+    await writer.revoke(db, "valid", int(time.time()) + 60)
+    assert await reader.refresh(db) == 1
+    # deleting the latest rows lets SQLite hand out their ids again
+    await db.execute(revoked_token_table.delete())
+    await writer.revoke(db, "after_purge", int(time.time()) + 60)
+    assert await reader.refresh(db) == 1
+    assert reader.is_revoked("after_purge")
+
+
+@pytest.mark.anyio
+async def test_is_revoked_in_db(db):
+    await RevocationList().revoke(db, "other_process", int(time.time()) + 60)
+    reader = RevocationList()
+    assert not reader.is_revoked("other_process")
+    assert await reader.is_revoked_in_db(db, "other_process")
+    assert not await reader.is_revoked_in_db(db, "unknown")
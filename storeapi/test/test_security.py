@@ -1,3 +1,5 @@
+import time
+
 import pytest
 from storeapi import security
 
@@ -7,6 +9,14 @@ def test_password_hashes():
     assert security.verify_password(password, security.get_password_hash(password))
 
 
+@pytest.mark.anyio
+async def test_password_hashes_in_pool():
+    password = "password"
+    hashed = await security.aget_password_hash(password)
+    assert await security.averify_password(password, hashed)
+    assert not await security.averify_password("wrong password", hashed)
+
+
 @pytest.mark.parametrize(
     "token_type",
     [
@@ -36,6 +46,27 @@ def test_get_subject_for_token_type_wrong_type(token_type):
     assert "Token has incorrect type, expected" in exc_info.value.detail
 
 
+def test_get_subject_for_token_type_memoized(mocker):
+    spy = mocker.spy(security.jwt, "decode")
+    email = "test@example.com"
+    token = security.create_access_token(email)
+    assert security.get_subject_for_token_type(token, "access") == email
+    assert security.get_subject_for_token_type(token, "access") == email
+    assert spy.call_count == 1
+    with pytest.raises(security.HTTPException):
+        security.get_subject_for_token_type(token, "confirmation")
+
+
+def test_memoized_token_not_served_after_expiry(mocker):
+    email = "test@example.com"
+    token = security.create_access_token(email)
+    security.get_subject_for_token_type(token, "access")
+    mocker.patch("storeapi.security.time.time", return_value=time.time() + 3600)
+    spy = mocker.spy(security.jwt, "decode")
+    security.get_subject_for_token_type(token, "access")
+    assert spy.call_count == 1
+
+
 def test_get_subject_for_token_type_expired(mocker):
     mocker.patch("storeapi.security.access_token_expire_minutes", return_value=-1)
     email = "test@example.com"
@@ -43,3 +74,31 @@ def test_get_subject_for_token_type_expired(mocker):
     with pytest.raises(security.HTTPException) as exc_info:
         security.get_subject_for_token_type(token, "access")
     assert "Token has expired" == exc_info.value.detail
+
+
+def test_token_key_rotation(mocker):
+    email = "test@example.com"
+    mocker.patch.object(security.config, "SECRET_KEYS", "old:old-secret")
+    token = security.create_access_token(email)
+
+    mocker.patch.object(security.config, "SECRET_KEYS", "new:new-secret,old:old-secret")
+    assert security.get_subject_for_token_type(token, "access") == email
+    assert (
+        security.jwt.get_unverified_header(security.create_access_token(email))["kid"]
+        == "new"
+    )
+
+    mocker.patch.object(security.config, "SECRET_KEYS", "new:new-secret")
+    with pytest.raises(security.HTTPException) as exc_info:
+        security.get_subject_for_token_type(token, "access")
+    assert "Invalid token" == exc_info.value.detail
+
+
+@pytest.mark.anyio
+async def test_get_current_user_from_claims(mocker):
+    mocker.patch.object(security.config, "ACCESS_TOKEN_CLAIMS", True)
+    spy = mocker.spy(security.database, "fetch_one")
+    token = security.create_access_token("test@example.com", "access", 7, True)
+    user = await security.get_current_user(token)
+    assert (user.id, user.email, user.confirmed) == (7, "test@example.com", True)
+    assert spy.call_count == 0
@@ -1,3 +1,4 @@
+import json
 import httpx
 import pytest
 from databases import Database
@@ -5,11 +6,12 @@ from databases import Database
 from storeapi.database import post_table
 from storeapi.models.post import UserPost
 from storeapi.security import get_current_user
+from storeapi import tasks
 from storeapi.tasks import (
     APIResponseError,
     send_simple_message,
     _generate_cute_creature_api,
-    generate_and_add_to_post,
+    generate_image_job,
 )
 
 
@@ -61,7 +63,7 @@ async def test_generate_cute_creature_api_json_error(mock_tasks_httpx_client):
 
 
 @pytest.mark.anyio
-async def test_generate_and_add_to_post_success(
+async def test_generate_image_job_success(
     mock_tasks_httpx_client,
     async_client: httpx.AsyncClient,
     logged_in_token: str,
@@ -79,12 +81,46 @@ async def test_generate_and_add_to_post_success(
         headers={"Authorization": f"Bearer {logged_in_token}"},
     )
     user = await get_current_user(logged_in_token)
-    await generate_and_add_to_post(
-        user.email, post_res.json()["id"], "/post/1", db, "A cat"
+    await generate_image_job(
+        {
+            "email": user.email,
+            "post_id": post_res.json()["id"],
+            "post_url": "/post/1",
+            "prompt": "A cat",
+        }
     )
-    # Check that after the background task runs, the post has been updated
+    # Check that after the job runs, the post has been updated
     query = post_table.select().where(post_table.c.id == post_res.json()["id"])
     updated_post = await db.fetch_one(query)
 
     assert updated_post.image_url == json_data["output_url"]
     assert updated_post.body == "Test to generate image"
+
+
+def test_render_email():
+    subject, text = tasks.render_email("image_ready", {"name": "bob", "url": "/post/1"})
+    assert subject == "Image generation completed"
+    assert text.startswith("Hi bob!")
+    assert text.endswith("view it: /post/1")
+
+
+@pytest.mark.anyio
+async def test_send_templated_email_by_outbox(mock_tasks_httpx_client, mocker, db):
+    mocker.patch.object(tasks.email_outbox, "_task", object())
+    await tasks.send_templated_email("bob@example.net", "registration", {"url": "/c"})
+    mock_tasks_httpx_client.post.assert_not_called()
+    (job,) = await tasks.job_queue.claim_batch("send_email", 10)
+    assert job.payload == {
+        "to": "bob@example.net",
+        "template": "registration",
+        "variables": {"name": "bob", "url": "/c"},
+    }
+
+
+@pytest.mark.anyio
+async def test_send_batch_message(mock_tasks_httpx_client):
+    recipients = {"a@example.net": {"name": "a"}, "b@example.net": {"name": "b"}}
+    await tasks.send_batch_message("image_error", recipients)
+    data = mock_tasks_httpx_client.post.call_args.kwargs["data"]
+    assert data["to"] == ["a@example.net", "b@example.net"]
+    assert json.loads(data["recipient-variables"]) == recipients
@@ -0,0 +1,54 @@
+import pytest
+from httpx import AsyncClient
+
+from storeapi import security
+from storeapi.throttle import TokenBucketLimiter, login_email_limiter
+
+
+class FakeTimer:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_token_bucket_refills():
+    timer = FakeTimer()
+    limiter = TokenBucketLimiter("test", rate=1, burst=2, timer=timer)
+    assert limiter.acquire("a") == 0
+    assert limiter.acquire("a") == 0
+    assert limiter.acquire("a") == pytest.approx(1)
+    assert limiter.acquire("b") == 0
+    timer.now = 1
+    assert limiter.acquire("a") == 0
+
+
+def test_token_bucket_bounded():
+    limiter = TokenBucketLimiter("test", rate=1, burst=1, maxsize=2)
+    for key in "abc":
+        limiter.acquire(key)
+    assert list(limiter._buckets) == ["b", "c"]
+
+
+@pytest.mark.anyio
+async def test_login_throttled_per_email(
+    async_client: AsyncClient, confirmed_user: dict, mocker
+):
+    mocker.patch.object(login_email_limiter, "burst", 1)
+    user = {"email": confirmed_user["email"], "password": "wrong"}
+    assert (await async_client.post("/login", json=user)).status_code == 401
+    res = await async_client.post("/login", json=user)
+    assert res.status_code == 429
+    assert int(res.headers["Retry-After"]) >= 1
+
+
+@pytest.mark.anyio
+async def test_password_pool_sheds_when_full():
+    pool = security.PasswordHashPool("thread", workers=1, queue_size=0)
+    async with pool.slots:
+        with pytest.raises(security.HTTPException) as exc_info:
+            await pool.run(security.get_password_hash, "1234")
+    assert exc_info.value.status_code == 429
+    assert "Retry-After" in exc_info.value.headers
+    pool.shutdown()
@@ -1,12 +1,18 @@
+import asyncio
 import contextlib
 import os
 from pathlib import Path
 import tempfile
+import threading
 
-from fastapi import status
+from fastapi import HTTPException, status
 import pytest
 from httpx import AsyncClient
 
+from storeapi.database import database, uploaded_file_table
+from storeapi.libs.b2 import AsyncStreamReader, B2File, UploadPool
+from storeapi.upload_index import upload_index
+
 
 @pytest.fixture()
 def sample_image(fs) -> Path:
@@ -18,7 +24,8 @@ def sample_image(fs) -> Path:
 @pytest.fixture(autouse=True)
 def mock_b2_upload_file(mocker):
     return mocker.patch(
-        "storeapi.libs.b2.b2_upload_file", return_value="https://fakefile.jpg"
+        "storeapi.libs.b2.b2_upload_file",
+        return_value=B2File("fake-id", "https://fakefile.jpg"),
     )
 
 
@@ -86,3 +93,203 @@ async def test_wrong_token_upload(
     res = await call_upload_endpoint(async_client, "wrong token", sample_image)
     assert res.status_code == status.HTTP_401_UNAUTHORIZED
     assert res.json()["detail"] == "Invalid token"
+
+
+@pytest.mark.anyio
+async def test_async_stream_reader():
+    chunks = [b"ab", b"cd", b""]
+
+    async def read(size: int) -> bytes:
+        return chunks.pop(0)
+
+    reader = AsyncStreamReader(read, asyncio.get_running_loop())
+
+    def read_all() -> bytes:
+        data = b""
+        while chunk := reader.read(2):
+            data += chunk
+        return data
+
+    assert await asyncio.to_thread(read_all) == b"abcd"
+    assert reader.bytes_read == 4
+
+
+@pytest.mark.anyio
+async def test_upload_streamed(async_client: AsyncClient, logged_in_token: str, mocker):
+    uploaded = []
+
+    def upload_stream(stream, file_name: str) -> B2File:
+        while chunk := stream.read(4):
+            uploaded.append(chunk)
+        return B2File(f"id-{file_name}", f"https://fakefile/{file_name}")
+
+    mocker.patch("storeapi.routers.upload.b2_upload_stream", side_effect=upload_stream)
+    res = await async_client.post(
+        "/upload",
+        files={"file": ("cat.jpg", b"0123456789")},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert res.status_code == 201
+    assert res.json()["file_url"] == "https://fakefile/cat.jpg"
+    assert b"".join(uploaded) == b"0123456789"
+
+
+@pytest.mark.anyio
+async def test_upload_falls_back_to_temp_file(
+    async_client: AsyncClient, logged_in_token: str, mocker
+):
+    mocker.patch(
+        "storeapi.routers.upload.b2_upload_stream", side_effect=ConnectionError
+    )
+    fallback = mocker.patch(
+        "storeapi.routers.upload.upload_by_temp_file",
+        return_value=B2File("fake-id", "https://fakefile"),
+    )
+    res = await async_client.post(
+        "/upload",
+        files={"file": ("cat.jpg", b"0123456789")},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert res.status_code == 201
+    fallback.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_upload_pool_runs_off_the_loop():
+    pool = UploadPool(workers=1, queue_size=0)
+    release = threading.Event()
+    upload = asyncio.create_task(pool.run(release.wait, 5))
+    await asyncio.sleep(0.05)
+    # the loop keeps running while the upload blocks its thread
+    assert not upload.done()
+    with pytest.raises(HTTPException) as exc_info:
+        await pool.run(release.wait, 5)
+    assert exc_info.value.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    release.set()
+    assert await upload is True
+    assert pool.waiting == 0
+    pool.shutdown()
+
+
+@pytest.mark.anyio
+async def test_upload_pool_cancelled_while_queued():
+    pool = UploadPool(workers=1, queue_size=1)
+    release = threading.Event()
+    running = asyncio.create_task(pool.run(release.wait, 5))
+    queued = asyncio.create_task(pool.run(release.wait, 5))
+    await asyncio.sleep(0.05)
+    assert pool.waiting == 1
+    queued.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await queued
+    assert pool.waiting == 0
+    release.set()
+    await running
+    pool.shutdown()
+
+
+@pytest.mark.anyio
+async def test_upload_full_pool_refused(
+    async_client: AsyncClient, logged_in_token: str, mocker
+):
+    mocker.patch("storeapi.libs.b2.upload_pool.slots.locked", return_value=True)
+    res = await async_client.post(
+        "/upload",
+        files={"file": ("cat.jpg", b"0123456789")},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert res.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert "Retry-After" in res.headers
+
+
+async def post_file(async_client: AsyncClient, token: str, name: str, content: bytes):
+    return await async_client.post(
+        "/upload",
+        files={"file": (name, content)},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+
+@pytest.mark.anyio
+async def test_upload_same_content_once(
+    async_client: AsyncClient, logged_in_token: str, mocker
+):
+    upload_stream = mocker.patch(
+        "storeapi.routers.upload.b2_upload_stream",
+        return_value=B2File("id-cat", "https://fakefile/cat.jpg"),
+    )
+    first = await post_file(async_client, logged_in_token, "cat.jpg", b"meow")
+    second = await post_file(async_client, logged_in_token, "copy.jpg", b"meow")
+    assert first.json()["file_url"] == second.json()["file_url"]
+    upload_stream.assert_called_once()
+
+    row = await database.fetch_one(uploaded_file_table.select())
+    assert row.file_id == "id-cat"
+    assert row.size == 4
+    assert row.ref_count == 2
+
+
+@pytest.mark.anyio
+async def test_upload_other_content_uploaded(
+    async_client: AsyncClient, logged_in_token: str, mocker
+):
+    upload_stream = mocker.patch(
+        "storeapi.routers.upload.b2_upload_stream",
+        side_effect=lambda stream, name: B2File(f"id-{name}", f"https://f/{name}"),
+    )
+    await post_file(async_client, logged_in_token, "cat.jpg", b"meow")
+    res = await post_file(async_client, logged_in_token, "dog.jpg", b"woof")
+    assert res.json()["file_url"] == "https://f/dog.jpg"
+    assert upload_stream.call_count == 2
+
+
+@pytest.mark.anyio
+async def test_concurrent_uploads_of_same_content_joined():
+    release = asyncio.Event()
+    calls = []
+
+    async def upload() -> B2File:
+        calls.append(1)
+        await release.wait()
+        return B2File("id", "https://fakefile")
+
+    uploads = [
+        asyncio.create_task(upload_index.get_or_upload("abc", 3, upload))
+        for _ in range(3)
+    ]
+    await asyncio.sleep(0)
+    release.set()
+    assert await asyncio.gather(*uploads) == ["https://fakefile"] * 3
+    assert len(calls) == 1
+    assert await upload_index.release("abc") == 2
+
+
+@pytest.mark.anyio
+async def test_release_upload_reference(db):
+    await upload_index.add("abc", B2File("id", "https://fakefile"), 3)
+    assert await upload_index.release("abc") == 0
+    # the row is kept for cleanup, the count never goes below zero
+    assert await upload_index.release("abc") is None
+    assert await upload_index.release("unknown") is None
+
+
+@pytest.mark.anyio
+async def test_waiter_uploads_when_first_upload_fails():
+    release = asyncio.Event()
+
+    async def failing_upload() -> B2File:
+        await release.wait()
+        raise ConnectionError("request closed")
+
+    async def upload() -> B2File:
+        return B2File("id", "https://fakefile")
+
+    first = asyncio.create_task(upload_index.get_or_upload("abc", 3, failing_upload))
+    await asyncio.sleep(0)
+    waiter = asyncio.create_task(upload_index.get_or_upload("abc", 3, upload))
+    await asyncio.sleep(0)
+    release.set()
+    with pytest.raises(ConnectionError):
+        await first
+    assert await waiter == "https://fakefile"
+    assert await upload_index.release("abc") == 0
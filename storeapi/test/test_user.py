@@ -1,9 +1,9 @@
-from multiprocessing import Process
 import pytest
 from fastapi import Request, status, BackgroundTasks
 from httpx import AsyncClient
 
 from storeapi import security
+from storeapi.worker_pool import email_pool
 
 
 @pytest.mark.anyio
@@ -20,6 +20,19 @@ async def test_get_user_not_found():
     assert user is None
 
 
+@pytest.mark.anyio
+async def test_get_user_cached(confirmed_user: dict, mocker):
+    spy = mocker.spy(security.database, "fetch_one")
+    await security.get_user(confirmed_user["email"])
+    user = await security.get_user(confirmed_user["email"])
+    assert user.id == confirmed_user["id"]
+    assert spy.call_count == 1
+
+    security.invalidate_user(user_id=confirmed_user["id"])
+    await security.get_user(confirmed_user["email"])
+    assert spy.call_count == 2
+
+
 @pytest.mark.anyio
 async def test_login_user(confirmed_user: dict, async_client: AsyncClient):
     # user = await security.authenticate_user(
@@ -31,6 +44,60 @@ async def test_login_user(confirmed_user: dict, async_client: AsyncClient):
     assert {"token_type": "bearer"}.items() <= res.json().items()
 
 
+@pytest.mark.anyio
+async def test_refresh_token(confirmed_user: dict, async_client: AsyncClient, mocker):
+    mocker.patch.object(security.config, "ACCESS_TOKEN_CLAIMS", True)
+    res = await async_client.post("/login", json=confirmed_user)
+    refresh_token = res.json()["refresh_token"]
+    res = await async_client.post("/refresh", json={"refresh_token": refresh_token})
+    assert res.status_code == 201
+    user = await security.get_current_user(res.json()["access_token"])
+    assert user.id == confirmed_user["id"]
+
+
+@pytest.mark.anyio
+async def test_refresh_with_access_token(
+    confirmed_user: dict, async_client: AsyncClient
+):
+    res = await async_client.post("/login", json=confirmed_user)
+    res = await async_client.post(
+        "/refresh", json={"refresh_token": res.json()["access_token"]}
+    )
+    assert res.status_code == 401
+
+
+@pytest.mark.anyio
+async def test_logout_revokes_refresh_token(
+    confirmed_user: dict, async_client: AsyncClient
+):
+    res = await async_client.post("/login", json=confirmed_user)
+    tokens = res.json()
+    res = await async_client.post(
+        "/logout",
+        json={"refresh_token": tokens["refresh_token"]},
+        headers={"Authorization": f"Bearer {tokens['access_token']}"},
+    )
+    assert res.status_code == 200
+    res = await async_client.post(
+        "/refresh", json={"refresh_token": tokens["refresh_token"]}
+    )
+    assert res.status_code == 401
+    assert res.json()["detail"] == "Token has been revoked"
+
+
+@pytest.mark.anyio
+async def test_refresh_revoked_by_other_process(
+    confirmed_user: dict, async_client: AsyncClient
+):
+    res = await async_client.post("/login", json=confirmed_user)
+    refresh_token = res.json()["refresh_token"]
+    await security.revoke_token(refresh_token)
+    # this process has not refreshed its revocation list yet
+    security.revocation_list.clear()
+    res = await async_client.post("/refresh", json={"refresh_token": refresh_token})
+    assert res.status_code == 401
+
+
 @pytest.mark.anyio
 async def test_fail_cookie_login(async_client: AsyncClient):
     res = await async_client.get("/login/cookies")
@@ -96,13 +163,13 @@ async def test_authenticate_user_not_confirmed(registered_user: dict):
 async def test_confirm_user(async_client: AsyncClient, mocker):
     # spy = mocker.spy(Request, "url_for")
     # spy = mocker.spy(BackgroundTasks, "add_task")
-    spy = mocker.spy(Process, "__init__")
+    spy = mocker.spy(email_pool, "submit")
     await async_client.post(
         "/register", json={"email": "test@example.net", "password": "1234"}
     )
     # confirm_url = str(spy.spy_return)
     # confirm_url = str(spy.call_args[1]["confirmation_url"])
-    confirm_url = str(spy.call_args[1]["args"][1])
+    confirm_url = spy.call_args[0][2]
     res = await async_client.get(confirm_url)
     assert res.status_code == 200
     assert "You're confirmed" in res.json()["detail"]
@@ -112,12 +179,12 @@ async def test_confirm_user(async_client: AsyncClient, mocker):
 async def test_confirm_email_token_expired(async_client: AsyncClient, mocker):
     mocker.patch("storeapi.security.confirmation_token_expire_minutes", return_value=-1)
     # spy = mocker.spy(BackgroundTasks, "add_task")
-    spy = mocker.spy(Process, "__init__")
+    spy = mocker.spy(email_pool, "submit")
     await async_client.post(
         "/register", json={"email": "test@example.net", "password": "1234"}
     )
     # confirm_url = str(spy.call_args[1]["confirmation_url"])
-    confirm_url = str(spy.call_args[1]["args"][1])
+    confirm_url = spy.call_args[0][2]
     res = await async_client.get(confirm_url)
     assert res.status_code == status.HTTP_401_UNAUTHORIZED
     assert "Token has expired" in res.json()["detail"]
@@ -139,3 +206,14 @@ async def test_expired_token(async_client: AsyncClient, confirmed_user: dict, mo
 async def test_invalid_confirm_user(async_client: AsyncClient):
     res = await async_client.get("/confirm/invalid_token")
     assert res.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+@pytest.mark.anyio
+async def test_logout_revokes_token(async_client: AsyncClient, logged_in_token: str):
+    res = await async_client.get(
+        "/logout", headers={"Authorization": f"Bearer {logged_in_token}"}
+    )
+    assert res.status_code == 200
+    with pytest.raises(security.HTTPException) as exc_info:
+        await security.get_current_user(logged_in_token)
+    assert exc_info.value.detail == "Token has been revoked"
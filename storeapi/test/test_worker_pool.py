@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from storeapi.worker_pool import WorkerPool
+
+
+@pytest.mark.anyio
+async def test_stop_drains_queue():
+    done = []
+
+    async def job(n: int):
+        await asyncio.sleep(0)
+        done.append(n)
+
+    pool = WorkerPool("test", workers=2, queue_size=10)
+    pool.start()
+    for n in range(5):
+        await pool.submit(job, n)
+    await pool.stop()
+    assert sorted(done) == [0, 1, 2, 3, 4]
+    assert not pool.running
+
+
+@pytest.mark.anyio
+async def test_failed_job_does_not_stop_worker():
+    done = []
+
+    async def fail():
+        raise ValueError("boom")
+
+    async def job():
+        done.append(True)
+
+    pool = WorkerPool("test", workers=1, queue_size=1)
+    pool.start()
+    await pool.submit(fail)
+    await pool.submit(job)
+    await pool.stop()
+    assert done == [True]
+
+
+@pytest.mark.anyio
+async def test_submit_waits_while_queue_full():
+    release = asyncio.Event()
+
+    async def job():
+        await release.wait()
+
+    pool = WorkerPool("test", workers=1, queue_size=1)
+    pool.start()
+    await pool.submit(job)
+    await asyncio.sleep(0)  # the worker takes the first job
+    await pool.submit(job)
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(pool.submit(job), 0.05)
+    release.set()
+    await pool.stop()
+
+
+@pytest.mark.anyio
+async def test_submit_before_start():
+    async def job():
+        pass
+
+    with pytest.raises(RuntimeError):
+        await WorkerPool("test", workers=1, queue_size=1).submit(job)
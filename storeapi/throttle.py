@@ -0,0 +1,106 @@
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from fastapi import HTTPException, status
+
+from storeapi import metrics
+from storeapi.config import config
+
+logger = logging.getLogger(__name__)
+
+
+def too_many_requests_exception(retry_after: float) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many requests, retry later",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+class TokenBucketLimiter:
+    """
+    A token bucket per key, refilled by rate tokens per second up to burst.
+    Only the maxsize most recently seen keys are tracked, a key which falls
+    out starts again with a full bucket.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: int,
+        maxsize: int = 10000,
+        timer: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.timer = timer
+        self._buckets: OrderedDict[Hashable, tuple[float, float]] = OrderedDict()
+
+    def acquire(self, key: Hashable) -> float:
+        """
+        Take a token of the key
+        :return: 0 when allowed, else seconds until a token is available
+        """
+        now = self.timer()
+        tokens, last = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens >= 1:
+            tokens -= 1
+            retry_after = 0.0
+        else:
+            retry_after = (1 - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+    def check(self, key: Hashable) -> None:
+        """Raise 429 when the key has run out of tokens"""
+        retry_after = self.acquire(key)
+        if retry_after:
+            metrics.throttle_decisions.labels(self.name, "throttled").inc()
+            logger.warning(f"Throttled {self.name} for {retry_after:.1f}s")
+            raise too_many_requests_exception(retry_after)
+        metrics.throttle_decisions.labels(self.name, "allowed").inc()
+
+    def clear(self) -> None:
+        self._buckets.clear()
+
+
+login_ip_limiter = TokenBucketLimiter(
+    "login_ip", rate=config.LOGIN_IP_PER_MINUTE / 60, burst=config.LOGIN_IP_BURST
+)
+login_email_limiter = TokenBucketLimiter(
+    "login_email",
+    rate=config.LOGIN_EMAIL_PER_MINUTE / 60,
+    burst=config.LOGIN_EMAIL_BURST,
+)
+register_ip_limiter = TokenBucketLimiter(
+    "register_ip",
+    rate=config.REGISTER_IP_PER_MINUTE / 60,
+    burst=config.REGISTER_IP_BURST,
+)
+
+
+def throttle_login(ip: str | None, email: str) -> None:
+    if not config.THROTTLE_ENABLED:
+        return
+    login_ip_limiter.check(ip)
+    login_email_limiter.check(email.lower())
+
+
+def throttle_register(ip: str | None) -> None:
+    if not config.THROTTLE_ENABLED:
+        return
+    register_ip_limiter.check(ip)
+
+
+def clear_limiters() -> None:
+    for limiter in (login_ip_limiter, login_email_limiter, register_ip_limiter):
+        limiter.clear()
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from databases import Database
+
+from storeapi import metrics
+from storeapi.database import database, dialect_insert, uploaded_file_table
+from storeapi.libs.b2 import B2File
+
+logger = logging.getLogger(__name__)
+
+
+class UploadIndex:
+    """
+    B2 files by sha256 of their content, so content uploaded before is
+    referenced again instead of being sent to B2. Concurrent uploads of
+    the same content wait for the one in flight.
+    """
+
+    def __init__(self, db: Database) -> None:
+        self.db = db
+        # set once the upload of a digest has finished or failed
+        self._in_flight: dict[str, asyncio.Event] = {}
+
+    async def acquire(self, digest: str) -> str | None:
+        """Add a reference to the file, :return: its url, None when unknown"""
+        query = (
+            uploaded_file_table.update()
+            .where(uploaded_file_table.c.digest == digest)
+            .values(ref_count=uploaded_file_table.c.ref_count + 1)
+            .returning(uploaded_file_table.c.file_url)
+        )
+        logger.debug(query)
+        return await self.db.fetch_val(query)
+
+    async def add(self, digest: str, file: B2File, size: int) -> None:
+        """
+        Record an uploaded file with one reference, when the content was
+        recorded meanwhile the first file is kept and referenced instead
+        """
+        query = (
+            dialect_insert(uploaded_file_table)
+            .values(digest=digest, file_id=file.file_id, file_url=file.url, size=size)
+            .on_conflict_do_update(
+                index_elements=["digest"],
+                set_={"ref_count": uploaded_file_table.c.ref_count + 1},
+            )
+        )
+        logger.debug(query)
+        await self.db.execute(query)
+
+    async def release(self, digest: str) -> int | None:
+        """
+        Drop a reference to the file, the row is kept so a file left
+        without references can be deleted from B2 later
+        :return: references left, None when unknown
+        """
+        query = (
+            uploaded_file_table.update()
+            .where(
+                uploaded_file_table.c.digest == digest,
+                uploaded_file_table.c.ref_count > 0,
+            )
+            .values(ref_count=uploaded_file_table.c.ref_count - 1)
+            .returning(uploaded_file_table.c.ref_count)
+        )
+        logger.debug(query)
+        return await self.db.fetch_val(query)
+
+    async def get_or_upload(
+        self, digest: str, size: int, upload: Callable[[], Awaitable[B2File]]
+    ) -> str:
+        """
+        The content is uploaded by the request calling it, a concurrent
+        upload of the same content waits for it and then references its
+        file, or uploads itself when it has failed
+        :param: upload: coroutine function uploading the content to B2
+        :return: url of the file holding the content
+        """
+        while True:
+            if (done := self._in_flight.get(digest)) is not None:
+                await done.wait()
+            if (file_url := await self.acquire(digest)) is not None:
+                metrics.cache_hits.labels("upload").inc()
+                metrics.upload_dedup_bytes_saved.inc(size)
+                return file_url
+            # checked again, another upload may have started while reading
+            if digest not in self._in_flight:
+                break
+        metrics.cache_misses.labels("upload").inc()
+        done = asyncio.Event()
+        self._in_flight[digest] = done
+        try:
+            file = await upload()
+            await self.add(digest, file, size)
+        finally:
+            del self._in_flight[digest]
+            done.set()
+        return file.url
+
+
+upload_index = UploadIndex(database)
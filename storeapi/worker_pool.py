@@ -0,0 +1,85 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable
+
+from storeapi import metrics
+from storeapi.config import config
+
+logger = logging.getLogger(__name__)
+
+Job = tuple[float, Callable[..., Awaitable[Any]], tuple]
+
+
+class WorkerPool:
+    """
+    Long lived asyncio workers fed by a bounded queue. submit() waits
+    while the queue is full, so a burst slows its producers down instead
+    of piling up work. stop() lets the workers finish what is queued.
+    """
+
+    def __init__(self, name: str, workers: int, queue_size: int) -> None:
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queue: asyncio.Queue[Job] | None = None
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self) -> None:
+        logger.info(f"Starting {self.workers} {self.name} workers")
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def submit(self, func: Callable[..., Awaitable[Any]], *args) -> None:
+        """Queue func(*args) to be awaited by a worker"""
+        if self._queue is None:
+            raise RuntimeError(f"{self.name} worker pool is not started")
+        await self._queue.put((time.perf_counter(), func, args))
+        metrics.worker_queue_depth.labels(self.name).set(self._queue.qsize())
+
+    async def stop(self, timeout: float | None = None) -> None:
+        """Wait at most timeout seconds for queued jobs, then stop the workers"""
+        if self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Dropping {self._queue.qsize()} queued {self.name} jobs on shutdown"
+            )
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+        metrics.worker_queue_depth.labels(self.name).set(0)
+        logger.info(f"{self.name} workers stopped")
+
+    async def _work(self) -> None:
+        while True:
+            queued_at, func, args = await self._queue.get()
+            metrics.worker_queue_depth.labels(self.name).set(self._queue.qsize())
+            start = time.perf_counter()
+            metrics.worker_queue_wait_seconds.labels(self.name).observe(
+                start - queued_at
+            )
+            outcome = "ok"
+            try:
+                await func(*args)
+            except Exception:
+                outcome = "failed"
+                logger.exception(f"{self.name} job {func.__name__} failed")
+            finally:
+                metrics.worker_task_seconds.labels(self.name, outcome).observe(
+                    time.perf_counter() - start
+                )
+                self._queue.task_done()
+
+
+email_pool = WorkerPool(
+    "email", workers=config.EMAIL_WORKERS, queue_size=config.EMAIL_QUEUE_SIZE
+)